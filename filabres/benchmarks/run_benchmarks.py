@@ -0,0 +1,410 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2020 Universidad Complutense de Madrid
+#
+# This file is part of filabres
+#
+# SPDX-License-Identifier: GPL-3.0+
+# License-Filename: LICENSE.txt
+#
+
+"""
+Benchmark the reduction stages with synthetic data.
+
+A temporary workspace is created with synthetic raw data (see
+synthetic.py), and the different stages are executed in the usual
+order: classification, calibration steps, science reduction (without
+astrometric calibration and, optionally, with the stub versions of the
+external astrometric tools; see stubs.py) and listings. For each
+benchmark the throughput (frames/s, and MB/s of raw data or, in the
+listings, of the databases) and the peak memory allocated by Python
+(tracemalloc) are reported.
+"""
+
+import argparse
+from contextlib import redirect_stdout
+import glob
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from filabres import LISTDIR
+from .synthetic import PIXSCALE
+from .synthetic import generate_night
+
+BENCHMARKS = ['statsumm', 'maskfromflat', 'initialize', 'bias', 'flat-imaging',
+              'science-imaging', 'science-imaging-astrometry', 'list_classified', 'list_reduced']
+
+# reduction steps available for both CAFOS and LSSS
+CALIBRATION_STEPS = ['bias', 'flat-imaging']
+SCIENCE_STEP = 'science-imaging'
+
+
+class BenchmarkResult(object):
+    """
+    Store the result of a single benchmark.
+
+    Parameters
+    ----------
+    name : str
+        Benchmark name.
+    nframes : int
+        Number of frames processed.
+    nbytes : int
+        Number of bytes of raw data processed.
+    elapsed : float
+        Elapsed time (seconds).
+    peak_mb : float or None
+        Peak memory allocated by Python (MB), as measured by tracemalloc.
+    """
+    def __init__(self, name, nframes, nbytes, elapsed, peak_mb):
+        self.name = name
+        self.nframes = nframes
+        self.nbytes = nbytes
+        self.elapsed = elapsed
+        self.peak_mb = peak_mb
+
+    def asdict(self):
+        elapsed = max(self.elapsed, 1E-9)
+        return {'name': self.name,
+                'nframes': self.nframes,
+                'elapsed_s': round(self.elapsed, 4),
+                'frames_per_s': round(self.nframes / elapsed, 3),
+                'mb_per_s': round(self.nbytes / 1024 / 1024 / elapsed, 3),
+                'peak_mb': None if self.peak_mb is None else round(self.peak_mb, 2)}
+
+    def __str__(self):
+        d = self.asdict()
+        peak = '-' if d['peak_mb'] is None else '{:.2f}'.format(d['peak_mb'])
+        return '{:<28} {:>6} {:>10.3f} {:>10.2f} {:>10.2f} {:>10}'.format(
+            d['name'], d['nframes'], d['elapsed_s'], d['frames_per_s'], d['mb_per_s'], peak)
+
+
+def measure(name, function, nframes, nbytes, memory=True, quiet=True):
+    """
+    Execute function and measure elapsed time and peak memory.
+
+    Parameters
+    ----------
+    name : str
+        Benchmark name.
+    function : callable
+        Function (without arguments) to be benchmarked.
+    nframes : int
+        Number of frames processed by the function.
+    nbytes : int
+        Number of bytes of raw data processed by the function.
+    memory : bool
+        If True, measure peak memory with tracemalloc (note that this
+        increases the elapsed time).
+    quiet : bool
+        If True, the output of the function is suppressed.
+
+    Returns
+    -------
+    result : instance of BenchmarkResult
+        Benchmark result.
+    """
+    if memory:
+        tracemalloc.start()
+    t0 = time.perf_counter()
+    try:
+        if quiet:
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                function()
+        else:
+            function()
+    except SystemExit:
+        pass
+    elapsed = time.perf_counter() - t0
+    peak_mb = None
+    if memory:
+        peak_mb = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+        tracemalloc.stop()
+    return BenchmarkResult(name, nframes, nbytes, elapsed, peak_mb)
+
+
+def prepare_workspace(workdir, instrument, nights, naxis, nbias, nflat, nscience, npointings, nstars):
+    """
+    Generate synthetic data and the initial setup files.
+
+    Returns
+    -------
+    catalogues : dict
+        Synthetic Gaia-like catalogues of each night.
+    """
+    from filabres.generate_setup import generate_setup
+
+    datadir = os.path.join(workdir, 'data')
+    catalogues = dict()
+    for i, night in enumerate(nights):
+        catalogues[night] = generate_night(datadir, night, instrument=instrument,
+                                           naxis1=naxis, naxis2=naxis,
+                                           nbias=nbias, nflat=nflat, nscience=nscience,
+                                           npointings=npointings, nstars=nstars,
+                                           mjd0=57800.8 + i, seed=1234 + i)
+    os.chdir(workdir)
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        generate_setup([instrument, datadir])
+    return catalogues
+
+
+def prepare_gaia_indices(redustep, night, catalogues):
+    """
+    Store the synthetic catalogues as previously downloaded Gaia data.
+
+    The catalogues are saved in the index subdirectories of the night,
+    and registered as central pointings of the night, so that
+    run_astrometry() reuses them instead of querying the Gaia archive.
+    """
+    from astropy.io import fits
+    from filabres.pointing_index import PointingIndex
+
+    nightdir = os.path.join(redustep, night)
+    os.makedirs(nightdir, exist_ok=True)
+    ccbase = PointingIndex(nightdir)
+    for i, catalogue in enumerate(catalogues):
+        subdir = 'index{:06d}'.format(i + 1)
+        os.makedirs(os.path.join(nightdir, subdir), exist_ok=True)
+        table = catalogue['table']
+        hdu = fits.BinTableHDU.from_columns([
+            fits.Column(name='source_id', format='K', array=np.array(table['SOURCE_ID'])),
+            fits.Column(name='ra', format='D', array=np.array(table['ra'])),
+            fits.Column(name='dec', format='D', array=np.array(table['dec'])),
+            fits.Column(name='phot_g_mean_mag', format='E', array=np.array(table['phot_g_mean_mag']))
+        ])
+        fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(os.path.join(nightdir, subdir, 'GaiaDRX-query.fits'),
+                                                       overwrite=True)
+        ccbase.add(subdir, catalogue['ra'], catalogue['dec'], catalogue['radius_deg'] * 60)
+
+
+def raw_files(datadir, nights, imagetype=None):
+    """Return list of raw files (optionally of a given image type)."""
+    result = []
+    for night in nights:
+        for fname in sorted(os.listdir(os.path.join(datadir, night))):
+            if imagetype is None or fname.endswith('-{}.fits'.format(imagetype)):
+                result.append(os.path.join(datadir, night, fname))
+    return result
+
+
+def nbytes_of(filelist):
+    """Return total size of files."""
+    return sum([os.path.getsize(fname) for fname in filelist])
+
+
+def run_benchmarks(workdir, instrument='cafos', nnights=1, naxis=512, nbias=5, nflat=5, nscience=5,
+                   npointings=1, nstars=300, selected=None, memory=True, quiet=True):
+    """
+    Execute the benchmarks in a workspace with synthetic data.
+
+    Parameters
+    ----------
+    workdir : str
+        Directory where the synthetic data and the reduction products
+        are generated (it must not exist or be empty).
+    instrument : str
+        'cafos' or 'lsss'.
+    nnights : int
+        Number of observing nights.
+    naxis : int
+        Dimensions (NAXIS1 = NAXIS2) of the synthetic images.
+    nbias, nflat, nscience : int
+        Number of bias, flat and science frames in each night.
+    npointings : int
+        Number of different pointings of the science frames.
+    nstars : int
+        Number of stars in the catalogue of each pointing.
+    selected : list of str or None
+        Benchmarks to be reported (see BENCHMARKS). If None, all of
+        them are reported. Note that the classification, calibration
+        steps and science reduction (without astrometric calibration)
+        are always executed, since they are required by the subsequent
+        stages.
+    memory : bool
+        If True, measure peak memory with tracemalloc.
+    quiet : bool
+        If True, the output of the reduction stages is suppressed.
+
+    Returns
+    -------
+    results : list of BenchmarkResult instances
+        Results of the selected benchmarks.
+    """
+    from astropy.io import fits
+    from filabres.load_instrument_configuration import load_instrument_configuration
+    from filabres.load_setup import load_setup
+    from filabres.maskfromflat import maskfromflat
+    from filabres.statsumm import statsumm
+    from .stubs import install_stubs
+
+    if selected is None:
+        selected = BENCHMARKS
+    for item in selected:
+        if item not in BENCHMARKS:
+            raise ValueError('Unexpected benchmark: {}'.format(item))
+
+    workdir = os.path.abspath(workdir)
+    os.makedirs(workdir, exist_ok=True)
+    if len(os.listdir(workdir)) > 0:
+        msg = 'Working directory {} is not empty'.format(workdir)
+        raise SystemError(msg)
+
+    initial_dir = os.getcwd()
+    initial_environ = dict(os.environ)
+    # non-interactive matplotlib backend
+    os.environ['MPLBACKEND'] = 'Agg'
+
+    nights = ['night{:03d}'.format(i + 1) for i in range(nnights)]
+    results = []
+    try:
+        catalogues = prepare_workspace(workdir, instrument, nights, naxis, nbias, nflat, nscience,
+                                       npointings, nstars)
+        setupdata = load_setup()
+        datadir = setupdata['datadir']
+        allfiles = raw_files(datadir, nights)
+        flatfiles = raw_files(datadir, nights, 'flat')
+        sciencefiles = raw_files(datadir, nights, 'science')
+
+        # image statistics
+        if 'statsumm' in selected:
+            def function():
+                for fname in allfiles:
+                    with fits.open(fname) as hdul:
+                        statsumm(hdul[0].data.astype(float), rm_nan=True)
+            results.append(measure('statsumm', function, len(allfiles), nbytes_of(allfiles), memory, quiet))
+
+        # useful region mask from flatfields
+        if 'maskfromflat' in selected:
+            def function():
+                for fname in flatfiles:
+                    with fits.open(fname) as hdul:
+                        maskfromflat(hdul[0].data.astype(float))
+            results.append(measure('maskfromflat', function, len(flatfiles), nbytes_of(flatfiles), memory, quiet))
+
+        # classification
+        def function():
+            from filabres.classify_images import classify_images
+            instconf = load_instrument_configuration(setupdata, 'initialize')
+            classify_images(list_of_nights=nights, instconf=instconf, setupdata=setupdata, force=False)
+        result = measure('initialize', function, len(allfiles), nbytes_of(allfiles), memory, quiet)
+        if 'initialize' in selected:
+            results.append(result)
+
+        # calibration steps
+        for redustep in CALIBRATION_STEPS:
+            def function():
+                from filabres.run_calibration_step import run_calibration_step
+                instconf = load_instrument_configuration(setupdata, redustep)
+                run_calibration_step(redustep=redustep, setupdata=setupdata, list_of_nights=nights,
+                                     instconf=instconf, force=False)
+            imagetype = 'flat' if redustep.startswith('flat') else redustep
+            filelist = raw_files(datadir, nights, imagetype)
+            result = measure(redustep, function, len(filelist), nbytes_of(filelist), memory, quiet)
+            if redustep in selected:
+                results.append(result)
+
+        # science reduction (the astrometric calibration makes use of the
+        # stub versions of the external tools)
+        redustep = SCIENCE_STEP
+        instconf = load_instrument_configuration(setupdata, redustep)
+        for with_astrometry in [False, True]:
+            name = redustep + ('-astrometry' if with_astrometry else '')
+            if with_astrometry:
+                if name not in selected:
+                    continue
+                install_stubs(os.path.join(workdir, 'bin'))
+                os.environ['PATH'] = os.path.join(workdir, 'bin') + os.pathsep + initial_environ['PATH']
+                os.environ['FILABRES_STUB_PIXSCALE'] = str(PIXSCALE[instrument])
+                for night in nights:
+                    prepare_gaia_indices(redustep, night, catalogues[night])
+
+            def function():
+                from filabres.run_reduction_step import run_reduction_step
+                run_reduction_step(redustep=redustep, interactive=False, setupdata=setupdata,
+                                   list_of_nights=nights, filename=None,
+                                   no_astrometry=not with_astrometry, no_reuse_gaia=False,
+                                   instconf=instconf, force=True)
+            result = measure(name, function, len(sciencefiles), nbytes_of(sciencefiles), memory, quiet)
+            if name in selected:
+                results.append(result)
+
+        # listings
+        if 'list_classified' in selected:
+            def function():
+                from filabres.list_classified import list_classified
+                list_classified(setupdata=setupdata, img=redustep, list_mode='long', args_night=None,
+                                args_keyword=None, args_keyword_sort=None, args_filter=None,
+                                args_plotxy=False, args_plotimage=False)
+            dbfiles = glob.glob('{}*/imagedb_{}.json'.format(LISTDIR, instrument))
+            results.append(measure('list_classified', function, len(sciencefiles), nbytes_of(dbfiles),
+                                   memory, quiet))
+        if 'list_reduced' in selected:
+            def function():
+                from filabres.list_reduced import list_reduced
+                list_reduced(setupdata=setupdata, img=redustep, list_mode='long', args_night=None,
+                             args_keyword=[['QUANT500'], ['IERR_ASTR'], ['TIME_TOTAL']], args_keyword_sort=None,
+                             args_filter=None, args_plotxy=False, args_plotimage=False)
+            dbfiles = glob.glob('{}/*/filabres_db_{}_{}.json'.format(redustep, instrument, redustep))
+            results.append(measure('list_reduced', function, len(sciencefiles), nbytes_of(dbfiles),
+                                   memory, quiet))
+    finally:
+        os.chdir(initial_dir)
+        os.environ.clear()
+        os.environ.update(initial_environ)
+
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark filabres with synthetic data")
+    parser.add_argument("--instrument", type=str, default='cafos', choices=['cafos', 'lsss'])
+    parser.add_argument("--nnights", type=int, default=1, help="number of nights")
+    parser.add_argument("--naxis", type=int, default=512, help="image dimensions (NAXIS1=NAXIS2)")
+    parser.add_argument("--nbias", type=int, default=5, help="number of bias frames per night")
+    parser.add_argument("--nflat", type=int, default=5, help="number of flat frames per night")
+    parser.add_argument("--nscience", type=int, default=5, help="number of science frames per night")
+    parser.add_argument("--npointings", type=int, default=1, help="number of science pointings per night")
+    parser.add_argument("--nstars", type=int, default=300, help="number of stars per pointing")
+    parser.add_argument("--benchmark", type=str, action='append', choices=BENCHMARKS,
+                        help="benchmark to be executed (default: all)")
+    parser.add_argument("--workdir", type=str,
+                        help="working directory (default: temporary directory, deleted at the end)")
+    parser.add_argument("--no_memory", action="store_true", help="do not measure peak memory")
+    parser.add_argument("--json", type=str, help="save results in JSON file", metavar='FILE')
+    parser.add_argument("--verbose", action="store_true", help="display output of the reduction stages")
+    args = parser.parse_args(args)
+
+    if args.workdir is None:
+        workdir = tempfile.mkdtemp(prefix='filabres-benchmarks-')
+    else:
+        workdir = args.workdir
+
+    try:
+        results = run_benchmarks(workdir, instrument=args.instrument, nnights=args.nnights, naxis=args.naxis,
+                                 nbias=args.nbias, nflat=args.nflat, nscience=args.nscience,
+                                 npointings=args.npointings, nstars=args.nstars, selected=args.benchmark,
+                                 memory=not args.no_memory, quiet=not args.verbose)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print('{:<28} {:>6} {:>10} {:>10} {:>10} {:>10}'.format(
+        'benchmark', 'frames', 'time (s)', 'frames/s', 'MB/s', 'peak (MB)'))
+    for result in results:
+        print(result)
+
+    if args.json is not None:
+        with open(args.json, 'w') as outfile:
+            json.dump({'argv': sys.argv, 'results': [result.asdict() for result in results]}, outfile, indent=2)
+
+
+if __name__ == "__main__":
+
+    main()
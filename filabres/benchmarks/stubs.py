@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2020 Universidad Complutense de Madrid
+#
+# This file is part of filabres
+#
+# SPDX-License-Identifier: GPL-3.0+
+# License-Filename: LICENSE.txt
+#
+
+"""
+Stub replacements of the external astrometric tools.
+
+The stubs mimic the output files of build-astrometry-index, image2xy,
+solve-field, new-wcs (Astrometry.net) and sex, scamp (AstrOmatic.net) that
+are read
+by run_astrometry(), without performing any actual computation. They
+allow the orchestration overhead of the astrometric calibration to be
+benchmarked offline.
+
+The WCS solution generated by the solve-field stub is centred on the
+coordinates given with --ra/--dec, with the pixel scale given by the
+environment variable FILABRES_STUB_PIXSCALE (arcsec/pixel; default 1.0).
+The field is not solved when the index file has been built with one of
+the P values listed (comma separated) in FILABRES_STUB_UNSOLVED_P.
+
+Usage: python -m filabres.benchmarks.stubs <tool> [arguments]
+"""
+
+from astropy.io import fits
+import numpy as np
+import os
+import stat
+import sys
+
+TOOLS = ['build-astrometry-index', 'image2xy', 'solve-field', 'new-wcs', 'sex', 'scamp']
+
+
+def install_stubs(bindir):
+    """
+    Generate executable stub scripts.
+
+    Parameters
+    ----------
+    bindir : str
+        Directory where the scripts are created. It must be prepended
+        to the PATH environment variable to replace the actual tools.
+    """
+    os.makedirs(bindir, exist_ok=True)
+    # make sure the stubs import this same copy of filabres
+    pythonpath = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    for tool in TOOLS:
+        fname = os.path.join(bindir, tool)
+        with open(fname, 'wt') as f:
+            f.write('#!/bin/sh\n')
+            f.write('PYTHONPATH="{}${{PYTHONPATH:+:$PYTHONPATH}}"\n'.format(pythonpath))
+            f.write('export PYTHONPATH\n')
+            f.write('exec "{}" -m filabres.benchmarks.stubs {} "$@"\n'.format(sys.executable, tool))
+        os.chmod(fname, os.stat(fname).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+
+def getarg(args, option, default=None):
+    """Return value following option in list of arguments."""
+    if option in args:
+        return args[args.index(option) + 1]
+    return default
+
+
+def stub_wcs_header(ra, dec, naxis1, naxis2):
+    """Return TAN-SIP header mimicking the output of solve-field."""
+    pixscale = float(os.environ.get('FILABRES_STUB_PIXSCALE', '1.0'))
+    header = fits.Header()
+    header['WCSAXES'] = 2
+    header['CTYPE1'] = ('RA---TAN-SIP', 'TAN (gnomic) projection + SIP distortions')
+    header['CTYPE2'] = ('DEC--TAN-SIP', 'TAN (gnomic) projection + SIP distortions')
+    header['EQUINOX'] = (2000.0, 'Equatorial coordinates definition (yr)')
+    header['CRVAL1'] = (ra, 'RA  of reference point')
+    header['CRVAL2'] = (dec, 'DEC of reference point')
+    header['CRPIX1'] = ((naxis1 + 1) / 2, 'X reference pixel')
+    header['CRPIX2'] = ((naxis2 + 1) / 2, 'Y reference pixel')
+    header['CUNIT1'] = ('deg', 'X pixel scale units')
+    header['CUNIT2'] = ('deg', 'Y pixel scale units')
+    header['CD1_1'] = (-pixscale / 3600, 'Transformation matrix')
+    header['CD1_2'] = (0.0, 'no comment')
+    header['CD2_1'] = (0.0, 'no comment')
+    header['CD2_2'] = (pixscale / 3600, 'no comment')
+    header['IMAGEW'] = (naxis1, 'Image width,  in pixels.')
+    header['IMAGEH'] = (naxis2, 'Image height, in pixels.')
+    for p in ['', 'P']:
+        for c in ['A', 'B']:
+            header['{}{}_ORDER'.format(c, p)] = (2, 'Polynomial order, axis {}'.format(c))
+            for i in range(3):
+                for j in range(3):
+                    if i + j < 3:
+                        header['{}{}_{}_{}'.format(c, p, i, j)] = (0.0, 'SIP coefficient')
+    header.add_history('Created by the solve-field stub (filabres benchmarks)')
+    header.add_comment('--Start of Astrometry.net WCS solution--')
+    header.add_comment('--End of Astrometry.net WCS--')
+    return header
+
+
+def catalogue_xy(wcs_header, naxis1, naxis2):
+    """Return X, Y, RA, DEC and magnitude of the Gaia objects within the image."""
+    from astropy.wcs import WCS
+    with fits.open('GaiaDRX-query.fits') as hdul_table:
+        gaia = hdul_table[1].data
+        ra = np.array(gaia.ra)
+        dec = np.array(gaia.dec)
+        mag = np.array(gaia.phot_g_mean_mag)
+    w = WCS(wcs_header, relax=True)
+    x, y = w.wcs_world2pix(ra, dec, 1)
+    inside = (x >= 1) & (x <= naxis1) & (y >= 1) & (y <= naxis2)
+    return x[inside], y[inside], ra[inside], dec[inside], mag[inside]
+
+
+def image2xy(args):
+    """Generate list of objects (local maxima above 5 sigma)."""
+    from scipy.ndimage import maximum_filter
+    with fits.open(args[-1]) as hdul:
+        data = hdul[0].data.astype(float)
+    background = np.median(data)
+    threshold = background + 5 * np.std(data)
+    iy, ix = np.nonzero((data == maximum_filter(data, size=3)) & (data > threshold))
+    fits.BinTableHDU.from_columns([
+        fits.Column(name='X', format='E', array=ix + 1),
+        fits.Column(name='Y', format='E', array=iy + 1),
+        fits.Column(name='FLUX', format='E', array=data[iy, ix] - background),
+        fits.Column(name='BACKGROUND', format='E', array=np.full(len(ix), background))
+    ]).writeto(getarg(args, '-o'), overwrite=True)
+
+
+def solve_field(args):
+    """Generate xxx.solved, xxx.wcs, xxx.new (image input), xxx.axy and xxx.corr."""
+    with open('index-image.fits') as f:
+        pvalue = f.read()
+    if pvalue in os.environ.get('FILABRES_STUB_UNSOLVED_P', '').split(','):
+        return
+    ra = float(getarg(args, '--ra'))
+    dec = float(getarg(args, '--dec'))
+    xylist = args[-1].endswith('.xyls')
+    if xylist:
+        naxis1 = int(getarg(args, '--width'))
+        naxis2 = int(getarg(args, '--height'))
+    else:
+        with fits.open('xxx.fits') as hdul:
+            image_header = hdul[0].header
+            naxis1 = image_header['NAXIS1']
+            naxis2 = image_header['NAXIS2']
+            data = hdul[0].data
+    wcs_header = stub_wcs_header(ra, dec, naxis1, naxis2)
+    x, y, ra, dec, mag = catalogue_xy(wcs_header, naxis1, naxis2)
+    flux = 10 ** (-0.4 * (mag - 22))
+
+    fits.PrimaryHDU(header=wcs_header).writeto('xxx.wcs', overwrite=True)
+    if xylist:
+        with fits.open(args[-1]) as hdul_table:
+            fits.BinTableHDU(hdul_table[1].data).writeto('xxx.axy', overwrite=True)
+    elif '--continue' not in args:
+        newheader = image_header.copy()
+        newheader.add_comment('--Put in by the new-wcs program--')
+        newheader.extend(wcs_header, update=True)
+        fits.PrimaryHDU(data, newheader).writeto('xxx.new', overwrite=True)
+        fits.BinTableHDU.from_columns([
+            fits.Column(name='X', format='E', array=x),
+            fits.Column(name='Y', format='E', array=y),
+            fits.Column(name='FLUX', format='E', array=flux)
+        ]).writeto('xxx.axy', overwrite=True)
+    fits.BinTableHDU.from_columns([
+        fits.Column(name='field_x', format='D', array=x),
+        fits.Column(name='field_y', format='D', array=y),
+        fits.Column(name='index_x', format='D', array=x),
+        fits.Column(name='index_y', format='D', array=y),
+        fits.Column(name='field_ra', format='D', array=ra),
+        fits.Column(name='field_dec', format='D', array=dec)
+    ]).writeto('xxx.corr', overwrite=True)
+    with open('xxx.solved', 'wb') as f:
+        f.write(b'\x01')
+
+
+def new_wcs(args):
+    """Insert the WCS of xxx.wcs in xxx.fits."""
+    with fits.open(getarg(args, '-i')) as hdul:
+        data = hdul[0].data
+        header = hdul[0].header.copy()
+    with fits.open(getarg(args, '-w')) as hdul:
+        header.add_comment('--Put in by the new-wcs program--')
+        header.extend(hdul[0].header, update=True)
+    fits.PrimaryHDU(data, header).writeto(getarg(args, '-o'), overwrite=True)
+
+
+def sex(args):
+    """Generate empty catalogue."""
+    with open(getarg(args, '-CATALOG_NAME'), 'wt') as f:
+        f.write('')
+
+
+def scamp(args):
+    """Generate xxx.head, full_1.cat and merged_1.cat (ASCII_HEAD or FITS_LDAC)."""
+    with fits.open('xxx.new') as hdul:
+        header = hdul[0].header
+        naxis1 = header['NAXIS1']
+        naxis2 = header['NAXIS2']
+    wcs_header = fits.Header()
+    for kwd in ['EQUINOX', 'CRVAL1', 'CRVAL2', 'CRPIX1', 'CRPIX2', 'CD1_1', 'CD1_2', 'CD2_1', 'CD2_2']:
+        wcs_header[kwd] = header[kwd]
+    wcs_header['CTYPE1'] = 'RA---TAN'
+    wcs_header['CTYPE2'] = 'DEC--TAN'
+    x, y, ra, dec, mag = catalogue_xy(wcs_header, naxis1, naxis2)
+
+    with open('xxx.head', 'wt') as f:
+        f.write('HISTORY   Astrometric solution by the scamp stub (filabres benchmarks)\n')
+        for kwd in ['EQUINOX', 'CRVAL1', 'CRVAL2', 'CRPIX1', 'CRPIX2', 'CD1_1', 'CD1_2', 'CD2_1', 'CD2_2']:
+            f.write('{:8s}= {:20.12E} / {}\n'.format(kwd, float(header[kwd]), 'WCS keyword'))
+        # distortion terms up to the polynomial degree (DISTORT_DEGREES)
+        maxindex = {1: 2, 2: 6, 3: 10}[int(getarg(args, '-DISTORT_DEGREES', 3))]
+        for axis in [1, 2]:
+            for i in range(maxindex + 1):
+                if i == 3:
+                    continue
+                kwd = 'PV{}_{}'.format(axis, i)
+                value = 1.0 if i == 1 else 0.0
+                f.write('{:8s}= {:20.12E} / {}\n'.format(kwd, value, 'Projection distortion parameter'))
+        f.write('END\n')
+
+    # output catalogue format (FULLOUTCAT_TYPE and MERGEDOUTCAT_TYPE)
+    cattype = dict()
+    with open(getarg(args, '-c')) as f:
+        for line in f:
+            items = line.split()
+            if len(items) > 1 and items[0] in ['FULLOUTCAT_TYPE', 'MERGEDOUTCAT_TYPE']:
+                cattype[items[0]] = items[1]
+
+    if cattype.get('FULLOUTCAT_TYPE') == 'FITS_LDAC':
+        write_ldac('full_1.cat', [('X_IMAGE', x), ('Y_IMAGE', y), ('CATALOG_NUMBER', np.ones(len(x)))])
+    else:
+        with open('full_1.cat', 'wt') as f:
+            f.write('#   1 X_IMAGE         Object position along x\n')
+            f.write('#   2 Y_IMAGE         Object position along y\n')
+            f.write('#   3 CATALOG_NUMBER  File index\n')
+            for xx, yy in zip(x, y):
+                f.write('{:12.4f} {:12.4f} 1\n'.format(xx, yy))
+    if cattype.get('MERGEDOUTCAT_TYPE') == 'FITS_LDAC':
+        write_ldac('merged_1.cat', [('ALPHA_J2000', ra), ('DELTA_J2000', dec)])
+    else:
+        with open('merged_1.cat', 'wt') as f:
+            f.write('#   1 ALPHA_J2000     Right ascension of barycenter (J2000)\n')
+            f.write('#   2 DELTA_J2000     Declination of barycenter (J2000)\n')
+            for rr, dd in zip(ra, dec):
+                f.write('{:14.8f} {:14.8f}\n'.format(rr, dd))
+
+
+def write_ldac(fname, columns):
+    """Write catalogue in FITS_LDAC format."""
+    imhead = fits.BinTableHDU.from_columns([
+        fits.Column(name='Field Header Card', format='80A', array=np.array(['END'.ljust(80)]))
+    ], name='LDAC_IMHEAD')
+    objects = fits.BinTableHDU.from_columns([fits.Column(name=name, format='D', array=array)
+                                             for name, array in columns], name='LDAC_OBJECTS')
+    fits.HDUList([fits.PrimaryHDU(), imhead, objects]).writeto(fname, overwrite=True)
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    tool = args[0]
+    if tool == 'build-astrometry-index':
+        with open(getarg(args, '-o'), 'wt') as f:
+            f.write(getarg(args, '-P'))
+    elif tool == 'image2xy':
+        image2xy(args)
+    elif tool == 'solve-field':
+        solve_field(args)
+    elif tool == 'new-wcs':
+        new_wcs(args)
+    elif tool == 'sex':
+        sex(args)
+    elif tool == 'scamp':
+        scamp(args)
+    else:
+        raise ValueError('Unexpected tool: {}'.format(tool))
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2020 Universidad Complutense de Madrid
+#
+# This file is part of filabres
+#
+# SPDX-License-Identifier: GPL-3.0+
+# License-Filename: LICENSE.txt
+#
+
+"""
+Generation of synthetic CAFOS/LSSS-like raw data.
+
+The generated nights contain bias frames, flatfields (with a circular
+vignetted field of view) and science frames with star fields. The stars
+of each science pointing are drawn from a synthetic Gaia-like catalogue
+that is also returned, so that the astrometric calibration can be
+exercised without network access.
+"""
+
+from astropy import units as u
+from astropy.coordinates import SkyCoord, FK5
+from astropy.io import fits
+from astropy.table import Table
+from astropy.time import Time
+from astropy.wcs import WCS
+import numpy as np
+import os
+
+# pixel scale (arcsec/pixel, without binning) and field of view (arcmin)
+# of each instrument
+PIXSCALE = {'cafos': 0.53, 'lsss': 3.5}
+FIELDOFVIEW_ARCMIN = {'cafos': 16, 'lsss': 120}
+
+BIAS_LEVEL = 600.0
+READOUT_NOISE = 5.0
+FLAT_LEVEL = 20000.0
+SKY_LEVEL = 300.0
+
+
+def tan_wcs(ra_deg, dec_deg, naxis1, naxis2, pixscale_arcsec):
+    """
+    Return TAN WCS centred on the image (North up, East left).
+
+    Parameters
+    ----------
+    ra_deg, dec_deg : float
+        Coordinates (J2000) of the image centre.
+    naxis1, naxis2 : int
+        Image dimensions.
+    pixscale_arcsec : float
+        Pixel scale (arcsec/pixel).
+
+    Returns
+    -------
+    w : astropy.wcs.WCS instance
+        World coordinate system.
+    """
+    w = WCS(naxis=2)
+    w.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    w.wcs.crval = [ra_deg, dec_deg]
+    w.wcs.crpix = [(naxis1 + 1) / 2, (naxis2 + 1) / 2]
+    w.wcs.cd = np.array([[-pixscale_arcsec / 3600, 0.0], [0.0, pixscale_arcsec / 3600]])
+    return w
+
+
+def synthetic_catalogue(ra_deg, dec_deg, radius_deg, nstars, rng, first_source_id=1):
+    """
+    Generate Gaia-like catalogue within a cone.
+
+    Parameters
+    ----------
+    ra_deg, dec_deg : float
+        Coordinates (J2000) of the cone centre.
+    radius_deg : float
+        Cone radius.
+    nstars : int
+        Number of stars.
+    rng : numpy.random.Generator instance
+        Random number generator.
+    first_source_id : int
+        SOURCE_ID of the first star.
+
+    Returns
+    -------
+    table : astropy.table.Table instance
+        Catalogue with the columns employed by filabres (sorted by
+        phot_g_mean_mag).
+    """
+    # uniform distribution within the cone (small angle approximation)
+    r = radius_deg * np.sqrt(rng.uniform(size=nstars))
+    theta = rng.uniform(0, 2 * np.pi, size=nstars)
+    dec = dec_deg + r * np.sin(theta)
+    ra = ra_deg + r * np.cos(theta) / np.cos(dec_deg * np.pi / 180)
+    # number counts increasing towards fainter magnitudes
+    mag = 21 - 9 * rng.uniform(size=nstars) ** 2
+    table = Table()
+    table['SOURCE_ID'] = np.arange(first_source_id, first_source_id + nstars, dtype=np.int64)
+    table['ref_epoch'] = np.full(nstars, 2016.0)
+    table['ra'] = ra % 360
+    table['dec'] = dec
+    table['pmra'] = rng.normal(0, 5, size=nstars)
+    table['pmdec'] = rng.normal(0, 5, size=nstars)
+    table['phot_g_mean_mag'] = mag
+    # stars without proper motion
+    table['pmra'][::10] = np.nan
+    table['pmdec'][::10] = np.nan
+    table.sort('phot_g_mean_mag')
+    return table
+
+
+def render_stars(image2d, x, y, flux, fwhm_pix):
+    """
+    Add Gaussian stars to image.
+
+    Parameters
+    ----------
+    image2d : numpy 2D array
+        Image to be modified.
+    x, y : numpy 1D arrays
+        Star coordinates (FITS criterium: first pixel is 1).
+    flux : numpy 1D array
+        Total flux of each star.
+    fwhm_pix : float
+        FWHM of the Gaussian profile (pixels).
+    """
+    naxis2, naxis1 = image2d.shape
+    sigma = fwhm_pix / 2.3548
+    halfsize = int(np.ceil(4 * sigma))
+    yy, xx = np.mgrid[-halfsize:halfsize + 1, -halfsize:halfsize + 1]
+    for xs, ys, fs in zip(x - 1, y - 1, flux):
+        ix, iy = int(round(xs)), int(round(ys))
+        if ix < -halfsize or ix >= naxis1 + halfsize or iy < -halfsize or iy >= naxis2 + halfsize:
+            continue
+        profile = np.exp(-((xx + ix - xs) ** 2 + (yy + iy - ys) ** 2) / (2 * sigma ** 2))
+        profile *= fs / (2 * np.pi * sigma ** 2)
+        i1, i2 = max(iy - halfsize, 0), min(iy + halfsize + 1, naxis2)
+        j1, j2 = max(ix - halfsize, 0), min(ix + halfsize + 1, naxis1)
+        image2d[i1:i2, j1:j2] += profile[(i1 - iy + halfsize):(i2 - iy + halfsize),
+                                         (j1 - ix + halfsize):(j2 - ix + halfsize)]
+
+
+def vignetting(naxis1, naxis2):
+    """Return flatfield pattern with a circular useful region."""
+    yy, xx = np.mgrid[0:naxis2, 0:naxis1]
+    rr = np.hypot(xx - naxis1 / 2, yy - naxis2 / 2) / (0.5 * min(naxis1, naxis2))
+    pattern = 1.0 - 0.1 * rr ** 2
+    pattern[rr > 0.95] = 0.05
+    return pattern
+
+
+def frame_header(instrument, imagetype, naxis1, naxis2, ra_deg, dec_deg, mjdobs, exptime, objname):
+    """
+    Return header mimicking the raw data of each instrument.
+
+    Parameters
+    ----------
+    instrument : str
+        'cafos' or 'lsss'.
+    imagetype : str
+        'bias', 'flat' or 'science'.
+    naxis1, naxis2 : int
+        Image dimensions.
+    ra_deg, dec_deg : float
+        Telescope pointing (J2000).
+    mjdobs : float
+        Modified Julian Date.
+    exptime : float
+        Exposure time (seconds).
+    objname : str
+        Target name.
+
+    Returns
+    -------
+    header : astropy.io.fits.Header instance
+        Image header.
+    """
+    tobs = Time(mjdobs, format='mjd')
+    dateobs = tobs.isot[:19]
+    # coordinates in the header are given for the equinox of the observation
+    c_fk5_dateobs = SkyCoord(ra=ra_deg * u.degree, dec=dec_deg * u.degree,
+                             frame='fk5', equinox='J2000').transform_to(FK5(equinox=Time(dateobs)))
+    header = fits.Header()
+    header['OBJECT'] = objname
+    header['DATE'] = dateobs
+    header['DATE-OBS'] = dateobs
+    header['EXPTIME'] = exptime
+    header['AIRMASS'] = 1.2
+    if instrument == 'cafos':
+        header['RA'] = c_fk5_dateobs.ra.deg
+        header['DEC'] = c_fk5_dateobs.dec.deg
+        header['EQUINOX'] = 2000.0
+        header['MJD-OBS'] = mjdobs
+        header['INSTRUME'] = 'CAFOS 2.2'
+        header['IMAGETYP'] = imagetype
+        header['CCDNAME'] = 'SITE#1d_15'
+        header['ORIGSECX'] = naxis1
+        header['ORIGSECY'] = naxis2
+        header['CCDSEC'] = '[1,1,{},{}]'.format(naxis1, naxis2)
+        header['BIASSEC'] = '[0,0,0,0]'
+        header['DATASEC'] = '[1,1,{},{}]'.format(naxis1, naxis2)
+        header['CCDBINX'] = 1
+        header['CCDBINY'] = 1
+        header['INSTRMOD'] = 'Imaging'
+        header['INSAPID'] = 'FREE'
+        header['INSTRSCL'] = PIXSCALE['cafos']
+        header['INSTRPIX'] = 24.0
+        header['INSTRPX0'] = 0
+        header['INSTRPY0'] = 0
+        header['INSFLID'] = '7'
+        header['INSFLNAM'] = 'R'
+        header['INSGRID'] = 'GRISM-11'
+        header['INSGRNAM'] = 'FREE'
+        header['INSGRROT'] = 0.0
+        header['INSGRWL0'] = 0.0
+        header['INSGRRES'] = 0.0
+        header['INSPOFPI'] = 'FREE'
+        header['INSPOROT'] = 0.0
+        header['INSFPZ'] = 0
+        header['INSFPWL'] = 0
+        header['INSFPDWL'] = 0
+        header['INSFPORD'] = 0
+        header['INSCALST'] = 'False'
+        header['INSCALID'] = 0
+        header['INSCALNM'] = 'NONE'
+    elif instrument == 'lsss':
+        ra_hms = c_fk5_dateobs.ra.hms
+        dec_dms = c_fk5_dateobs.dec.signed_dms
+        header['RA'] = '{:02d} {:02d} {:05.2f}'.format(int(ra_hms.h), int(ra_hms.m), ra_hms.s)
+        header['DEC'] = '{}{:02d} {:02d} {:04.1f}'.format('-' if dec_dms.sign < 0 else '+',
+                                                          int(dec_dms.d), int(dec_dms.m), dec_dms.s)
+        header['JD'] = mjdobs + 2400000.5
+        header['TELESCOP'] = 'LSSS'
+        header['INSTRUME'] = 'SBIG ST-10 3 CCD Camera'
+        header['IMAGETYP'] = {'bias': 'Dark Frame', 'flat': 'Flat Field', 'science': 'Light Frame'}[imagetype]
+        header['XORGSUBF'] = 0
+        header['YORGSUBF'] = 0
+        header['XBINNING'] = 1
+        header['YBINNING'] = 1
+        header['FLIPSTAT'] = ''
+        header['CLRBAND'] = 'C'
+    else:
+        raise ValueError('Unexpected instrument: {}'.format(instrument))
+    return header
+
+
+def generate_night(datadir, night, instrument='cafos', naxis1=512, naxis2=512,
+                   nbias=5, nflat=5, nscience=5, npointings=1, nstars=300,
+                   mjd0=57800.8, seed=1234):
+    """
+    Generate raw data of a synthetic observing night.
+
+    Parameters
+    ----------
+    datadir : str
+        Directory where the nights are stored.
+    night : str
+        Night label (name of the subdirectory within datadir).
+    instrument : str
+        'cafos' or 'lsss'.
+    naxis1, naxis2 : int
+        Image dimensions.
+    nbias, nflat, nscience : int
+        Number of bias, flat and science frames.
+    npointings : int
+        Number of different telescope pointings of the science frames
+        (dithered exposures are generated for each pointing).
+    nstars : int
+        Number of stars in the catalogue of each pointing.
+    mjd0 : float
+        Modified Julian Date of the first frame.
+    seed : int
+        Seed for the random number generator.
+
+    Returns
+    -------
+    catalogues : list of dict
+        For each pointing, a dictionary with the keys 'ra', 'dec'
+        (J2000), 'radius_deg' and 'table' (Gaia-like catalogue).
+    """
+    rng = np.random.default_rng(seed)
+    nightdir = os.path.join(datadir, night)
+    os.makedirs(nightdir, exist_ok=True)
+
+    pixscale = PIXSCALE[instrument]
+    # the catalogues cover the field of view of the dithered exposures
+    radius_deg = 1.5 * FIELDOFVIEW_ARCMIN[instrument] / 2 / 60
+    flatpattern = vignetting(naxis1, naxis2)
+
+    catalogues = []
+    for ipointing in range(npointings):
+        ra = rng.uniform(30, 330)
+        dec = rng.uniform(-10, 60)
+        table = synthetic_catalogue(ra, dec, radius_deg, nstars, rng, first_source_id=ipointing * nstars + 1)
+        catalogues.append({'ra': ra, 'dec': dec, 'radius_deg': radius_deg, 'table': table})
+
+    mjdobs = mjd0
+    iframe = 0
+    for imagetype, nframes in [('bias', nbias), ('flat', nflat), ('science', nscience)]:
+        for i in range(nframes):
+            iframe += 1
+            mjdobs += 30 / 86400
+            image2d = rng.normal(BIAS_LEVEL, READOUT_NOISE, size=(naxis2, naxis1))
+            ra, dec = 0.0, 0.0
+            objname = imagetype
+            exptime = 0.0
+            if imagetype == 'flat':
+                exptime = 2.0
+                image2d += FLAT_LEVEL * (1 + 0.05 * i) * flatpattern
+            elif imagetype == 'science':
+                exptime = 60.0
+                ipointing = i % npointings
+                catalogue = catalogues[ipointing]
+                # small dithering around the nominal pointing
+                offset = 5 / 3600 * (i // npointings)
+                ra = catalogue['ra'] + offset / np.cos(catalogue['dec'] * np.pi / 180)
+                dec = catalogue['dec'] + offset
+                objname = 'field{}'.format(ipointing + 1)
+                w = tan_wcs(ra, dec, naxis1, naxis2, pixscale)
+                table = catalogue['table']
+                x, y = w.all_world2pix(table['ra'], table['dec'], 1)
+                flux = 10 ** (-0.4 * (table['phot_g_mean_mag'] - 22)) * exptime
+                signal = np.full((naxis2, naxis1), SKY_LEVEL)
+                render_stars(signal, x, y, flux, fwhm_pix=2.0 / pixscale * PIXSCALE['cafos'] * 2)
+                image2d += signal * flatpattern
+            image2d = np.clip(image2d, 0, 65535).astype(np.uint16)
+            header = frame_header(instrument, imagetype, naxis1, naxis2, ra, dec, mjdobs, exptime, objname)
+            fname = os.path.join(nightdir, '{}-{:04d}-{}.fits'.format(night, iframe, imagetype))
+            hdu = fits.PrimaryHDU(image2d, header)
+            hdu.writeto(fname, overwrite=True)
+
+    return catalogues
@@ -29,13 +29,14 @@ def check_args_compatibility(args, debug=False):
     # create a list for each group
     arglist_setup = ['setup']
     arglist_check = ['check']
-    arglist_reduc = ['reduction_step', 'force', 'no_astrometry', 'no_reuse_gaia',
+    arglist_reduc = ['reduction_step', 'force', 'force_if_changed', 'no_astrometry', 'no_reuse_gaia',
+                     'prefetch_gaia', 'pvalue_trials', 'astrometry_plots', 'supermaster', 'maxmem_mb',
                      'interactive', 'filename']
-    arglist_delet = ['delete']
-    arglist_lists = ['list_classified', 'list_reduced', 'originf', 'list_mode',
+    arglist_delet = ['delete', 'delete_dependants']
+    arglist_lists = ['list_classified', 'list_reduced', 'originf', 'list_dependants', 'list_mode',
                      'keyword', 'keyword_sort', 'filter', 'plotxy', 'plotimage',
                      'ndecimal']
-    arglist_other = ['night', 'setup', 'verbose', 'debug']
+    arglist_other = ['night', 'setup', 'verbose', 'debug', 'profile']
 
     # concatenate the above lists
     total_arglist = arglist_setup + arglist_check + arglist_reduc + \
@@ -21,6 +21,8 @@ import warnings
 from .check_image_classification import ImageClassification
 from .check_image_corrections import ImageCorrections
 from .check_image_ignore import ImageIgnore
+from .instrumentation import span_begin
+from .instrumentation import span_end
 from .progressbar import progressbar
 from .statsumm import statsumm
 from .version import version
@@ -226,6 +228,7 @@ def classify_images(list_of_nights, instconf, setupdata, force, verbose=False):
             print('File {} already exists: skipping directory.'.format(jsonfname))
 
         if execute_night:
+            span_begin(night, 'night')
             # get list of FITS files for current night
             fnames = datadir + night + '/*.fits'
             list_of_fits = glob.glob(fnames)
@@ -419,3 +422,4 @@ def classify_images(list_of_nights, instconf, setupdata, force, verbose=False):
 
             # close logfile
             logfile.close()
+            span_end(night, 'night')
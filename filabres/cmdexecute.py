@@ -8,69 +8,255 @@
 # License-Filename: LICENSE.txt
 #
 
+"""
+Execution of external commands (astrometric tools).
+
+The commands are executed as asyncio subprocesses. Their output is
+stored in the log file line by line while the command is running, the
+elapsed time of each tool is limited (see TOOL_TIMEOUTS), and the number
+of commands simultaneously executed by the whole program (including
+those launched from different threads) is limited by a global
+semaphore (see configure()).
+"""
+
+import asyncio
+import os
 import re
-import subprocess
+import signal
+import threading
+
+from .instrumentation import span
+
+# maximum elapsed time (seconds) of each external tool (None: no limit)
+TOOL_TIMEOUTS = {
+    'build-astrometry-index': 900,
+    'solve-field': 900,
+    'new-wcs': 300,
+    'sex': 900,
+    'scamp': 900,
+}
+
+# default maximum number of simultaneous external commands
+DEFAULT_MAX_CONCURRENT = os.cpu_count() or 1
+
+# regex to filter out ANSI escape sequences
+ANSI_ESCAPE = re.compile(r'\x1b('
+                         r'(\[\??\d+[hl])|'
+                         r'([=<>a-kzNM78])|'
+                         r'([\(\)][a-b0-2])|'
+                         r'(\[\d{0,2}[ma-dgkjqi])|'
+                         r'(\[\d+;\d+[hfy]?)|'
+                         r'(\[;?[hf])|'
+                         r'(#[3-68])|'
+                         r'([01356]n)|'
+                         r'(O[mlnp-z]?)|'
+                         r'(/Z)|'
+                         r'(\d+)|'
+                         r'(\[\?\d;\d0c)|'
+                         r'(\d;\dR))', flags=re.IGNORECASE)
+
+_SEMAPHORE = threading.BoundedSemaphore(DEFAULT_MAX_CONCURRENT)
+# interval (seconds) between attempts to acquire the global semaphore
+SEMAPHORE_POLL = 0.05
+
+
+def configure(timeouts=None, max_concurrent=None):
+    """
+    Modify the limits applied to the execution of external commands.
+
+    Parameters
+    ----------
+    timeouts : dict or None
+        Maximum elapsed time (seconds) of particular tools (tool
+        name as key). A value of None removes the limit.
+    max_concurrent : int or None
+        Maximum number of simultaneous external commands.
+    """
+    global _SEMAPHORE
+    if timeouts is not None:
+        TOOL_TIMEOUTS.update(timeouts)
+    if max_concurrent is not None:
+        if max_concurrent < 1:
+            msg = 'Invalid maximum number of simultaneous commands: {}'.format(max_concurrent)
+            raise SystemError(msg)
+        _SEMAPHORE = threading.BoundedSemaphore(max_concurrent)
+
+
+def _kill(proc):
+    """Kill process (and the processes it has launched)."""
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (AttributeError, OSError):
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
 
 
 class CmdExecute(object):
-    def __init__(self, logfile=None):
+    """
+    Execute external commands.
+
+    Parameters
+    ----------
+    logfile : instance of ToLogFile or None
+        Log file to store the command output. If None, the output
+        is displayed.
+    cancel : instance of threading.Event or None
+        When this event is set, the running commands are killed and
+        subsequent commands are not executed.
+    """
+    def __init__(self, logfile=None, cancel=None):
         self.logfile = logfile
+        self.cancel = cancel
 
-    def run(self, command, cwd=None):
-        # define regex to filter out ANSI escape sequences
-        ansi_regex = r'\x1b(' \
-                     r'(\[\??\d+[hl])|' \
-                     r'([=<>a-kzNM78])|' \
-                     r'([\(\)][a-b0-2])|' \
-                     r'(\[\d{0,2}[ma-dgkjqi])|' \
-                     r'(\[\d+;\d+[hfy]?)|' \
-                     r'(\[;?[hf])|' \
-                     r'(#[3-68])|' \
-                     r'([01356]n)|' \
-                     r'(O[mlnp-z]?)|' \
-                     r'(/Z)|' \
-                     r'(\d+)|' \
-                     r'(\[\?\d;\d0c)|' \
-                     r'(\d;\dR))'
-        ansi_escape = re.compile(ansi_regex, flags=re.IGNORECASE)
-
-        # display working directory
-        if cwd is not None:
-            msg = '[Working in {}]'.format(cwd)
-            if self.logfile is None:
-                print(msg)
-            else:
-                self.logfile.print(msg)
-
-        # display command line
-        msg = '$ {}'.format(command)
+    def print(self, msg):
         if self.logfile is None:
             print(msg)
         else:
             self.logfile.print(msg)
 
-        # execute command line
-        p = subprocess.Popen(command.split(), cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        p.wait()
-        pout = p.stdout.read().decode('utf-8')
-        perr = p.stderr.read().decode('utf-8')
-        p.stdout.close()
-        p.stderr.close()
-        if pout != '':
-            if command[:4] == 'sex ':
-                msg = ansi_escape.sub('', str(pout))
-            else:
-                msg = pout
-            if self.logfile is None:
-                print(msg)
-            else:
-                self.logfile.print(msg)
-        if perr != '':
-            if command[:4] == 'sex ':
-                msg = ansi_escape.sub('', str(perr))
-            else:
-                msg = perr
-            if self.logfile is None:
-                print(msg)
-            else:
-                self.logfile.print(msg)
+    def cancelled(self):
+        return self.cancel is not None and self.cancel.is_set()
+
+    async def _stream(self, reader, filter_ansi):
+        """Store output lines while the command is running."""
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            line = line.decode('utf-8', errors='replace').rstrip('\n')
+            if filter_ansi:
+                line = ANSI_ESCAPE.sub('', line)
+            self.print(line)
+
+    async def _wait_cancel(self):
+        while not self.cancel.is_set():
+            await asyncio.sleep(0.1)
+
+    async def _acquire(self, semaphore):
+        """
+        Wait for a free slot of the global semaphore.
+
+        The semaphore is polled (instead of blocking a thread of the
+        executor), so that a task cancelled while waiting never holds
+        a slot.
+
+        Returns
+        -------
+        acquired : bool
+            False if the execution has been cancelled while waiting.
+        """
+        while not semaphore.acquire(blocking=False):
+            if self.cancelled():
+                return False
+            await asyncio.sleep(SEMAPHORE_POLL)
+        return True
+
+    async def run_async(self, command, cwd=None, timeout=None):
+        """
+        Execute command (coroutine).
+
+        Parameters
+        ----------
+        command : str
+            Command line.
+        cwd : str or None
+            Working directory.
+        timeout : float or None
+            Maximum elapsed time (seconds). If None, the value given
+            in TOOL_TIMEOUTS for the corresponding tool is employed.
+
+        Returns
+        -------
+        returncode : int or None
+            Exit status of the command. None if the command has been
+            killed (timeout or cancellation) or not executed.
+        """
+        if self.cancelled():
+            return None
+
+        tool = command.split()[0]
+        if timeout is None:
+            timeout = TOOL_TIMEOUTS.get(tool)
+
+        # wait for the global limit of simultaneous commands
+        semaphore = _SEMAPHORE
+        if not await self._acquire(semaphore):
+            return None
+        try:
+            if self.cancelled():
+                return None
+
+            # display working directory and command line
+            if cwd is not None:
+                self.print('[Working in {}]'.format(cwd))
+            self.print('$ {}'.format(command))
+
+            with span(tool, 'subprocess', command=command, cwd=cwd):
+                proc = await asyncio.create_subprocess_exec(*command.split(), cwd=cwd,
+                                                            stdout=asyncio.subprocess.PIPE,
+                                                            stderr=asyncio.subprocess.PIPE,
+                                                            start_new_session=True)
+                filter_ansi = tool == 'sex'
+                execution = asyncio.ensure_future(asyncio.gather(self._stream(proc.stdout, filter_ansi),
+                                                                 self._stream(proc.stderr, filter_ansi),
+                                                                 proc.wait()))
+                waiting = [execution]
+                if self.cancel is not None:
+                    waiting.append(asyncio.ensure_future(self._wait_cancel()))
+                done, pending = await asyncio.wait(waiting, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in waiting[1:]:
+                    task.cancel()
+                if execution in done:
+                    execution.result()
+                    return proc.returncode
+
+                # timeout or cancellation: kill the process and collect the remaining output
+                _kill(proc)
+                try:
+                    await asyncio.wait_for(execution, timeout=10)
+                except asyncio.TimeoutError:
+                    pass
+                if self.cancelled():
+                    self.print('WARNING: command cancelled: {}'.format(command))
+                else:
+                    self.print('ERROR: command killed after {} seconds: {}'.format(timeout, command))
+                return None
+        finally:
+            semaphore.release()
+
+    def run(self, command, cwd=None, timeout=None):
+        """
+        Execute command.
+
+        See run_async() for a description of the parameters and the
+        returned value.
+        """
+        return asyncio.run(self.run_async(command, cwd=cwd, timeout=timeout))
+
+    def run_many(self, commands, cwd=None, timeout=None):
+        """
+        Execute several commands simultaneously.
+
+        The number of simultaneous commands is limited by the global
+        limit (see configure()).
+
+        Parameters
+        ----------
+        commands : list of str
+            Command lines.
+        cwd : str or None
+            Working directory.
+        timeout : float or None
+            Maximum elapsed time (seconds) of each command.
+
+        Returns
+        -------
+        returncodes : list
+            Exit status of each command (see run_async()).
+        """
+        async def run_all():
+            return await asyncio.gather(*[self.run_async(command, cwd=cwd, timeout=timeout)
+                                          for command in commands])
+        return asyncio.run(run_all())
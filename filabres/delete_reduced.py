@@ -12,10 +12,12 @@ import glob
 import json
 import os
 
+from .dependants import DependantsIndex
+from .journal import load_database
 from .load_instrument_configuration import load_instrument_configuration
 
 
-def delete_reduced(setupdata, reducedima):
+def delete_reduced(setupdata, reducedima, delete_dependants=False, handled=None):
     """Delete calibration: actual file and database reference
 
     Parameters
@@ -24,6 +26,13 @@ def delete_reduced(setupdata, reducedima):
         Setup data stored as a Python dictionary.
     reducedima : str
         Full path and file name of the reduced calibration image.
+    delete_dependants : bool
+        If True, the reduced images that depend on the deleted image
+        (see DependantsIndex) are also deleted, in order to reduce them
+        again with the remaining master calibrations.
+    handled : set or None
+        Reduced images already deleted (or being deleted) when deleting
+        the dependants recursively.
     """
 
     instrument = setupdata['instrument']
@@ -59,8 +68,8 @@ def delete_reduced(setupdata, reducedima):
         # look for the expected results database
         databasefile = 'filabres_db_{}_{}.json'.format(instrument, imagetype)
         try:
-            with open(databasefile) as jfile:
-                database = json.load(jfile)
+            # the updated database is saved below (removing the journal)
+            database = load_database(databasefile, imagetype, checkpoint=True)
         except FileNotFoundError:
             msg = 'ERROR: expected database file {} not found'.format(databasefile)
             print(msg)
@@ -166,3 +175,27 @@ def delete_reduced(setupdata, reducedima):
             print('-> Removing subdirectory: {}'.format(subdir))
         except:
             print("ERROR while deleting subdirectory: {}".format(subdir))
+
+    # reduced images depending on the deleted image
+    depindex = DependantsIndex(instrument)
+    depindex.remove_product(reducedima)
+    if handled is None:
+        handled = set()
+    handled.add(reducedima)
+    if delete_dependants:
+        # the indirect dependants are deleted through the direct ones,
+        # skipping the images already handled
+        products = [product for product in depindex.dependants(reducedima, recursive=False)
+                    if product not in handled and os.path.exists(product)]
+        if len(products) > 0:
+            print('-> Deleting {} dependant images of {}'.format(len(products), reducedima))
+            handled.update(products)
+            for product in products:
+                delete_reduced(setupdata, product, delete_dependants=True, handled=handled)
+    else:
+        products = [product for product in depindex.dependants(reducedima) if os.path.exists(product)]
+        if len(products) > 0:
+            print('WARNING: {} reduced images depend on {}'.format(len(products), reducedima))
+            for product in products:
+                print(' - {}'.format(product))
+            print('Use --delete_dependants to delete them or --force_if_changed to reduce them again.')
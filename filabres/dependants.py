@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2020 Universidad Complutense de Madrid
+#
+# This file is part of filabres
+#
+# SPDX-License-Identifier: GPL-3.0+
+# License-Filename: LICENSE.txt
+#
+
+"""
+Reverse index from master calibrations to the reduced images using them.
+
+The results databases store the master calibrations employed to reduce
+each image (bias_fname, flat_fname), but finding the images that depend
+on a particular master would require reading the databases of every
+night. This index allows to list the dependants of a master calibration
+(including indirect dependants: e.g. science images reduced with a
+master flat that was generated using a given master bias) and to delete
+them when the master calibration is deleted.
+
+The index is stored with the calibration databases as an append-only
+file (filabres_dependants_<instrument>.jsonl, one JSON record per line
+with a reduced image and the master calibrations employed), so that
+registering a new reduced image does not require rewriting the whole
+file. The file is rewritten (removing the obsolete records) when it is
+loaded and most of its records are obsolete. The file
+filabres_dependants_<instrument>.json generated by previous versions of
+filabres is converted into the new format.
+"""
+
+import json
+import os
+
+
+def dependants_fname(instrument):
+    """Return file name of the reverse index."""
+    return 'filabres_dependants_{}.jsonl'.format(instrument)
+
+
+class DependantsIndex(object):
+    """
+    Reduced images depending on each master calibration.
+
+    Parameters
+    ----------
+    instrument : str
+        Instrument name.
+    """
+    def __init__(self, instrument):
+        self.fname = dependants_fname(instrument)
+        # master calibrations employed by each reduced image
+        self.masters = dict()
+        # reduced images depending on each master calibration (the
+        # dictionary values are None: employed as ordered sets)
+        self.index = dict()
+        self.legacyfname = os.path.splitext(self.fname)[0] + '.json'
+        if os.path.exists(self.legacyfname):
+            with open(self.legacyfname) as jfile:
+                for master, products in json.load(jfile).items():
+                    for product in products:
+                        self._update(product, self.masters.get(product, []) + [master])
+        nrecords = 0
+        if os.path.exists(self.fname):
+            with open(self.fname) as jfile:
+                for line in jfile:
+                    # ignore an incomplete last line (interrupted execution)
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self._update(record['product'], record['masters'])
+                    nrecords += 1
+        if os.path.exists(self.legacyfname) or nrecords > 2 * len(self.masters) + 100:
+            self.compact()
+
+    def _update(self, product, masters):
+        for master in self.masters.pop(product, []):
+            del self.index[master][product]
+            if len(self.index[master]) == 0:
+                del self.index[master]
+        if len(masters) > 0:
+            self.masters[product] = masters
+            for master in masters:
+                self.index.setdefault(master, dict())[product] = None
+
+    def _append(self, product, masters):
+        with open(self.fname, 'a') as outfile:
+            outfile.write(json.dumps({'product': product, 'masters': masters}) + '\n')
+        self._update(product, masters)
+
+    def compact(self):
+        """Rewrite the index file removing the obsolete records."""
+        with open(self.fname + '.tmp', 'w') as outfile:
+            for product, masters in self.masters.items():
+                outfile.write(json.dumps({'product': product, 'masters': masters}) + '\n')
+        os.replace(self.fname + '.tmp', self.fname)
+        # the previous contents of the legacy file are now included
+        if os.path.exists(self.legacyfname):
+            os.remove(self.legacyfname)
+
+    def remove_product(self, product):
+        """Remove a reduced image from the lists of dependants."""
+        if product in self.masters:
+            self._append(product, [])
+
+    def register(self, product, masters):
+        """
+        Register the master calibrations employed to reduce an image.
+
+        Parameters
+        ----------
+        product : str
+            Reduced image.
+        masters : list of str
+            Master calibrations employed. Values that do not correspond
+            to existing files (e.g. None or the description of a dummy
+            calibration) are ignored.
+        """
+        # the image may have been previously reduced with other masters
+        masters = [master for master in masters if master is not None and os.path.isfile(master)]
+        if len(masters) > 0 or product in self.masters:
+            self._append(product, masters)
+
+    def dependants(self, master, recursive=True):
+        """
+        Return the reduced images depending on a master calibration.
+
+        Parameters
+        ----------
+        master : str
+            Master calibration.
+        recursive : bool
+            If True, the dependants of the dependants (e.g. science
+            images reduced with a master flat which depends on the
+            given master bias) are also included.
+
+        Returns
+        -------
+        products : list of str
+            Reduced images (direct dependants first).
+        """
+        products = list(self.index.get(master, []))
+        if recursive:
+            found = set(products)
+            i = 0
+            while i < len(products):
+                for product in self.index.get(products[i], []):
+                    if product not in found:
+                        found.add(product)
+                        products.append(product)
+                i += 1
+        return products
+
+    def warn_outdated(self, master, logfile):
+        """
+        Display the reduced images that depend on a master calibration
+        that has been recomputed or deleted.
+
+        Parameters
+        ----------
+        master : str
+            Master calibration.
+        logfile : ToLogFile instance
+            Log file.
+        """
+        products = self.dependants(master)
+        if len(products) > 0:
+            logfile.print('WARNING: {} reduced images depend on the previous version of {}'.format(
+                len(products), master), f=True)
+            for product in products:
+                logfile.print(' - {}'.format(product), f=True)
+            logfile.print('Use --force_if_changed to reduce them again.', f=True)
+
+
+def list_dependants(setupdata, master):
+    """
+    Display the reduced images depending on a master calibration.
+
+    Parameters
+    ----------
+    setupdata : dict
+        Setup data stored as a Python dictionary.
+    master : str
+        Full path and file name of the master calibration.
+    """
+    depindex = DependantsIndex(setupdata['instrument'])
+    direct = depindex.dependants(master, recursive=False)
+    products = depindex.dependants(master)
+    print('Number of images depending on {}: {}'.format(master, len(products)))
+    for product in products:
+        if product in direct:
+            print(' - {}'.format(product))
+        else:
+            print(' - {}  (indirect)'.format(product))
@@ -31,20 +31,15 @@ from datetime import datetime
 import sys
 
 from .check_args_compatibility import check_args_compatibility
-from .check_datadir import check_datadir
-from .delete_reduced import delete_reduced
-from .generate_setup import generate_setup
-from .classify_images import classify_images
-from .list_classified import list_classified
-from .list_originf import list_originf
-from .list_reduced import list_reduced
-from .load_instrument_configuration import load_instrument_configuration
+from .cmdexecute import configure as configure_cmdexecute
 from .load_setup import load_setup
-from .nights_to_be_reduced import nights_to_be_reduced
-from .run_calibration_step import run_calibration_step
-from .run_reduction_step import run_reduction_step
 from .version import version
 
+# note: the modules implementing each subcommand are imported only when
+# that subcommand is executed; this avoids loading heavy dependencies
+# (pandas, matplotlib, scipy, astroquery,...) in commands that do not
+# need them (e.g. --setup, --check or -lr/-lc with -lm basic)
+
 
 def main():
 
@@ -77,11 +72,32 @@ def main():
     # group_reduc
     group_reduc.add_argument("-rs", "--reduction_step", type=str, nargs='?', const="None")
     group_reduc.add_argument("-f", "--force", action="store_true", help="force reduction of already reduced files")
+    group_reduc.add_argument("-fc", "--force_if_changed", action="store_true",
+                             help="force reduction of already reduced files whose inputs (original files, master "
+                                  "calibrations, instrument configuration or setup) have changed")
     group_reduc.add_argument("-na", "--no_astrometry", action="store_true",
                              help="do not perform astrometry calibration")
     group_reduc.add_argument("-ng", "--no_reuse_gaia", action="store_true",
                              help="do not reuse pevious GAIA data to perform the initial astrometric calibration"
                                   " (with Astrometry.net tools)")
+    group_reduc.add_argument("-pg", "--prefetch_gaia", type=int, nargs='?', const=4,
+                             help="retrieve in advance the GAIA data of all the selected nights, performing "
+                                  "NQUERIES simultaneous queries (default 4)",
+                             metavar='NQUERIES')
+    group_reduc.add_argument("-pt", "--pvalue_trials", type=int,
+                             help="number of P values (index scale numbers) tried simultaneously when solving "
+                                  "the field with Astrometry.net",
+                             metavar='NTRIALS')
+    group_reduc.add_argument("-ap", "--astrometry_plots", type=str, choices=['now', 'background', 'none'],
+                             help="generation of the PDF files with plots of the astrometric calibration: "
+                                  "immediately (now, default), in background processes, or none (they can be "
+                                  "generated later with filabres-replot_astrometry)")
+    group_reduc.add_argument("-sm", "--supermaster", action="store_true",
+                             help="combine the calibration images of all the selected nights into a single "
+                                  "master calibration for each signature (only valid for bias and flat-imaging)")
+    group_reduc.add_argument("--maxmem_mb", type=float,
+                             help="memory ceiling (Mb) for the combination of images when using --supermaster",
+                             metavar='MEGABYTES')
     group_reduc.add_argument("-i", "--interactive", action="store_true", help="enable interactive execution")
     group_reduc.add_argument("--filename", type=str,
                              help="particular image to be reduced (only valid for science images; without path)")
@@ -89,6 +105,8 @@ def main():
     # group_delet
     group_delet.add_argument("--delete", type=str, help="delete reduced image",
                              metavar='REDUCED_IMAGE')
+    group_delet.add_argument("-dd", "--delete_dependants", action="store_true",
+                             help="delete also the reduced images depending on the deleted image")
 
     # group_lists
     group_lists.add_argument("-lc", "--list_classified", type=str, nargs='?', const="None",
@@ -99,6 +117,9 @@ def main():
                              metavar='REDUCTION_STEP')
     group_lists.add_argument("-of", "--originf", type=str, help="list original individual images employed to "
                                                                 "generate a particular reduced calibration image")
+    group_lists.add_argument("-ld", "--list_dependants", type=str, help="list reduced images depending on "
+                                                                        "a particular reduced calibration image",
+                             metavar='REDUCED_IMAGE')
     group_lists.add_argument("-lm", "--list_mode", type=str, help="display mode for list of files",
                              choices=["long", "singleline", "basic"], metavar='MODE')
     group_lists.add_argument("-k", "--keyword", type=str, action='append', nargs=1,
@@ -118,6 +139,10 @@ def main():
     group_other.add_argument("-v", "--verbose", action="store_true",
                              help="display intermediate information while running")
     group_other.add_argument("--debug", action="store_true", help="display debugging information")
+    group_other.add_argument("--profile", type=str,
+                             help="save trace of the execution (Chrome trace-event format; JSON lines if the "
+                                  "file name ends in .jsonl)",
+                             metavar='FILE')
 
     args = parser.parse_args()
 
@@ -127,6 +152,10 @@ def main():
         parser.print_usage()
         raise SystemExit()
 
+    if args.profile is not None:
+        from .instrumentation import start_profile
+        start_profile(args.profile)
+
     # ---
 
     execution_command = ''
@@ -150,22 +179,31 @@ def main():
 
     # generate setup_filabres.yaml if required
     if args.setup is not None:
+        from .generate_setup import generate_setup
         generate_setup(args.setup)
         print('* program STOP')
         raise SystemExit()
 
     # load setup file
     setupdata = load_setup(args.verbose)
+    configure_cmdexecute(timeouts=setupdata.get('tool_timeouts'),
+                         max_concurrent=setupdata.get('max_concurrent_commands'))
 
     # delete reduced image
+    if args.delete_dependants and args.delete is None:
+        msg = 'Argument --delete_dependants requires --delete'
+        raise SystemError(msg)
     if args.delete is not None:
+        from .delete_reduced import delete_reduced
         delete_reduced(setupdata=setupdata,
-                       reducedima=args.delete)
+                       reducedima=args.delete,
+                       delete_dependants=args.delete_dependants)
         print('* program STOP')
         raise SystemExit()
 
     # initial image check
     if args.check:
+        from .check_datadir import check_datadir
         check_datadir(setupdata, args.verbose)
         print('* program STOP')
         raise SystemExit()
@@ -175,6 +213,7 @@ def main():
         if args.list_reduced is not None or args.originf is not None:
             print("-lc is incompatible with either -lr or -of")
             raise SystemExit()
+        from .list_classified import list_classified
         list_classified(setupdata=setupdata,
                         img=args.list_classified,
                         list_mode=args.list_mode,
@@ -192,6 +231,7 @@ def main():
         if args.list_classified is not None or args.originf is not None:
             print("-lr is incompatible with either -lc or -of")
             raise SystemExit()
+        from .list_reduced import list_reduced
         list_reduced(setupdata=setupdata,
                      img=args.list_reduced,
                      list_mode=args.list_mode,
@@ -208,6 +248,7 @@ def main():
         if args.list_classified is not None or args.list_reduced is not None:
             print("-of is incompatible with either -lc or -lr")
             raise SystemExit()
+        from .list_originf import list_originf
         list_originf(setupdata=setupdata,
                      args_originf=args.originf,
                      list_mode=args.list_mode,
@@ -219,7 +260,15 @@ def main():
                      args_ndecimal=args.ndecimal)
         raise SystemExit()
 
+    # list of reduced images depending on a reduced calibration
+    if args.list_dependants is not None:
+        from .dependants import list_dependants
+        list_dependants(setupdata=setupdata,
+                        master=args.list_dependants)
+        raise SystemExit()
+
     # load instrument configuration
+    from .load_instrument_configuration import load_instrument_configuration
     instconf = load_instrument_configuration(
         setupdata=setupdata,
         redustep=args.reduction_step,
@@ -228,6 +277,7 @@ def main():
     )
 
     # nights to be reduced
+    from .nights_to_be_reduced import nights_to_be_reduced
     list_of_nights = nights_to_be_reduced(args_night=args.night,
                                           setupdata=setupdata,
                                           verbose=args.verbose)
@@ -241,7 +291,17 @@ def main():
         if args.no_reuse_gaia or args.no_astrometry:
             msg = 'Argument --no_reuse_gaia / --no_astrometry are invalid for --rs initialize'
             raise SystemError(msg)
+        if args.prefetch_gaia is not None or args.pvalue_trials is not None or args.astrometry_plots is not None:
+            msg = 'Argument --prefetch_gaia / --pvalue_trials / --astrometry_plots are invalid for --rs initialize'
+            raise SystemError(msg)
+        if args.force_if_changed:
+            msg = 'Argument --force_if_changed is invalid for --rs initialize'
+            raise SystemError(msg)
+        if args.supermaster or args.maxmem_mb is not None:
+            msg = 'Argument --supermaster / --maxmem_mb are invalid for --rs initialize'
+            raise SystemError(msg)
         # initialize auxiliary databases (one for each observing night)
+        from .classify_images import classify_images
         classify_images(list_of_nights=list_of_nights,
                         instconf=instconf,
                         setupdata=setupdata,
@@ -257,16 +317,42 @@ def main():
             if args.no_reuse_gaia or args.no_astrometry:
                 msg = 'Argument --no_reuse_gaia / --no_astrometry are invalid for calibration reduction steps'
                 raise SystemError(msg)
+            if args.prefetch_gaia is not None or args.pvalue_trials is not None or \
+                    args.astrometry_plots is not None:
+                msg = 'Argument --prefetch_gaia / --pvalue_trials / --astrometry_plots are invalid for ' \
+                      'calibration reduction steps'
+                raise SystemError(msg)
+            if args.maxmem_mb is not None and not args.supermaster:
+                msg = 'Argument --maxmem_mb requires --supermaster'
+                raise SystemError(msg)
             # execute reduction step
-            run_calibration_step(redustep=args.reduction_step,
-                                 setupdata=setupdata,
-                                 list_of_nights=list_of_nights,
-                                 instconf=instconf,
-                                 force=args.force,
-                                 verbose=args.verbose,
-                                 debug=args.debug)
+            if args.supermaster:
+                from .supermaster import run_supermaster_step
+                run_supermaster_step(redustep=args.reduction_step,
+                                     setupdata=setupdata,
+                                     list_of_nights=list_of_nights,
+                                     instconf=instconf,
+                                     force=args.force,
+                                     force_if_changed=args.force_if_changed,
+                                     maxmem_mb=args.maxmem_mb,
+                                     verbose=args.verbose,
+                                     debug=args.debug)
+            else:
+                from .run_calibration_step import run_calibration_step
+                run_calibration_step(redustep=args.reduction_step,
+                                     setupdata=setupdata,
+                                     list_of_nights=list_of_nights,
+                                     instconf=instconf,
+                                     force=args.force,
+                                     force_if_changed=args.force_if_changed,
+                                     verbose=args.verbose,
+                                     debug=args.debug)
         elif classification == 'science':
+            if args.supermaster or args.maxmem_mb is not None:
+                msg = 'Argument --supermaster / --maxmem_mb are invalid for science reduction steps'
+                raise SystemError(msg)
             # execute reduction step
+            from .run_reduction_step import run_reduction_step
             run_reduction_step(redustep=args.reduction_step,
                                interactive=args.interactive,
                                setupdata=setupdata,
@@ -276,6 +362,10 @@ def main():
                                no_reuse_gaia=args.no_reuse_gaia,
                                instconf=instconf,
                                force=args.force,
+                               prefetch_gaia=args.prefetch_gaia,
+                               pvalue_trials=args.pvalue_trials,
+                               astrometry_plots=args.astrometry_plots,
+                               force_if_changed=args.force_if_changed,
                                verbose=args.verbose,
                                debug=args.debug)
         else:
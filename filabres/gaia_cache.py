@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2020 Universidad Complutense de Madrid
+#
+# This file is part of filabres
+#
+# SPDX-License-Identifier: GPL-3.0+
+# License-Filename: LICENSE.txt
+#
+
+"""
+Global on-disk cache of Gaia data shared by all the observing nights.
+
+The sky is partitioned in tiles (see skytiles.py). The cache stores, for
+each tile, all the Gaia sources brighter than a limiting magnitude for
+which the tile is known to be complete. A cone search can be answered
+from the cache when all the tiles overlapping the cone are complete down
+to the requested magnitude (or when they already contain the maximum
+number of sources to be returned; see GaiaCache.lookup()).
+
+The tiles are grouped in FITS files (one file for each group of
+neighbouring tiles), which are the units of the least-recently-used
+eviction applied when the cache exceeds its size budget. The
+completeness limit of each tile and the access time of each file are
+stored in the JSON file cache_index.json.
+"""
+
+from contextlib import contextmanager
+import json
+import os
+import time
+
+import numpy as np
+
+from .local_gaia import is_local_source
+from .skytiles import SkyTiling
+from .skytiles import angular_distance_deg
+
+try:
+    import fcntl
+except ImportError:  # not available in Windows
+    fcntl = None
+
+# approximate size of the sky tiles (degrees)
+TILE_DEG = 1 / 16
+# number of consecutive tiles (in right ascension) stored in the same file
+TILES_PER_FILE = 16
+# default size budget (MB)
+DEFAULT_SIZE_MB = 1024
+
+
+class GaiaCache(object):
+    """
+    On-disk cache of Gaia cone searches.
+
+    Parameters
+    ----------
+    cachedir : str
+        Cache directory. A subdirectory is created for each Gaia
+        data release (gaiadr_source).
+    gaiadr_source : str
+        String identifying the Gaia DR version (e.g. 'gaiadr3.gaia_source').
+    size_mb : float
+        Size budget (MB). When exceeded, the least recently used files
+        are removed.
+    """
+    def __init__(self, cachedir, gaiadr_source, size_mb=DEFAULT_SIZE_MB):
+        self.cachedir = os.path.join(os.path.expanduser(cachedir), gaiadr_source)
+        self.size_mb = size_mb
+        self.tiling = SkyTiling(TILE_DEG)
+        self.indexfname = os.path.join(self.cachedir, 'cache_index.json')
+        os.makedirs(self.cachedir, exist_ok=True)
+
+    @classmethod
+    def from_setup(cls, setupdata):
+        """
+        Return cache defined in setup_filabres.yaml.
+
+        Parameters
+        ----------
+        setupdata : dict
+            Setup data stored as a Python dictionary.
+
+        Returns
+        -------
+        cache : instance of GaiaCache or None
+            Cache instance. None if gaia_cache_dir is not defined or
+            if a local Gaia catalogue is employed.
+        """
+        cachedir = setupdata.get('gaia_cache_dir')
+        if cachedir is None or is_local_source(setupdata['gaiadr_source']):
+            return None
+        size_mb = setupdata.get('gaia_cache_size_mb', DEFAULT_SIZE_MB)
+        return cls(cachedir, setupdata['gaiadr_source'], size_mb)
+
+    @property
+    def margin_deg(self):
+        """
+        Enlargement of the cone searches required to fill the tiles.
+
+        A cone search with a radius enlarged by this amount fully
+        contains all the tiles overlapping the original cone.
+        """
+        return self.tiling.diagonal_deg + self.tiling.height / 2
+
+    @contextmanager
+    def _locked(self):
+        """Lock the cache to avoid concurrent modifications."""
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.cachedir, '.lock'), 'w') as flock:
+            fcntl.flock(flock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(flock, fcntl.LOCK_UN)
+
+    def _load_index(self):
+        try:
+            with open(self.indexfname) as jfile:
+                return json.load(jfile)
+        except FileNotFoundError:
+            return {'tile_deg': TILE_DEG, 'tiles': {}, 'files': {}}
+
+    def _save_index(self, index):
+        tmpfname = self.indexfname + '.tmp'
+        with open(tmpfname, 'w') as outfile:
+            json.dump(index, outfile)
+        os.replace(tmpfname, self.indexfname)
+
+    def _filename(self, tile):
+        iband, ira = divmod(int(tile), self.tiling.NRA_MAX)
+        return 'tiles_{:05d}_{:06d}.fits'.format(iband, ira // TILES_PER_FILE)
+
+    def _read_file(self, fname):
+        from astropy.table import Table
+        return Table.read(os.path.join(self.cachedir, fname), format='fits')
+
+    def _write_file(self, fname, table):
+        fullname = os.path.join(self.cachedir, fname)
+        tmpfname = fullname + '.tmp'
+        table.write(tmpfname, format='fits', overwrite=True)
+        os.replace(tmpfname, fullname)
+        return os.path.getsize(fullname)
+
+    def lookup(self, ra_deg, dec_deg, radius_deg, magnitude, nmax=None):
+        """
+        Answer a cone search from the cache.
+
+        The query can be answered when all the tiles overlapping the
+        cone are complete down to the requested magnitude or, when nmax
+        is given, when these tiles contain at least nmax objects within
+        the cone brighter than their (common) completeness limit. In the
+        latter case, the nmax brightest objects are returned (which is
+        also the expected result when the query is sorted by magnitude;
+        otherwise, it is a valid subset of nmax objects).
+
+        Parameters
+        ----------
+        ra_deg, dec_deg : float
+            Coordinates (degrees) of the cone centre.
+        radius_deg : float
+            Cone radius (degrees).
+        magnitude : float
+            Limiting magnitude (phot_g_mean_mag < magnitude).
+        nmax : int or None
+            If not None, maximum number of objects returned (the
+            brightest ones).
+
+        Returns
+        -------
+        result : astropy Table or None
+            Objects within the cone sorted by phot_g_mean_mag. None if
+            the cache does not contain the required data.
+        """
+        overlapping, _ = self.tiling.tiles_in_cone(ra_deg, dec_deg, radius_deg)
+        with self._locked():
+            index = self._load_index()
+            maglim = None
+            for tile in overlapping:
+                tile_maglim = index['tiles'].get(str(tile))
+                if tile_maglim is None:
+                    return None
+                maglim = tile_maglim if maglim is None else min(maglim, tile_maglim)
+            if maglim < magnitude and nmax is None:
+                return None
+            fnames = sorted(set([self._filename(tile) for tile in overlapping]))
+            try:
+                tables = [self._read_file(fname) for fname in fnames]
+            except FileNotFoundError:
+                return None
+            now = time.time()
+            for fname in fnames:
+                if fname in index['files']:
+                    index['files'][fname]['last_access'] = now
+            self._save_index(index)
+
+        from astropy.table import vstack
+        table = vstack(tables, metadata_conflicts='silent') if len(tables) > 1 else tables[0]
+        distance = angular_distance_deg(ra_deg, dec_deg, np.asarray(table['ra']), np.asarray(table['dec']))
+        mag = np.asarray(table['phot_g_mean_mag'])
+        result = table[(distance <= radius_deg) & (mag < min(magnitude, maglim))]
+        if maglim < magnitude and len(result) < nmax:
+            return None
+        result.remove_column('tile')
+        result.sort('phot_g_mean_mag')
+        if nmax is not None:
+            result = result[:nmax]
+        return result
+
+    def store(self, ra_deg, dec_deg, radius_deg, magnitude, table):
+        """
+        Store the result of a complete cone search.
+
+        Only the tiles fully contained within the cone are stored. A
+        tile already stored with a fainter (or equal) limiting magnitude
+        is not modified.
+
+        Parameters
+        ----------
+        ra_deg, dec_deg : float
+            Coordinates (degrees) of the cone centre.
+        radius_deg : float
+            Cone radius (degrees).
+        magnitude : float
+            Limiting magnitude of the cone search.
+        table : astropy Table
+            Result of the cone search. It must contain all the sources
+            within the cone brighter than the limiting magnitude.
+
+        Returns
+        -------
+        nstored : int
+            Number of tiles stored.
+        """
+        from astropy.table import Table, vstack
+
+        _, inside = self.tiling.tiles_in_cone(ra_deg, dec_deg, radius_deg)
+        if len(inside) == 0:
+            return 0
+        table = Table(table, copy=True)
+        table.meta.clear()
+        table['tile'] = self.tiling.tile_of(np.asarray(table['ra']), np.asarray(table['dec']))
+
+        nstored = 0
+        with self._locked():
+            index = self._load_index()
+            newtiles = [tile for tile in inside if index['tiles'].get(str(tile), -np.inf) < magnitude]
+            byfile = dict()
+            for tile in newtiles:
+                byfile.setdefault(self._filename(tile), []).append(tile)
+            for fname, tiles in byfile.items():
+                newrows = table[np.isin(np.asarray(table['tile']), tiles)]
+                if fname in index['files'] and os.path.isfile(os.path.join(self.cachedir, fname)):
+                    oldrows = self._read_file(fname)
+                    oldrows = oldrows[~np.isin(np.asarray(oldrows['tile']), tiles)]
+                    newrows = vstack([oldrows, newrows], metadata_conflicts='silent')
+                nbytes = self._write_file(fname, newrows)
+                index['files'][fname] = {'nbytes': nbytes, 'last_access': time.time()}
+                for tile in tiles:
+                    index['tiles'][str(tile)] = float(magnitude)
+                nstored += len(tiles)
+            self._evict(index)
+            self._save_index(index)
+        return nstored
+
+    def _evict(self, index):
+        """Remove least recently used files until the size budget is met."""
+        total = sum([item['nbytes'] for item in index['files'].values()])
+        budget = self.size_mb * 1024 * 1024
+        lru = sorted(index['files'], key=lambda fname: index['files'][fname]['last_access'])
+        for fname in lru:
+            if total <= budget:
+                break
+            total -= index['files'][fname]['nbytes']
+            del index['files'][fname]
+            try:
+                os.remove(os.path.join(self.cachedir, fname))
+            except FileNotFoundError:
+                pass
+            for tile in [tile for tile in index['tiles'] if self._filename(tile) == fname]:
+                del index['tiles'][tile]
+
+    def size_mb_used(self):
+        """Return current size (MB) of the stored files."""
+        index = self._load_index()
+        return sum([item['nbytes'] for item in index['files'].values()]) / 1024 / 1024
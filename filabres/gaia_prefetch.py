@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2020 Universidad Complutense de Madrid
+#
+# This file is part of filabres
+#
+# SPDX-License-Identifier: GPL-3.0+
+# License-Filename: LICENSE.txt
+#
+
+"""
+Asynchronous retrieval of the GAIA data required by the science images.
+
+The central coordinates of the science images of the selected nights
+are grouped in the minimum number of cone searches following the same
+criterion employed by run_astrometry() to reuse previously downloaded
+GAIA data. The corresponding queries are executed concurrently (with a
+bounded number of simultaneous queries, and retrying failed queries) in
+a background thread, while the reduction of the images proceeds. The
+results are installed in the usual index subdirectories (indexNNNNNN,
+registered in the PointingIndex of the night) before starting the
+reduction of each night, so that run_astrometry() simply reuses them.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import os
+import shutil
+import threading
+
+from astropy import units as u
+from astropy.coordinates import SkyCoord, FK5
+from astropy.time import Time
+import numpy as np
+
+from .pointing_index import PointingIndex
+from .run_astrometry import query_gaia_field
+from .run_astrometry import radec_deg
+from .run_astrometry import save_gaia_index
+from .staging import stage_file
+from .tologfile import ToLogFile
+
+# default number of simultaneous queries
+DEFAULT_NQUERIES = 4
+# number of attempts for each query
+NRETRIES = 3
+# delay (seconds) before the first retry (doubled in each new attempt)
+RETRY_DELAY = 5.0
+
+
+def pointings_from_imagedb(imagedb, redustep, list_of_images, instrument):
+    """
+    Return central coordinates of the images stored in the image database.
+
+    Parameters
+    ----------
+    imagedb : dict
+        Image database of a particular night.
+    redustep : str
+        Reduction step.
+    list_of_images : list of str
+        Images to be considered (in the order in which they will be
+        reduced).
+    instrument : str
+        Instrument name.
+
+    Returns
+    -------
+    pointings : list of dict
+        Image name ('fname'), central coordinates ('ra' and 'dec',
+        FK5 J2000, degrees), and date of the observation ('dateobs')
+        of each image.
+    """
+    if len(list_of_images) == 0:
+        return []
+    radec = np.array([radec_deg(instrument, imagedb[redustep][fname]['RA'], imagedb[redustep][fname]['DEC'])
+                      for fname in list_of_images])
+    tobs = Time([imagedb[redustep][fname]['MJD-OBS'] for fname in list_of_images], format='mjd')
+    c_fk5_dateobs = SkyCoord(ra=radec[:, 0] * u.degree, dec=radec[:, 1] * u.degree,
+                             frame='fk5', equinox=tobs)
+    c_fk5_j2000 = c_fk5_dateobs.transform_to(FK5(equinox='J2000'))
+    pointings = []
+    for i, fname in enumerate(list_of_images):
+        pointings.append({
+            'fname': fname,
+            'ra': float(c_fk5_j2000.ra.deg[i]),
+            'dec': float(c_fk5_j2000.dec.deg[i]),
+            'dateobs': tobs[i].isot
+        })
+    return pointings
+
+
+def cluster_pointings(pointings, ccbase, maxfieldview_arcmin, fieldfactor):
+    """
+    Group pointings in the minimum number of cone searches.
+
+    The pointings are examined in the order of reduction. A new cone
+    search, centred on the current pointing, is required when the
+    field of view is not fully covered by any previous cone search,
+    which reproduces the decisions taken by run_astrometry().
+
+    Parameters
+    ----------
+    pointings : list of dict
+        Central coordinates of the images (see pointings_from_imagedb()).
+    ccbase : instance of PointingIndex
+        Central coordinates of the fields with GAIA data already
+        retrieved.
+    maxfieldview_arcmin : float
+        Maximum field of view.
+    fieldfactor : float
+        Multiplicative factor to enlarge the required field of view.
+
+    Returns
+    -------
+    clusters : list of dict
+        Pointings defining the centre of the new cone searches.
+    """
+    ccbase = ccbase.copy()
+    search_radius_arcmin = fieldfactor * (maxfieldview_arcmin / 2)
+    clusters = []
+    for pointing in pointings:
+        if ccbase.find(pointing['ra'], pointing['dec'], maxfieldview_arcmin) is None:
+            subdir = 'index{:06d}'.format(len(ccbase) + 1)
+            ccbase.add(subdir, pointing['ra'], pointing['dec'], search_radius_arcmin)
+            clusters.append(pointing)
+    return clusters
+
+
+class GaiaPrefetcher(object):
+    """
+    Concurrent retrieval of the GAIA data of several nights.
+
+    Parameters
+    ----------
+    setupdata : dict
+        Setup data stored as a Python dictionary.
+    nqueries : int
+        Maximum number of simultaneous queries.
+    nretries : int
+        Number of attempts for each query.
+    retry_delay : float
+        Delay (seconds) before the first retry.
+    verbose : bool
+        If True, display intermediate information.
+    """
+    def __init__(self, setupdata, nqueries=DEFAULT_NQUERIES, nretries=NRETRIES, retry_delay=RETRY_DELAY,
+                 verbose=False):
+        if nqueries < 1:
+            msg = 'Invalid number of simultaneous queries: {}'.format(nqueries)
+            raise SystemError(msg)
+        self.setupdata = setupdata
+        self.nqueries = nqueries
+        self.nretries = nretries
+        self.retry_delay = retry_delay
+        self.verbose = verbose
+        # cone searches of each night
+        self.nights = dict()
+        self._done = dict()
+        self._results = dict()
+        self._thread = None
+
+    def add_night(self, nightdir, pointings, maxfieldview_arcmin, fieldfactor):
+        """
+        Define the cone searches required by the images of a night.
+
+        Parameters
+        ----------
+        nightdir : str
+            Directory where the reduced images will be stored.
+        pointings : list of dict
+            Central coordinates of the images to be reduced (see
+            pointings_from_imagedb()).
+        maxfieldview_arcmin : float
+            Maximum field of view.
+        fieldfactor : float
+            Multiplicative factor to enlarge the required field of view.
+
+        Returns
+        -------
+        nclusters : int
+            Number of cone searches.
+        """
+        ccbase = PointingIndex(nightdir)
+        clusters = cluster_pointings(pointings, ccbase, maxfieldview_arcmin, fieldfactor)
+        search_radius_arcmin = fieldfactor * (maxfieldview_arcmin / 2)
+        self.nights[nightdir] = [dict(pointing, search_radius_arcmin=search_radius_arcmin,
+                                      maxfieldview_arcmin=maxfieldview_arcmin,
+                                      tmpdir='{}/prefetch{:06d}'.format(nightdir, icluster + 1))
+                                 for icluster, pointing in enumerate(clusters)]
+        self._done[nightdir] = threading.Event()
+        if self.verbose:
+            print('Prefetching GAIA data for {}: {} images, {} cone searches'.format(
+                nightdir, len(pointings), len(clusters)))
+        return len(clusters)
+
+    def _fetch(self, cluster):
+        """Retrieve and save the GAIA data of a single cone search."""
+        tmpdir = cluster['tmpdir']
+        if os.path.isdir(tmpdir):
+            shutil.rmtree(tmpdir)
+        os.makedirs(tmpdir)
+        logfile = ToLogFile(workdir=tmpdir, basename='prefetch.log')
+        try:
+            with open('{}/gaialog.log'.format(tmpdir), 'wt') as loggaia:
+                gaia_query_line, gaia_result = query_gaia_field(cluster['ra'], cluster['dec'],
+                                                                cluster['search_radius_arcmin'],
+                                                                self.setupdata, loggaia, logfile)
+                if gaia_result is None:
+                    logfile.print('WARNING: unable to retrieve GAIA data (gaia_result is None)')
+                    return False
+                loggaia.write(str(gaia_result) + '\n')
+            logfile.print('Querying GAIA data: {} objects found'.format(len(gaia_result)))
+            save_gaia_index(gaia_query_line, gaia_result, cluster['dateobs'],
+                            '{}/GaiaDRX-query.fits'.format(tmpdir), logfile)
+        except Exception as error:
+            logfile.print('WARNING: error while retrieving GAIA data: {}'.format(error))
+            return False
+        finally:
+            logfile.close()
+        return True
+
+    async def _fetch_with_retries(self, cluster, semaphore, executor):
+        loop = asyncio.get_running_loop()
+        async with semaphore:
+            for itry in range(self.nretries):
+                if itry > 0:
+                    await asyncio.sleep(self.retry_delay * 2 ** (itry - 1))
+                if await loop.run_in_executor(executor, self._fetch, cluster):
+                    return True
+        return False
+
+    async def _fetch_night(self, nightdir, semaphore, executor):
+        try:
+            self._results[nightdir] = await asyncio.gather(
+                *[self._fetch_with_retries(cluster, semaphore, executor) for cluster in self.nights[nightdir]]
+            )
+        finally:
+            self._done[nightdir].set()
+
+    async def _fetch_all(self):
+        semaphore = asyncio.Semaphore(self.nqueries)
+        with ThreadPoolExecutor(max_workers=self.nqueries) as executor:
+            await asyncio.gather(*[self._fetch_night(nightdir, semaphore, executor) for nightdir in self.nights],
+                                 return_exceptions=True)
+
+    def start(self):
+        """Start the retrieval of the GAIA data in a background thread."""
+        if self._thread is not None:
+            msg = 'GaiaPrefetcher already started'
+            raise SystemError(msg)
+        self._thread = threading.Thread(target=asyncio.run, args=(self._fetch_all(),), daemon=True)
+        self._thread.start()
+
+    def wait(self, nightdir):
+        """
+        Wait for the GAIA data of a night and install the index subdirectories.
+
+        This method must be called (from the main thread) before the
+        reduction of the images of the night.
+
+        Parameters
+        ----------
+        nightdir : str
+            Directory where the reduced images will be stored.
+
+        Returns
+        -------
+        ninstalled : int
+            Number of new index subdirectories.
+        """
+        if nightdir not in self.nights:
+            return 0
+        if self._thread is None:
+            self.start()
+        self._done[nightdir].wait()
+        results = self._results.get(nightdir, [False] * len(self.nights[nightdir]))
+        ccbase = PointingIndex(nightdir)
+        ninstalled = 0
+        for cluster, success in zip(self.nights[nightdir], results):
+            tmpdir = cluster['tmpdir']
+            # the field may have been covered in the meantime
+            if success and ccbase.find(cluster['ra'], cluster['dec'], cluster['maxfieldview_arcmin']) is None:
+                subdir = 'index{:06d}'.format(len(ccbase) + 1)
+                os.rename(tmpdir, '{}/{}'.format(nightdir, subdir))
+                ccbase.add(subdir, cluster['ra'], cluster['dec'], cluster['search_radius_arcmin'])
+                ninstalled += 1
+            else:
+                if not success:
+                    # keep the log file of the failed query
+                    logfname = '{}/{}.log'.format(nightdir, os.path.basename(tmpdir))
+                    if os.path.isfile('{}/prefetch.log'.format(tmpdir)):
+                        stage_file('{}/prefetch.log'.format(tmpdir), logfname)
+                    print('WARNING: unable to prefetch GAIA data around RA={}, DEC={} (see {})'.format(
+                        cluster['ra'], cluster['dec'], logfname))
+                if os.path.isdir(tmpdir):
+                    shutil.rmtree(tmpdir)
+        if self.verbose:
+            print('Prefetched GAIA data for {}: {} new index subdirectories'.format(nightdir, ninstalled))
+        del self.nights[nightdir]
+        return ninstalled
+
+    def run(self):
+        """Retrieve (synchronously) the GAIA data of all the nights."""
+        nightdirs = list(self.nights)
+        ninstalled = 0
+        for nightdir in nightdirs:
+            ninstalled += self.wait(nightdir)
+        if self._thread is not None:
+            self._thread.join()
+        return ninstalled
@@ -15,6 +15,7 @@ import sys
 import yaml
 
 from .check_tslash import check_tslash
+from .load_setup import DEFAULT_GAIA_QUERY_MODE
 
 from filabres import version
 
@@ -65,11 +66,18 @@ def generate_setup(args_setup):
     d['datadir'] = check_tslash(args_setup[1])
     d['gaiadr_source'] = 'gaiadr3.gaia_source'
     d['tweak_order_astrometry'] = 2
+    d['gaia_query_mode'] = DEFAULT_GAIA_QUERY_MODE
+    d['use_supermasters'] = False
     d['ignored_images_file'] = yaml_fname2
     d['image_header_corrections_file'] = yaml_fname3
     d['forced_classifications_file'] = yaml_fname4
     with open(yaml_fname1, 'wt') as f:
         yaml.dump(d, f, default_flow_style=False)
+        # the global Gaia cache is not used by default (as in setup files
+        # lacking gaia_cache_dir)
+        f.write('# global cache of Gaia data (uncomment to enable it)\n')
+        f.write('# gaia_cache_dir: ~/.cache/filabres/gaia\n')
+        f.write('# gaia_cache_size_mb: 1024\n')
 
     # include comments in all the files
     for yaml_fname in lfiles:
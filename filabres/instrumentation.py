@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2020 Universidad Complutense de Madrid
+#
+# This file is part of filabres
+#
+# SPDX-License-Identifier: GPL-3.0+
+# License-Filename: LICENSE.txt
+#
+
+"""
+Lightweight instrumentation of the reduction stages.
+
+Besides the per-product timings stored in the results databases, every
+instrumented span (night, block, image, stage, external command) can be
+exported as a trace of the whole run (see start_profile()).
+"""
+
+import atexit
+from contextlib import contextmanager
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # not available in Windows
+    resource = None
+
+# reduction stages that can be timed
+STAGES = ['fits_read', 'bias', 'flat', 'maskfromflat', 'combine', 'statsumm',
+          'gaia', 'build_index', 'image2xy', 'solve_field', 'sex', 'scamp', 'plots', 'fits_write']
+
+# keywords stored in the 'timings' entry of the results databases
+TIMING_KEYWORDS = ['time_' + item for item in STAGES] + \
+                  ['time_total', 'maxrss_mb', 'maxrss_children_mb', 'io_read_mb', 'io_write_mb']
+
+# active trace writer (None when profiling is not enabled)
+_TRACE = None
+
+
+class TraceWriter(object):
+    """
+    Write trace events to file.
+
+    The events follow the Chrome trace-event format, which can be loaded
+    in chrome://tracing or https://ui.perfetto.dev. When the output file
+    name ends in '.jsonl', each event is written as an independent JSON
+    line instead of as an element of a JSON array.
+
+    The events are written (and flushed) as soon as they are generated, so
+    that the trace is still useful if the execution is interrupted (the
+    trace viewers accept a JSON array without the closing bracket).
+
+    Parameters
+    ----------
+    fname : str
+        Output file name.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.jsonlines = fname.endswith('.jsonl')
+        self.pid = os.getpid()
+        self.t0 = time.perf_counter()
+        self.nevents = 0
+        self.lock = threading.Lock()
+        self.f = open(fname, 'wt')
+        if not self.jsonlines:
+            self.f.write('[\n')
+        self.write({'name': 'process_name', 'ph': 'M', 'pid': self.pid,
+                    'args': {'name': 'filabres'}})
+
+    def timestamp(self):
+        """Return time (microseconds) since the creation of the trace."""
+        return (time.perf_counter() - self.t0) * 1E6
+
+    def write(self, event):
+        """Write a single event."""
+        line = json.dumps(event)
+        with self.lock:
+            if self.f.closed:
+                return
+            if self.jsonlines:
+                self.f.write(line + '\n')
+            else:
+                if self.nevents > 0:
+                    self.f.write(',\n')
+                self.f.write(line)
+            self.f.flush()
+            self.nevents += 1
+
+    def event(self, name, cat, ph, ts=None, dur=None, args=None):
+        """
+        Generate a new event.
+
+        Parameters
+        ----------
+        name : str
+            Event name.
+        cat : str
+            Event category (e.g. 'night', 'image', 'stage', 'subprocess').
+        ph : str
+            Event phase: 'X' (complete event, requires dur), 'B' (begin)
+            or 'E' (end).
+        ts : float or None
+            Time stamp (microseconds). If None, the current time is used.
+        dur : float or None
+            Duration (microseconds) of complete events.
+        args : dict or None
+            Additional information to be displayed with the event.
+        """
+        event = {'name': name, 'cat': cat, 'ph': ph,
+                 'ts': round(self.timestamp() if ts is None else ts, 1),
+                 'pid': self.pid, 'tid': threading.get_ident()}
+        if dur is not None:
+            event['dur'] = round(dur, 1)
+        if args:
+            event['args'] = args
+        self.write(event)
+
+    def close(self):
+        """Close output file."""
+        with self.lock:
+            if self.f.closed:
+                return
+            if not self.jsonlines:
+                self.f.write('\n]\n')
+            self.f.close()
+
+
+def start_profile(fname):
+    """
+    Start recording a trace of the instrumented spans.
+
+    The trace is automatically closed when the program ends.
+
+    Parameters
+    ----------
+    fname : str
+        Output file name (Chrome trace-event JSON array, or JSON
+        lines if the file name ends in '.jsonl').
+    """
+    global _TRACE
+    if _TRACE is not None:
+        stop_profile()
+    _TRACE = TraceWriter(fname)
+    atexit.register(stop_profile)
+
+
+def stop_profile():
+    """Stop recording the trace and close the output file."""
+    global _TRACE
+    if _TRACE is not None:
+        _TRACE.event('filabres', 'run', 'X', ts=0, dur=_TRACE.timestamp(), args={'argv': sys.argv})
+        _TRACE.close()
+        _TRACE = None
+
+
+@contextmanager
+def span(name, cat, **kwargs):
+    """
+    Context manager recording a span in the trace (if profiling is enabled).
+
+    Parameters
+    ----------
+    name : str
+        Span name.
+    cat : str
+        Span category.
+    kwargs : dict
+        Additional information stored with the span.
+    """
+    trace = _TRACE
+    if trace is None:
+        yield
+        return
+    ts = trace.timestamp()
+    try:
+        yield
+    finally:
+        trace.event(name, cat, 'X', ts=ts, dur=trace.timestamp() - ts, args=kwargs)
+
+
+def span_begin(name, cat, **kwargs):
+    """
+    Open a span in the trace (if profiling is enabled).
+
+    This is an alternative to span() for long code blocks. Each call
+    must be paired with a call to span_end() in the same thread.
+    """
+    if _TRACE is not None:
+        _TRACE.event(name, cat, 'B', args=kwargs)
+
+
+def span_end(name, cat, **kwargs):
+    """Close a span previously opened with span_begin()."""
+    if _TRACE is not None:
+        _TRACE.event(name, cat, 'E', args=kwargs)
+
+
+def io_counters():
+    """
+    Return number of bytes read and written by the current process.
+
+    The values are obtained from /proc/self/io, which is only available
+    in Linux. Otherwise, (None, None) is returned.
+
+    Returns
+    -------
+    rchar, wchar : int or None
+        Number of bytes read and written, respectively.
+    """
+    rchar = None
+    wchar = None
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, value = line.split(':')
+                if key == 'rchar':
+                    rchar = int(value)
+                elif key == 'wchar':
+                    wchar = int(value)
+    except (OSError, ValueError):
+        pass
+    return rchar, wchar
+
+
+def maxrss_mb(who='self'):
+    """
+    Return peak resident set size (in MB).
+
+    Parameters
+    ----------
+    who : str
+        'self' for the current process, 'children' for the terminated
+        child processes (e.g. the external astrometric tools).
+
+    Returns
+    -------
+    result : float or None
+        Peak resident set size. None if it cannot be determined.
+    """
+    if resource is None:
+        return None
+    if who == 'self':
+        rusage = resource.getrusage(resource.RUSAGE_SELF)
+    elif who == 'children':
+        rusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    else:
+        raise ValueError('Unexpected who={}'.format(who))
+    # ru_maxrss is given in kilobytes in Linux and in bytes in macOS
+    if sys.platform == 'darwin':
+        return rusage.ru_maxrss / 1024 / 1024
+    return rusage.ru_maxrss / 1024
+
+
+class StageTimer(object):
+    """
+    Accumulate elapsed time and resource usage of reduction stages.
+
+    A new instance must be created for each reduced image (or master
+    calibration), so that the total elapsed time and the bytes
+    read/written correspond to that particular product.
+
+    Attributes
+    ----------
+    timings : dict
+        Accumulated elapsed time (seconds) of each stage.
+    """
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.rchar0, self.wchar0 = io_counters()
+        self.timings = dict()
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager measuring the elapsed time of a stage."""
+        if name not in STAGES:
+            raise ValueError('Unexpected stage name: {}'.format(name))
+        t0 = time.perf_counter()
+        try:
+            with span(name, 'stage'):
+                yield
+        finally:
+            elapsed = time.perf_counter() - t0
+            self.timings[name] = self.timings.get(name, 0.0) + elapsed
+
+    def add(self, name, elapsed):
+        """Add elapsed time (seconds) measured elsewhere to a stage."""
+        if name not in STAGES:
+            raise ValueError('Unexpected stage name: {}'.format(name))
+        self.timings[name] = self.timings.get(name, 0.0) + elapsed
+
+    def summary(self):
+        """
+        Return summary to be stored in the results database.
+
+        Returns
+        -------
+        result : dict
+            Dictionary with the keywords listed in TIMING_KEYWORDS
+            (stages that have not been executed are not included).
+        """
+        result = dict()
+        for name in STAGES:
+            if name in self.timings:
+                result['time_' + name] = round(self.timings[name], 4)
+        result['time_total'] = round(time.perf_counter() - self.t0, 4)
+        for who in ['self', 'children']:
+            value = maxrss_mb(who)
+            if value is not None:
+                kwd = 'maxrss_mb' if who == 'self' else 'maxrss_children_mb'
+                result[kwd] = round(value, 2)
+        rchar, wchar = io_counters()
+        if rchar is not None and self.rchar0 is not None:
+            result['io_read_mb'] = round((rchar - self.rchar0) / 1024 / 1024, 3)
+        if wchar is not None and self.wchar0 is not None:
+            result['io_write_mb'] = round((wchar - self.wchar0) / 1024 / 1024, 3)
+        return result
+
+    def print_summary(self, logfile, summary=None):
+        """Display summary (computed if not given) in log file."""
+        if summary is None:
+            summary = self.summary()
+        for key, value in summary.items():
+            logfile.print('-> {:.<24}: {}'.format(key + '.', value))
+
+
+def stage(timer, name):
+    """
+    Return context manager to time a stage.
+
+    Parameters
+    ----------
+    timer : instance of StageTimer or None
+        Object accumulating the timings. If None, the returned
+        context manager only records the span in the trace (when
+        profiling is enabled).
+    name : str
+        Stage name (must be one of STAGES).
+    """
+    if timer is None:
+        return span(name, 'stage')
+    return timer.stage(name)
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2020 Universidad Complutense de Madrid
+#
+# This file is part of filabres
+#
+# SPDX-License-Identifier: GPL-3.0+
+# License-Filename: LICENSE.txt
+#
+
+"""
+Journal of the changes of a calibration database.
+
+The calibration databases are kept in memory during the execution of a
+reduction step and saved at the end. In order to preserve the master
+calibrations generated before an interruption, the database changes
+corresponding to each reduced block of images are appended (and flushed
+to disk) to a journal file (filabres_db_<instrument>_<step>.journal). The
+journal is replayed when the database is loaded again (see
+load_database(), employed by every module reading a calibration database),
+and removed once the complete database has been saved by the reduction step
+owning the database. The remaining modules only apply the journal in
+memory, leaving both files unchanged.
+"""
+
+import json
+import os
+
+
+def write_database(databasefile, database):
+    """
+    Save database, replacing atomically any previous version.
+
+    Parameters
+    ----------
+    databasefile : str
+        File name of the database.
+    database : dict
+        Database.
+    """
+    with open(databasefile + '.tmp', 'w') as outfile:
+        json.dump(database, outfile, indent=2)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(databasefile + '.tmp', databasefile)
+
+
+def load_database(databasefile, redustep, checkpoint=False):
+    """
+    Load calibration database, recovering the changes stored in its journal.
+
+    The changes stored in the journal (blocks of images reduced in an
+    interrupted execution, or in a reduction step still running) are
+    applied to the returned database.
+
+    Parameters
+    ----------
+    databasefile : str
+        File name of the database.
+    redustep : str
+        Reduction step.
+    checkpoint : bool
+        If True, the updated database is saved and the journal removed.
+        This must only be requested by the reduction step owning the
+        database (i.e. modifying it).
+
+    Returns
+    -------
+    database : dict
+        Database.
+
+    Raises
+    ------
+    FileNotFoundError
+        If neither the database nor its journal exist.
+    """
+    journal = DatabaseJournal(databasefile)
+    try:
+        with open(databasefile) as jfile:
+            database = json.load(jfile)
+    except FileNotFoundError:
+        if not os.path.exists(journal.fname):
+            raise
+        database = {}
+    nrecords = journal.replay(database, redustep)
+    if nrecords > 0 and checkpoint:
+        print('Recovering {} reduced blocks from {}'.format(nrecords, journal.fname))
+        journal.checkpoint(database)
+    return database
+
+
+class DatabaseJournal(object):
+    """
+    Journal of the changes of a calibration database.
+
+    Parameters
+    ----------
+    databasefile : str
+        File name of the database.
+    """
+    def __init__(self, databasefile):
+        self.databasefile = databasefile
+        self.fname = os.path.splitext(databasefile)[0] + '.journal'
+
+    def replay(self, database, redustep):
+        """
+        Apply the changes stored in the journal.
+
+        A last incomplete record (interruption while writing it) is
+        ignored.
+
+        Parameters
+        ----------
+        database : dict
+            Database to be updated.
+        redustep : str
+            Reduction step.
+
+        Returns
+        -------
+        nrecords : int
+            Number of records applied.
+        """
+        if not os.path.exists(self.fname):
+            return 0
+        nrecords = 0
+        with open(self.fname) as jfile:
+            for line in jfile:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                if 'signaturekeys' not in database:
+                    database['signaturekeys'] = record['signaturekeys']
+                if redustep not in database:
+                    database[redustep] = dict()
+                ssig = record['ssig']
+                if ssig not in database[redustep]:
+                    database[redustep][ssig] = dict()
+                for mjdobs in record['deleted']:
+                    database[redustep][ssig].pop(mjdobs, None)
+                database[redustep][ssig][record['mjdobs']] = record['entry']
+                nrecords += 1
+        return nrecords
+
+    def commit(self, signaturekeys, ssig, mjdobs, entry, deleted):
+        """
+        Append the changes corresponding to a reduced block of images.
+
+        Parameters
+        ----------
+        signaturekeys : list of str
+            Signature keywords of the reduction step.
+        ssig : str
+            Signature (string) of the block.
+        mjdobs : str
+            Key of the new database entry.
+        entry : dict
+            New database entry.
+        deleted : list of str
+            Keys of the database entries (with the same signature)
+            deleted due to conflicts with the new entry.
+        """
+        record = {'signaturekeys': signaturekeys, 'ssig': ssig, 'mjdobs': mjdobs,
+                  'entry': entry, 'deleted': deleted}
+        with open(self.fname, 'a') as outfile:
+            outfile.write(json.dumps(record) + '\n')
+            outfile.flush()
+            os.fsync(outfile.fileno())
+
+    def checkpoint(self, database):
+        """Save the complete database and remove the journal."""
+        write_database(self.databasefile, database)
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
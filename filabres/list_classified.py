@@ -11,12 +11,10 @@
 import glob
 import json
 import os
-import pandas as pd
 
 from .check_list_filter import check_list_filter
 from .check_list_mode import check_list_mode
 from .load_instrument_configuration import load_instrument_configuration
-from .show_df import show_df
 from .statsumm import statsumm
 
 from filabres import LISTDIR
@@ -66,6 +64,10 @@ def list_classified(setupdata, img, list_mode, args_night,
     instrument = setupdata['instrument']
     datadir = setupdata['datadir']
 
+    # pandas is only required to display the long list of files
+    if list_mode == 'long':
+        import pandas as pd
+
     # protections
     check_list_mode(list_mode, args_keyword, args_keyword_sort, args_plotxy, args_plotimage, args_ndecimal)
 
@@ -190,6 +192,7 @@ def list_classified(setupdata, img, list_mode, args_night,
                         msg = 'Unexpected list_mode {}'.format(list_mode)
                         raise SystemError(msg)
 
+    from .show_df import show_df
     show_df(df=df,
             n=n,
             list_mode=list_mode,
@@ -10,12 +10,11 @@
 
 import json
 import os
-import pandas as pd
 
 from .check_list_filter import check_list_filter
 from .check_list_mode import check_list_mode
+from .journal import load_database
 from .load_instrument_configuration import load_instrument_configuration
-from .show_df import show_df
 from .statsumm import statsumm
 
 from filabres import LISTDIR
@@ -62,6 +61,10 @@ def list_originf(setupdata, args_originf, list_mode,
     instrument = setupdata['instrument']
     datadir = setupdata['datadir']
 
+    # pandas is only required to display the long list of files
+    if list_mode == 'long':
+        import pandas as pd
+
     # protections
     check_list_mode(list_mode, args_keyword, args_keyword_sort, args_plotxy, args_plotimage, args_ndecimal)
 
@@ -113,8 +116,7 @@ def list_originf(setupdata, args_originf, list_mode,
     # look for the expected results database
     databasefile = 'filabres_db_{}_{}.json'.format(instrument, imagetype)
     try:
-        with open(databasefile) as jfile:
-            database = json.load(jfile)
+        database = load_database(databasefile, imagetype)
     except FileNotFoundError:
         msg = 'ERROR: expected database file {} not found'.format(databasefile)
         print(msg)
@@ -219,6 +221,7 @@ def list_originf(setupdata, args_originf, list_mode,
             msg = 'ERROR: file {} not found in {}'.format(fname, jsonfname)
             raise SystemError(msg)
 
+    from .show_df import show_df
     show_df(df=df,
             n=n,
             list_mode=list_mode,
@@ -13,12 +13,12 @@ import glob
 import json
 import numpy as np
 import os
-import pandas as pd
 
 from .check_list_filter import check_list_filter
 from .check_list_mode import check_list_mode
+from .instrumentation import TIMING_KEYWORDS
+from .journal import load_database
 from .load_instrument_configuration import load_instrument_configuration
-from .show_df import show_df
 
 
 def list_reduced(setupdata, img, list_mode, args_night, args_keyword,
@@ -64,6 +64,10 @@ def list_reduced(setupdata, img, list_mode, args_night, args_keyword,
 
     instrument = setupdata['instrument']
 
+    # pandas is only required to display the long list of files
+    if list_mode == 'long':
+        import pandas as pd
+
     # protections
     check_list_mode(list_mode, args_keyword, args_keyword_sort, args_plotxy, args_plotimage, args_ndecimal)
 
@@ -156,8 +160,11 @@ def list_reduced(setupdata, img, list_mode, args_night, args_keyword,
     for jsonfname in list_of_databases:
 
         try:
-            with open(jsonfname) as jfile:
-                database = json.load(jfile)
+            if classification == 'calibration':
+                database = load_database(jsonfname, imagetype)
+            else:
+                with open(jsonfname) as jfile:
+                    database = json.load(jfile)
         except FileNotFoundError:
             msg = 'File {} not found'.format(jsonfname)
             raise SystemError(msg)
@@ -175,6 +182,9 @@ def list_reduced(setupdata, img, list_mode, args_night, args_keyword,
                             storedkeywords.update({kwd.upper(): minidict[mjdobs][kwd]})
                         else:
                             storedkeywords.update({kwd.upper(): np.nan})
+                    timings = minidict[mjdobs].get('timings', dict())
+                    for kwd in TIMING_KEYWORDS:
+                        storedkeywords.update({kwd.upper(): timings.get(kwd, np.nan)})
                     if args_filter is not None:
                         filterok = check_list_filter(args_filter, storedkeywords)
                     else:
@@ -197,6 +207,7 @@ def list_reduced(setupdata, img, list_mode, args_night, args_keyword,
                                     for kwd in additional_kwd:
                                         if kwd in minidict[mjdobs]:
                                             valid_keywords.append(kwd.upper())
+                                    valid_keywords += [kwd.upper() for kwd in TIMING_KEYWORDS]
                                     print('Valid keywords:', valid_keywords)
                                     raise SystemExit()
                                 colnames_ = []
@@ -241,6 +252,9 @@ def list_reduced(setupdata, img, list_mode, args_night, args_keyword,
                             storedkeywords.update({kwd.upper(): minidict[kwd]})
                         else:
                             storedkeywords.update({kwd.upper(): np.nan})
+                    timings = minidict.get('timings', dict())
+                    for kwd in TIMING_KEYWORDS:
+                        storedkeywords.update({kwd.upper(): timings.get(kwd, np.nan)})
                     if args_filter is not None:
                         filterok = check_list_filter(args_filter, storedkeywords)
                     else:
@@ -259,6 +273,7 @@ def list_reduced(setupdata, img, list_mode, args_night, args_keyword,
                                 for kwd in additional_kwd:
                                     # add all the keywords (even if not available; a NaN will be stored)
                                     valid_keywords.append(kwd.upper())
+                                valid_keywords += [kwd.upper() for kwd in TIMING_KEYWORDS]
                                 print('Valid keywords:', valid_keywords)
                                 raise SystemExit()
                             colnames_ = []
@@ -293,6 +308,7 @@ def list_reduced(setupdata, img, list_mode, args_night, args_keyword,
             msg = 'Unexpected classification {}'.format(classification)
             raise SystemError(msg)
 
+    from .show_df import show_df
     show_df(df=df,
             n=n,
             list_mode=list_mode,
@@ -16,6 +16,11 @@ from .statsumm import statsumm
 
 from filabres import REQ_OPERATORS
 
+# valid keywords in the astrometry section
+ASTROMETRY_KEYWORDS = ['pvalues', 'pixscale_keyword', 'binning_keywords', 'scale_tolerance',
+                       'downsample', 'max_objects', 'cpulimit_seconds', 'plots',
+                       'scamp_reference_min_targets', 'scamp_linear_max_targets']
+
 
 def load_instrument_configuration(setupdata, redustep,
                                   dontcheckredustep=False,
@@ -107,6 +112,22 @@ def load_instrument_configuration(setupdata, redustep,
                 print('-> the (signature) keyword {} is not included in the masterkeywords list'.format(keyword))
                 raise SystemExit()
 
+    # check the keywords of the astrometry section
+    if 'astrometry' in instconf:
+        for keyword in instconf['astrometry']:
+            if keyword not in ASTROMETRY_KEYWORDS:
+                print('ERROR in {} file'.format(yaml_conffile))
+                print('-> invalid keyword {} in astrometry section'.format(keyword))
+                raise SystemExit()
+        headerkeywords = instconf['astrometry'].get('binning_keywords', [])
+        if 'pixscale_keyword' in instconf['astrometry']:
+            headerkeywords = [instconf['astrometry']['pixscale_keyword']] + headerkeywords
+        for keyword in headerkeywords:
+            if keyword not in instconf['masterkeywords']:
+                print('ERROR in {} file'.format(yaml_conffile))
+                print('-> the (astrometry) keyword {} is not included in the masterkeywords list'.format(keyword))
+                raise SystemExit()
+
     if debug:
         print('* Instrument configuration: {}'.format(instconf))
 
@@ -8,13 +8,57 @@
 # License-Filename: LICENSE.txt
 #
 
+from astropy.io import fits
 import numpy as np
 
 
+def is_fits_file(fname):
+    """Check whether a file is in FITS format (e.g. FITS_LDAC catalogue)."""
+    with open(fname, 'rb') as f:
+        return f.read(9) == b'SIMPLE  ='
+
+
+def load_ldac_columns(fname, colnames):
+    """
+    Read columns from a FITS_LDAC catalogue.
+
+    The objects of all the LDAC_OBJECTS extensions are read (using
+    memory mapping) and concatenated.
+
+    Parameters
+    ==========
+    fname : str
+        File name.
+    colnames : list of str
+        Column names.
+
+    Returns
+    =======
+    columns : list of numpy 1D arrays
+        Requested columns.
+    """
+    columns = [[] for col in colnames]
+    with fits.open(fname, memmap=True) as hdul:
+        for hdu in hdul[1:]:
+            if hdu.name != 'LDAC_OBJECTS':
+                continue
+            for col, column in zip(colnames, columns):
+                if col not in hdu.columns.names:
+                    msg = '{} not found in {}'.format(col, fname)
+                    raise SystemError(msg)
+                # copy data (the file is closed afterwards)
+                column.append(np.array(hdu.data[col], dtype=float))
+    return [np.concatenate(column) if len(column) > 0 else np.array([]) for column in columns]
+
+
 def load_scamp_cat(catalogue, workdir, logfile=None):
     """
     Load X, Y coordinates from catalogue generated with SCAMP
 
+    The catalogue can be stored in FITS_LDAC format (FULLOUTCAT_TYPE
+    and MERGEDOUTCAT_TYPE in config.scamp), which is read faster, or in
+    ASCII_HEAD format.
+
     Parameters
     ==========
     catalogue : str
@@ -36,44 +80,57 @@ def load_scamp_cat(catalogue, workdir, logfile=None):
         raise SystemError(msg)
 
     fname = '{}/{}_1.cat'.format(workdir, catalogue)
-    with open(fname, 'rt') as f:
-        fulltxt = f.readlines()
-
-    if logfile is not None:
-        logfile.print('Reading {}'.format(fname))
 
-    # determine relevant column numbers
+    # relevant columns
     if catalogue == 'full':
         colnames = ['X_IMAGE', 'Y_IMAGE', 'CATALOG_NUMBER']
     else:
         colnames = ['ALPHA_J2000', 'DELTA_J2000']
+
+    if is_fits_file(fname):
+        if logfile is not None:
+            logfile.print('Reading {} (FITS_LDAC)'.format(fname))
+        columns = load_ldac_columns(fname, colnames)
+        if catalogue == 'full':
+            # delete invalid rows (those with CATALOG_NUMBER == 0)
+            valid_rows = columns[2] != 0
+            if logfile is not None:
+                logfile.print('Number of objects read: {}'.format(np.sum(valid_rows)))
+            return columns[0][valid_rows], columns[1][valid_rows]
+        return columns[0], columns[1]
+
+    if logfile is not None:
+        logfile.print('Reading {}'.format(fname))
+
+    # determine relevant column numbers (ASCII_HEAD header lines)
+    colnumbers = dict()
+    with open(fname, 'rt') as f:
+        for line in f:
+            if line[0] != '#':
+                break
+            items = line[1:].split()
+            if len(items) > 1:
+                colnumbers[items[1]] = int(items[0])
     ncol = []
     for col in colnames:
-        ii = None
-        for i, line in enumerate(fulltxt):
-            if col in line:
-                ii = i + 1
-                break
-        if ii is None:
+        if col not in colnumbers:
             msg = '{} not found in {}'.format(col, fname)
             raise SystemError(msg)
         if logfile is not None:
-            logfile.print('{} is located in column #{}'.format(col, ii))
-        ncol.append(ii - 1)
+            logfile.print('{} is located in column #{}'.format(col, colnumbers[col]))
+        ncol.append(colnumbers[col] - 1)
 
-    # read full data set
-    fulltable = np.genfromtxt(fname)
+    # read relevant columns
+    table = np.loadtxt(fname, usecols=ncol, ndmin=2)
 
     if catalogue == 'full':
         # delete invalid rows (those with CATALOG_NUMBER == 0)
-        valid_rows = np.where(fulltable[:, ncol[2]] != 0)[0]
+        valid_rows = np.where(table[:, 2] != 0)[0]
         if logfile is not None:
             logfile.print('Number of objects read: {}'.format(len(valid_rows)))
-        newtable = fulltable[valid_rows, :]
-    else:
-        newtable = fulltable
+        table = table[valid_rows, :]
 
-    col1 = newtable[:, ncol[0]]
-    col2 = newtable[:, ncol[1]]
+    col1 = table[:, 0]
+    col2 = table[:, 1]
 
     return col1, col2
@@ -10,6 +10,9 @@
 
 import yaml
 
+# Gaia retrieval strategy when gaia_query_mode is not present in the setup file
+DEFAULT_GAIA_QUERY_MODE = 'bisection'
+
 
 def load_setup(verbose=False):
     """
@@ -33,7 +36,9 @@ def load_setup(verbose=False):
     expected_kwd = ['instrument', 'datadir', 'gaiadr_source', 'tweak_order_astrometry',
                     'ignored_images_file', 'image_header_corrections_file',
                     'forced_classifications_file']
-    additional_kwd = ['default_param', 'config_sex', 'config_scamp']
+    additional_kwd = ['default_param', 'config_sex', 'config_scamp',
+                      'gaia_cache_dir', 'gaia_cache_size_mb', 'gaia_query_mode',
+                      'tool_timeouts', 'max_concurrent_commands', 'use_supermasters']
 
     for kwd in expected_kwd:
         if kwd not in setupdata:
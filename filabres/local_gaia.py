@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2020 Universidad Complutense de Madrid
+#
+# This file is part of filabres
+#
+# SPDX-License-Identifier: GPL-3.0+
+# License-Filename: LICENSE.txt
+#
+
+"""
+Local (offline) Gaia catalogue.
+
+The local catalogue is a pre-extracted subset of Gaia stored in a
+directory containing one NumPy structured array (.npy file) for each sky
+tile (see skytiles.py), with the sources sorted by phot_g_mean_mag, and
+the file local_gaia.json describing the tiling. Such a directory can be
+generated with write_local_catalogue() (or with the auxiliary script
+filabres-make_local_gaia).
+
+The local catalogue is selected in setup_filabres.yaml using
+gaiadr_source: local:<directory>
+"""
+
+import json
+import os
+
+import numpy as np
+
+from .skytiles import SkyTiling
+from .skytiles import angular_distance_deg
+
+LOCAL_PREFIX = 'local:'
+INDEX_FNAME = 'local_gaia.json'
+
+# default size (degrees) of the tiles of the local catalogue
+DEFAULT_TILE_DEG = 1.0
+
+# columns that must be present in the local catalogue
+REQUIRED_COLUMNS = ['SOURCE_ID', 'ref_epoch', 'ra', 'dec', 'pmra', 'pmdec', 'phot_g_mean_mag']
+
+# local catalogues already opened
+_OPENED = dict()
+
+
+def is_local_source(gaiadr_source):
+    """Return True if gaiadr_source defines a local catalogue."""
+    return gaiadr_source.startswith(LOCAL_PREFIX)
+
+
+def write_local_catalogue(table, outdir, tile_deg=DEFAULT_TILE_DEG):
+    """
+    Generate local catalogue from a table with Gaia data.
+
+    Parameters
+    ----------
+    table : astropy Table
+        Gaia data. It must contain the columns listed in
+        REQUIRED_COLUMNS (lower case 'source_id' is also valid).
+        Masked values are replaced by NaN.
+    outdir : str
+        Output directory.
+    tile_deg : float
+        Approximate size (degrees) of the sky tiles.
+
+    Returns
+    -------
+    ntiles : int
+        Number of tiles generated.
+    """
+    if 'source_id' in table.colnames and 'SOURCE_ID' not in table.colnames:
+        table = table.copy(copy_data=False)
+        table.rename_column('source_id', 'SOURCE_ID')
+    for col in REQUIRED_COLUMNS:
+        if col not in table.colnames:
+            msg = 'Column {} missing in table with Gaia data'.format(col)
+            raise SystemError(msg)
+
+    # structured array with all the columns (masked values set to NaN)
+    dtype = []
+    for col in table.colnames:
+        kind = table[col].dtype.kind
+        if kind in 'iub':
+            if hasattr(table[col], 'mask') and np.any(table[col].mask):
+                dtype.append((col, 'f8'))
+            else:
+                dtype.append((col, 'i8'))
+        elif kind == 'f':
+            dtype.append((col, 'f8'))
+    data = np.empty(len(table), dtype=dtype)
+    for col, _ in dtype:
+        column = table[col]
+        if hasattr(column, 'filled'):
+            column = column.filled(np.nan if data.dtype[col].kind == 'f' else 0)
+        data[col] = np.asarray(column)
+
+    tiling = SkyTiling(tile_deg)
+    os.makedirs(outdir, exist_ok=True)
+    tiles = tiling.tile_of(data['ra'], data['dec'])
+    data = data[np.lexsort((data['phot_g_mean_mag'], tiles))]
+    tiles = np.sort(tiles)
+    ntiles = 0
+    for tile, i1, n in zip(*np.unique(tiles, return_index=True, return_counts=True)):
+        np.save(os.path.join(outdir, 'tile_{}.npy'.format(tile)), data[i1:i1 + n])
+        ntiles += 1
+    with open(os.path.join(outdir, INDEX_FNAME), 'w') as outfile:
+        json.dump({'tile_deg': tile_deg, 'columns': [col for col, _ in dtype], 'nsources': len(data)},
+                  outfile, indent=2)
+    return ntiles
+
+
+class LocalGaiaCatalogue(object):
+    """
+    Local Gaia catalogue answering cone searches.
+
+    Parameters
+    ----------
+    catdir : str
+        Directory with the local catalogue.
+    """
+    def __init__(self, catdir):
+        self.catdir = os.path.expanduser(catdir)
+        indexfname = os.path.join(self.catdir, INDEX_FNAME)
+        if not os.path.isfile(indexfname):
+            msg = 'Local Gaia catalogue {} not found'.format(indexfname)
+            raise SystemError(msg)
+        with open(indexfname) as jfile:
+            self.index = json.load(jfile)
+        self.tiling = SkyTiling(self.index['tile_deg'])
+
+    @classmethod
+    def from_source(cls, gaiadr_source):
+        """Return (already opened) catalogue defined by gaiadr_source."""
+        catdir = gaiadr_source[len(LOCAL_PREFIX):]
+        if catdir not in _OPENED:
+            _OPENED[catdir] = cls(catdir)
+        return _OPENED[catdir]
+
+    def query(self, ra_deg, dec_deg, radius_deg, magnitude, nmax=None):
+        """
+        Cone search.
+
+        Parameters
+        ----------
+        ra_deg, dec_deg : float
+            Coordinates (degrees) of the cone centre.
+        radius_deg : float
+            Cone radius (degrees).
+        magnitude : float or None
+            Limiting magnitude (phot_g_mean_mag < magnitude). If None,
+            no magnitude limit is applied.
+        nmax : int or None
+            If not None, maximum number of sources returned (the
+            brightest ones).
+
+        Returns
+        -------
+        result : astropy Table
+            Sources within the cone sorted by phot_g_mean_mag.
+        """
+        from astropy.table import Table
+
+        overlapping, _ = self.tiling.tiles_in_cone(ra_deg, dec_deg, radius_deg)
+        selected = []
+        for tile in overlapping:
+            fname = os.path.join(self.catdir, 'tile_{}.npy'.format(tile))
+            if not os.path.isfile(fname):
+                continue
+            data = np.load(fname, mmap_mode='r')
+            # the sources are sorted by magnitude within each tile
+            if magnitude is not None:
+                data = data[:np.searchsorted(data['phot_g_mean_mag'], magnitude, side='left')]
+            distance = angular_distance_deg(ra_deg, dec_deg, data['ra'], data['dec'])
+            selected.append(np.asarray(data[distance <= radius_deg]))
+        if len(selected) > 0:
+            result = np.concatenate(selected)
+        else:
+            result = np.empty(0, dtype=[(col, 'f8') for col in self.index['columns']])
+        result = result[np.argsort(result['phot_g_mean_mag'], kind='stable')]
+        if nmax is not None:
+            result = result[:nmax]
+        return Table(result)
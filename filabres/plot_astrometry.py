@@ -8,8 +8,22 @@
 # License-Filename: LICENSE.txt
 #
 
+"""
+Summary and plots of the astrometric calibration.
+
+The summary (AstrSummary) is always computed immediately. The plots
+(astrometry-<suffix>.pdf) can be generated immediately ('now'), in a pool
+of background processes ('background'), or not generated at all ('none').
+In the last two cases the data required to generate the plots are saved as
+astrometry-<suffix>.npz (stored with the reduced image), so that they can
+be generated later with filabres-replot_astrometry.
+"""
+
+from astropy.io import fits
+from concurrent.futures import ProcessPoolExecutor
 from matplotlib.backends.backend_pdf import PdfPages
 import matplotlib.pyplot as plt
+import multiprocessing
 import numpy as np
 import os
 
@@ -19,6 +33,12 @@ from .ximshow import ximshow
 
 NMAXGAIA = 2000
 
+PLOT_MODES = ['now', 'background', 'none']
+
+# pool of processes generating plots in background
+_POOL = None
+_PENDING = []
+
 
 class AstrSummary(object):
     """
@@ -49,10 +69,36 @@ class AstrSummary(object):
         self.meanerr = meanerr
 
 
+def astrometry_summary(peak_x, peak_y, pred_x, pred_y, pixel_scales_arcsec_pix, logfile, suffix):
+    """
+    Compute summary of the astrometric calibration.
+
+    See plot_astrometry() for a description of the parameters.
+
+    Returns
+    -------
+    astrsumm : instance of AstrSumm
+        Summary of astrometric calibration.
+    """
+    ntargets = len(peak_x)
+    mean_pixel_scale_arcsec_pix = float(np.mean(pixel_scales_arcsec_pix))
+    delta_x = (pred_x - peak_x) * mean_pixel_scale_arcsec_pix
+    delta_y = (pred_y - peak_y) * mean_pixel_scale_arcsec_pix
+    delta_r = np.sqrt(delta_x * delta_x + delta_y * delta_y)
+    rorder = np.argsort(delta_r)
+    meanerr = float(np.mean(delta_r))
+    logfile.print('astrometry-{}> Number of targest found: {}'.format(suffix, ntargets))
+    logfile.print('astrometry-{}> Mean error (arcsec)....: {}'.format(suffix, meanerr))
+    for i, iorder in enumerate(rorder):
+        if delta_r[iorder] > 3 * meanerr:
+            logfile.print('-> outlier point #{}, delta_r (arcsec): {}'.format(i+1, delta_r[iorder]))
+    return AstrSummary(mean_pixel_scale_arcsec_pix, ntargets, meanerr)
+
+
 def plot_astrometry(output_fname, image2d, mask2d,
                     peak_x, peak_y, pred_x, pred_y, xcatag, ycatag,
                     pixel_scales_arcsec_pix, workdir, interactive, logfile,
-                    suffix):
+                    suffix, plots='now'):
     """
     Generate plots with the results of the astrometric calibration.
 
@@ -91,6 +137,12 @@ def plot_astrometry(output_fname, image2d, mask2d,
         stored.
     suffix : str
         Suffix to be appended to PDF output.
+    plots : str
+        'now': generate the PDF file immediately (without saving the
+        data employed); 'background' and 'none': only save the data
+        required to generate the PDF file (see submit_background_plots()
+        and replot_astrometry()). Interactive executions always generate
+        the plots immediately.
 
     Returns
     -------
@@ -98,7 +150,35 @@ def plot_astrometry(output_fname, image2d, mask2d,
         Summary of astrometric calibration.
 
     """
+    if plots not in PLOT_MODES:
+        msg = 'Invalid astrometry plots mode: {}'.format(plots)
+        raise SystemError(msg)
+
+    astrsumm = astrometry_summary(peak_x, peak_y, pred_x, pred_y, pixel_scales_arcsec_pix, logfile, suffix)
+
+    # save data required to generate the plots later
+    if plots != 'now':
+        np.savez_compressed('{}/astrometry-{}.npz'.format(workdir, suffix),
+                            output_fname=output_fname, suffix=suffix, mask2d=mask2d,
+                            peak_x=peak_x, peak_y=peak_y, pred_x=pred_x, pred_y=pred_y,
+                            xcatag=xcatag, ycatag=ycatag, pixel_scales_arcsec_pix=pixel_scales_arcsec_pix)
+
+    if plots == 'now' or interactive:
+        render_astrometry_plots('{}/astrometry-{}.pdf'.format(workdir, suffix), output_fname, image2d, mask2d,
+                                peak_x, peak_y, pred_x, pred_y, xcatag, ycatag, pixel_scales_arcsec_pix,
+                                interactive, suffix)
+
+    return astrsumm
+
+
+def render_astrometry_plots(pdfname, output_fname, image2d, mask2d,
+                            peak_x, peak_y, pred_x, pred_y, xcatag, ycatag,
+                            pixel_scales_arcsec_pix, interactive, suffix):
+    """
+    Generate PDF file with plots of the astrometric calibration.
 
+    See plot_astrometry() for a description of the parameters.
+    """
     ntargets = len(peak_x)
     naxis2, naxis1 = image2d.shape
 
@@ -108,16 +188,11 @@ def plot_astrometry(output_fname, image2d, mask2d,
     delta_r = np.sqrt(delta_x * delta_x + delta_y * delta_y)
     rorder = np.argsort(delta_r)
     meanerr = float(np.mean(delta_r))
-    logfile.print('astrometry-{}> Number of targest found: {}'.format(suffix, ntargets))
-    logfile.print('astrometry-{}> Mean error (arcsec)....: {}'.format(suffix, meanerr))
-    for i, iorder in enumerate(rorder):
-        if delta_r[iorder] > 3 * meanerr:
-            logfile.print('-> outlier point #{}, delta_r (arcsec): {}'.format(i+1, delta_r[iorder]))
 
     plot_suptitle = '[File: {}]'.format(os.path.basename(output_fname))
     plot_title = 'astrometry-{} (npoints={}, meanerr={:.3f} arcsec)'.format(suffix, ntargets, meanerr)
     # plot 1: X and Y errors
-    pp = PdfPages('{}/astrometry-{}.pdf'.format(workdir, suffix))
+    pp = PdfPages(pdfname)
     fig, ax = plt.subplots(1, 1, figsize=(11.7, 8.3))
     fig.suptitle(plot_suptitle)
     ax.plot(delta_x, delta_y, 'mo', alpha=0.5)
@@ -179,5 +254,92 @@ def plot_astrometry(output_fname, image2d, mask2d,
     pp.close()
     plt.close()
 
-    astrsumm = AstrSummary(mean_pixel_scale_arcsec_pix, ntargets, meanerr)
-    return astrsumm
+
+def replot_astrometry(npzfname, pdfname=None, image_fname=None):
+    """
+    Generate PDF file with plots from the data saved by plot_astrometry().
+
+    Parameters
+    ----------
+    npzfname : str
+        File with the saved data (astrometry-<suffix>.npz).
+    pdfname : str or None
+        Output PDF file. If None, the name of npzfname with the
+        extension replaced by .pdf is employed.
+    image_fname : str or None
+        Reduced image. If None, the output file name saved with the
+        data is employed.
+
+    Returns
+    -------
+    pdfname : str
+        Output PDF file.
+    """
+    if pdfname is None:
+        pdfname = os.path.splitext(npzfname)[0] + '.pdf'
+    with np.load(npzfname) as data:
+        data = dict(data)
+    output_fname = str(data['output_fname'])
+    if image_fname is None:
+        image_fname = output_fname
+    # the reduced image contains the same data employed in the astrometric calibration
+    image2d = fits.getdata(image_fname)
+    render_astrometry_plots(pdfname, output_fname, image2d, data['mask2d'],
+                            data['peak_x'], data['peak_y'], data['pred_x'], data['pred_y'],
+                            data['xcatag'], data['ycatag'], data['pixel_scales_arcsec_pix'],
+                            False, str(data['suffix']))
+    return pdfname
+
+
+def _init_background_process():
+    plt.switch_backend('Agg')
+
+
+def submit_background_plots(npzfname, logfile=None):
+    """
+    Generate PDF file with plots in a background process.
+
+    Parameters
+    ----------
+    npzfname : str
+        File with the saved data (astrometry-<suffix>.npz). The PDF
+        file is created in the same directory.
+    logfile : ToLogFile instance or None
+        Log file to store information.
+    """
+    global _POOL
+    if _POOL is None:
+        # the processes are started with 'spawn' to avoid inheriting the
+        # threads (and locks) of the main process
+        _POOL = ProcessPoolExecutor(max_workers=max(1, (os.cpu_count() or 1) // 2),
+                                    mp_context=multiprocessing.get_context('spawn'),
+                                    initializer=_init_background_process)
+    _PENDING.append((npzfname, _POOL.submit(replot_astrometry, npzfname)))
+    if logfile is not None:
+        logfile.print('-> plots from {} queued'.format(npzfname))
+
+
+def wait_background_plots(verbose=False):
+    """
+    Wait for the plots generated in background processes.
+
+    Returns
+    -------
+    nfailed : int
+        Number of PDF files that could not be generated.
+    """
+    global _POOL
+    nfailed = 0
+    for npzfname, future in _PENDING:
+        try:
+            pdfname = future.result()
+            if verbose:
+                print('-> file {} created'.format(pdfname))
+        except Exception as error:
+            print('WARNING: unable to generate plots from {}: {}'.format(npzfname, error))
+            nfailed += 1
+    del _PENDING[:]
+    if _POOL is not None:
+        _POOL.shutdown()
+        _POOL = None
+    return nfailed
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2020 Universidad Complutense de Madrid
+#
+# This file is part of filabres
+#
+# SPDX-License-Identifier: GPL-3.0+
+# License-Filename: LICENSE.txt
+#
+
+"""
+Central coordinates of the fields with GAIA data already retrieved.
+
+Within each night, every index subdirectory (indexNNNNNN) contains the
+GAIA data retrieved around a particular pointing. The central coordinates
+and search radius of these cone searches are stored as an append-only
+file (central_pointings.jsonl, one JSON record per line), so that adding
+a new pointing does not require rewriting the whole file. The file
+central_pointings.json generated by previous versions of filabres is
+still read.
+
+The pointings are kept as unit vectors in order to find, with vectorized
+operations (or a KD-tree when the number of pointings is large), the
+closest cone search covering a given field of view.
+"""
+
+import json
+import os
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+JSONL_FNAME = 'central_pointings.jsonl'
+LEGACY_FNAME = 'central_pointings.json'
+
+# minimum number of pointings to employ a KD-tree
+KDTREE_MIN_POINTINGS = 256
+
+
+def unit_vector(ra_deg, dec_deg):
+    """Return cartesian coordinates in the unit sphere."""
+    ra = ra_deg * np.pi / 180
+    dec = dec_deg * np.pi / 180
+    return np.cos(ra) * np.cos(dec), np.sin(ra) * np.cos(dec), np.sin(dec)
+
+
+class PointingIndex(object):
+    """
+    Central coordinates of the cone searches performed in a night.
+
+    The instance behaves as a (read-only) dictionary with the index
+    subdirectory names as keys.
+
+    Parameters
+    ----------
+    nightdir : str or None
+        Directory where the reduced images are stored. If None, the
+        pointings are only kept in memory.
+    """
+    def __init__(self, nightdir=None):
+        self.nightdir = nightdir
+        self.entries = dict()
+        self._keys = []
+        self._xyz = None
+        self._radius_arcmin = None
+        self._tree = None
+        if nightdir is None:
+            return
+        records = []
+        legacyfname = os.path.join(nightdir, LEGACY_FNAME)
+        if os.path.exists(legacyfname):
+            with open(legacyfname) as jfile:
+                records += list(json.load(jfile).items())
+        jsonlfname = os.path.join(nightdir, JSONL_FNAME)
+        if os.path.exists(jsonlfname):
+            with open(jsonlfname) as jfile:
+                for line in jfile:
+                    # ignore an incomplete last line (interrupted execution)
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    records.append((record.pop('subdir'), record))
+        self._extend(records)
+
+    def _extend(self, records):
+        for subdir, entry in records:
+            if subdir not in self.entries:
+                self._keys.append(subdir)
+            self.entries[subdir] = entry
+        # arrays with unit vectors and search radii (see _arrays())
+        self._xyz = None
+        self._radius_arcmin = None
+        self._tree = None
+
+    def _arrays(self):
+        if self._xyz is None:
+            entries = [self.entries[subdir] for subdir in self._keys]
+            self._xyz = np.array([[entry['x'], entry['y'], entry['z']] for entry in entries]).reshape(-1, 3)
+            self._radius_arcmin = np.array([entry['search_radius_arcmin'] for entry in entries])
+        return self._xyz, self._radius_arcmin
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, subdir):
+        return subdir in self.entries
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __getitem__(self, subdir):
+        return self.entries[subdir]
+
+    def copy(self):
+        """Return copy of the pointings (only kept in memory)."""
+        result = PointingIndex()
+        result._extend(self.entries.items())
+        return result
+
+    def add(self, subdir, ra_deg, dec_deg, search_radius_arcmin):
+        """
+        Add a new pointing.
+
+        Parameters
+        ----------
+        subdir : str
+            Index subdirectory (indexNNNNNN) with the GAIA data.
+        ra_deg, dec_deg : float
+            Central coordinates (J2000, degrees) of the cone search.
+        search_radius_arcmin : float
+            Radius (arcmin) of the cone search.
+        """
+        x, y, z = unit_vector(ra_deg, dec_deg)
+        entry = {
+            'ra': float(ra_deg),
+            'dec': float(dec_deg),
+            'x': float(x),
+            'y': float(y),
+            'z': float(z),
+            'search_radius_arcmin': float(search_radius_arcmin)
+        }
+        if self.nightdir is not None:
+            with open(os.path.join(self.nightdir, JSONL_FNAME), 'a') as outfile:
+                outfile.write(json.dumps(dict(subdir=subdir, **entry)) + '\n')
+        self._extend([(subdir, entry)])
+
+    def find(self, ra_deg, dec_deg, maxfieldview_arcmin):
+        """
+        Find the closest cone search covering a field.
+
+        Parameters
+        ----------
+        ra_deg, dec_deg : float
+            Central coordinates (J2000, degrees) of the field.
+        maxfieldview_arcmin : float
+            Maximum field of view.
+
+        Returns
+        -------
+        indexid : int or None
+            Identification of the closest index subdirectory covering
+            the whole field of view. None if not found.
+        """
+        if len(self) == 0:
+            return None
+        xyz = np.array(unit_vector(ra_deg, dec_deg))
+        xyz_pointings, radius_arcmin = self._arrays()
+        if len(self) >= KDTREE_MIN_POINTINGS:
+            if self._tree is None:
+                self._tree = cKDTree(xyz_pointings)
+            # maximum angular distance of a cone search covering the field
+            maxdist_rad = (np.max(radius_arcmin) - maxfieldview_arcmin / 2) / 60 * np.pi / 180
+            if maxdist_rad <= 0:
+                return None
+            chord = 2 * np.sin(min(maxdist_rad, np.pi) / 2)
+            candidates = np.sort(np.array(self._tree.query_ball_point(xyz, chord * (1 + 1e-9)), dtype=int))
+        else:
+            candidates = np.arange(len(self))
+        if len(candidates) == 0:
+            return None
+        # angular distance (arcmin)
+        dotproduct = np.clip(xyz_pointings[candidates] @ xyz, -1, 1)
+        dist_arcmin = np.arccos(dotproduct) * 180 / np.pi * 60
+        valid = (maxfieldview_arcmin / 2) + dist_arcmin < radius_arcmin[candidates]
+        if not np.any(valid):
+            return None
+        iclosest = candidates[valid][np.argmin(dist_arcmin[valid])]
+        return int(self._keys[iclosest][-6:])
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2020 Universidad Complutense de Madrid
+#
+# This file is part of filabres
+#
+# SPDX-License-Identifier: GPL-3.0+
+# License-Filename: LICENSE.txt
+#
+
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.time import Time
+import numpy as np
+
+
+def as_float_array(column):
+    """Return copy of column as a float array (masked values set to NaN)."""
+    return np.array(np.ma.filled(np.ma.asarray(column, dtype=float), np.nan), dtype=float)
+
+
+def apply_proper_motion(ra_deg, dec_deg, pmra, pmdec, ref_epoch, dateobs):
+    """
+    Propagate coordinates from the reference epoch to a new date.
+
+    All the sources are corrected with a single (vectorized) call to
+    SkyCoord.apply_space_motion(). The coordinates of sources with
+    undefined (NaN or masked) proper motion are not modified.
+
+    Parameters
+    ----------
+    ra_deg, dec_deg : array_like
+        Coordinates (degrees) at the reference epoch.
+    pmra, pmdec : array_like
+        Proper motion (mas/yr) in right ascension (including the
+        cos(dec) factor) and declination.
+    ref_epoch : float or array_like
+        Reference epoch (decimal year).
+    dateobs : str
+        Date of the observation (e.g. DATE-OBS keyword).
+
+    Returns
+    -------
+    ra_corrected, dec_corrected : numpy array
+        Coordinates (degrees) at the date of the observation.
+    """
+    ra_corrected = as_float_array(ra_deg)
+    dec_corrected = as_float_array(dec_deg)
+    pmra = as_float_array(pmra)
+    pmdec = as_float_array(pmdec)
+    ref_epoch = np.broadcast_to(as_float_array(ref_epoch), ra_corrected.shape)
+
+    valid = ~np.isnan(pmra) & ~np.isnan(pmdec)
+    if np.any(valid):
+        t0 = Time(ref_epoch[valid], format='decimalyear')
+        c = SkyCoord(ra=ra_corrected[valid] * u.degree,
+                     dec=dec_corrected[valid] * u.degree,
+                     pm_ra_cosdec=pmra[valid] * u.mas / u.yr,
+                     pm_dec=pmdec[valid] * u.mas / u.yr,
+                     obstime=t0
+                     )
+        dt = Time(dateobs) - t0
+        c_corrected = c.apply_space_motion(dt=dt.jd * u.day)
+        ra_corrected[valid] = c_corrected.ra.degree
+        dec_corrected[valid] = c_corrected.dec.degree
+
+    return ra_corrected, dec_corrected
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2020 Universidad Complutense de Madrid
+#
+# This file is part of filabres
+#
+# SPDX-License-Identifier: GPL-3.0+
+# License-Filename: LICENSE.txt
+#
+
+"""
+Provenance of the reduced images.
+
+The provenance hash of a reduced image summarizes the inputs of its
+reduction: checksums of the original FITS files, names and checksums of
+the master calibrations employed, version of the instrument configuration
+(together with the parameters of the reduction step), and the relevant
+setup parameters. The hash is stored in the results database, so that
+only the images whose inputs have changed are reduced again when using
+--force_if_changed.
+"""
+
+import hashlib
+import json
+import os
+
+from .load_setup import DEFAULT_GAIA_QUERY_MODE
+
+# setup parameters affecting the reduction of science images
+SETUP_KEYWORDS = ['gaiadr_source', 'tweak_order_astrometry', 'gaia_query_mode']
+# values employed when the previous parameters are not set
+SETUP_DEFAULTS = {'gaia_query_mode': DEFAULT_GAIA_QUERY_MODE}
+# setup parameters given as file names (included through the file checksum)
+SETUP_FILES = ['default_param', 'config_sex', 'config_scamp']
+
+# checksums already computed: (path, size, modification time) as key
+_CHECKSUMS = dict()
+
+
+def file_checksum(fname):
+    """Return (abbreviated) SHA-256 checksum of a file."""
+    stat = os.stat(fname)
+    key = (os.path.abspath(fname), stat.st_size, stat.st_mtime_ns)
+    if key not in _CHECKSUMS:
+        sha256 = hashlib.sha256()
+        with open(fname, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha256.update(chunk)
+        _CHECKSUMS[key] = sha256.hexdigest()[:16]
+    return _CHECKSUMS[key]
+
+
+def provenance_hash(input_fnames, calibration_fnames, instconf, redustep, setupdata=None, options=None):
+    """
+    Compute the provenance hash of a reduced image.
+
+    Parameters
+    ----------
+    input_fnames : list of str
+        Original FITS files.
+    calibration_fnames : list of str
+        Master calibrations employed in the reduction. Names that do not
+        correspond to existing files (e.g. when no calibration with the
+        expected signature is available) are included as given.
+    instconf : dict
+        Instrument configuration.
+    redustep : str
+        Reduction step.
+    setupdata : dict or None
+        Setup data. If not None, the parameters listed in SETUP_KEYWORDS
+        and SETUP_FILES are included.
+    options : dict or None
+        Additional options affecting the reduction (e.g. whether the
+        astrometric calibration is performed).
+
+    Returns
+    -------
+    provenance : str
+        Abbreviated SHA-256 checksum of the reduction inputs.
+    """
+    imagetype = dict(instconf['imagetypes'][redustep])
+    # the classification criteria do not affect the reduction
+    for key in ['requirements', 'requirementx']:
+        imagetype.pop(key, None)
+    items = {
+        'inputs': [[os.path.basename(fname), file_checksum(fname)] for fname in sorted(input_fnames)],
+        'calibrations': [[fname, file_checksum(fname) if fname is not None and os.path.isfile(fname) else None]
+                         for fname in calibration_fnames],
+        'instconf': [instconf['version'], imagetype, instconf.get('astrometry')],
+        'setup': dict(),
+        'options': options
+    }
+    if setupdata is not None:
+        for key in SETUP_KEYWORDS:
+            items['setup'][key] = setupdata.get(key, SETUP_DEFAULTS.get(key))
+        for key in SETUP_FILES:
+            if key in setupdata:
+                fname = setupdata[key]
+                items['setup'][key] = file_checksum(fname) if os.path.isfile(fname) else fname
+    dumstr = json.dumps(items, sort_keys=True, default=str)
+    return hashlib.sha256(dumstr.encode('utf-8')).hexdigest()[:16]
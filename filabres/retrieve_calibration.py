@@ -9,9 +9,9 @@
 #
 
 from astropy.io import fits
-import json
 import numpy as np
 
+from .journal import load_database
 from .signature import signature_string
 
 
@@ -76,7 +76,47 @@ def findclosestquant(mjdobs, database, quantile):
     return delta_mjdobs, result
 
 
-def retrieve_calibration(instrument, redustep, signature, mjdobs, logfile):
+def select_calibration(entries, mjdobs, use_supermasters=False):
+    """
+    Select calibration among those with the expected signature.
+
+    The closest calibration in MJD-OBS is employed. The super-masters
+    (see run_supermaster_step) are only considered when use_supermasters
+    is True (or when no nightly calibration is available): in that case
+    a super-master computed from images covering the requested MJD-OBS
+    is preferred.
+
+    Parameters
+    ----------
+    entries : dict
+        Calibrations with the expected signature, using their MJD-OBS
+        (string) as key.
+    mjdobs : float
+        Modified Julian Date of the image to be calibrated.
+    use_supermasters : bool
+        If True, prefer the super-masters covering mjdobs.
+
+    Returns
+    -------
+    mjdkey : str
+        Key of the selected calibration.
+    """
+    mjdobsarray_str = []
+    if use_supermasters:
+        mjdobsarray_str = [strmjd for strmjd in entries.keys()
+                           if entries[strmjd].get('supermaster', False) and
+                           entries[strmjd]['mjd_min'] <= mjdobs <= entries[strmjd]['mjd_max']]
+    if len(mjdobsarray_str) == 0:
+        mjdobsarray_str = [strmjd for strmjd in entries.keys() if not entries[strmjd].get('supermaster', False)]
+    if len(mjdobsarray_str) == 0:
+        mjdobsarray_str = list(entries.keys())
+    mjdobsarray_str = np.array(mjdobsarray_str)
+    mjdobsarray_float = np.array([float(strmjd) for strmjd in mjdobsarray_str])
+    ipos = find_nearest(mjdobsarray_float, mjdobs)
+    return mjdobsarray_str[ipos]
+
+
+def retrieve_calibration(instrument, redustep, signature, mjdobs, logfile, use_supermasters=False, database=None):
     """
     Retrieve calibration from main database.
 
@@ -94,6 +134,12 @@ def retrieve_calibration(instrument, redustep, signature, mjdobs, logfile):
         available in the main database.
     logfile : instance of ToLogFile
         Logfile to store the output.
+    use_supermasters : bool
+        If True, prefer the super-masters covering mjdobs (see
+        select_calibration()).
+    database : dict or None
+        Calibration database already loaded (see load_database()). If
+        None, the database is read from the corresponding file.
 
     Returns
     -------
@@ -121,12 +167,12 @@ def retrieve_calibration(instrument, redustep, signature, mjdobs, logfile):
     # check that the requested calibration is available in the corresponding
     # calibration database
     databasefile = 'filabres_db_{}_{}.json'.format(instrument, redustep)
-    try:
-        with open(databasefile) as jfile:
-            database = json.load(jfile)
-    except FileNotFoundError:
-        msg = '* ERROR: {} calibration database not found'.format(databasefile)
-        raise SystemError(msg)
+    if database is None:
+        try:
+            database = load_database(databasefile, redustep)
+        except FileNotFoundError:
+            msg = '* ERROR: {} calibration database not found'.format(databasefile)
+            raise SystemError(msg)
 
     msg = '\nCalibration database set to {}'.format(databasefile)
     logfile.print(msg)
@@ -151,16 +197,17 @@ def retrieve_calibration(instrument, redustep, signature, mjdobs, logfile):
     if ssig in database[redustep]:
         msg = '-> looking for calibration {} with signature {}'.format(redustep, ssig)
         logfile.print(msg)
-        mjdobsarray_str = np.array([strmjd for strmjd in database[redustep][ssig].keys()])
         mjdobsarray_float = np.array([float(strmjd) for strmjd in database[redustep][ssig].keys()])
-        ipos = find_nearest(mjdobsarray_float, mjdobs)
-        mjdkey = mjdobsarray_str[ipos]
+        mjdkey = select_calibration(database[redustep][ssig], mjdobs, use_supermasters=use_supermasters)
         delta_mjd = float(mjdkey) - mjdobs
         logfile.print('->   mjdobsarray.......: {}'.format(mjdobsarray_float))
         logfile.print('->   looking for mjdobs: {}'.format(mjdobs))
         logfile.print('->   nearest value is..: {}'.format(mjdkey))
         logfile.print('->   delta_mjd (days)..: {}'.format(delta_mjd))
         calfname = database[redustep][ssig][mjdkey]['fname']
+        if database[redustep][ssig][mjdkey].get('supermaster', False):
+            logfile.print('->   using super-master: {} (nights {})'.format(
+                calfname, ', '.join(database[redustep][ssig][mjdkey]['nights'])), f=True)
         with fits.open(calfname) as hdul:
             image2d_cal = hdul[0].data
         ierr = 0
@@ -199,3 +246,57 @@ def retrieve_calibration(instrument, redustep, signature, mjdobs, logfile):
             raise SystemError(msg)
 
     return ierr, delta_mjd, image2d_cal, calfname
+
+
+def calibration_fname(instrument, redustep, signature, mjdobs, use_supermasters=False, database=None):
+    """
+    Return file name of the calibration that retrieve_calibration() employs.
+
+    The calibration image is not read.
+
+    Parameters
+    ----------
+    instrument : string
+        Instrument name.
+    redustep : string
+        Reduction step.
+    signature : dict()
+        Signature of the image to be calibrated.
+    mjdobs: float
+        Modified Julian Date of the image to be calibrated.
+    use_supermasters : bool
+        If True, prefer the super-masters covering mjdobs (see
+        select_calibration()).
+    database : dict or None
+        Calibration database already loaded (see load_database()). If
+        None, the database is read from the corresponding file.
+
+    Returns
+    -------
+    calfname: str or None
+        Calibration file name. None if the calibration database is
+        not available or if there is no calibration with the expected
+        signature.
+    """
+
+    if database is None:
+        databasefile = 'filabres_db_{}_{}.json'.format(instrument, redustep)
+        try:
+            database = load_database(databasefile, redustep)
+        except FileNotFoundError:
+            return None
+    if redustep not in database:
+        return None
+
+    sortedkeys = database['signaturekeys']
+    expected_signature = dict()
+    for keyword in sortedkeys:
+        if keyword not in signature:
+            return None
+        expected_signature[keyword] = signature[keyword]
+    ssig = signature_string(sortedkeys, expected_signature)
+    if ssig not in database[redustep]:
+        return None
+
+    mjdkey = select_calibration(database[redustep][ssig], mjdobs, use_supermasters=use_supermasters)
+    return database[redustep][ssig][mjdkey]['fname']
@@ -8,24 +8,77 @@
 # License-Filename: LICENSE.txt
 #
 
-from astroquery.gaia import Gaia
+import numpy as np
+
+from .local_gaia import LocalGaiaCatalogue
+from .local_gaia import is_local_source
 
 NMAXGAIA = 2000
 
 
-def retrieve_gaia(gaiadr_source, ra_deg, dec_deg, radius_deg, magnitude, loggaia):
+def gaia_query(gaiadr_source, ra_deg, dec_deg, radius_deg, magnitude, nmax=NMAXGAIA, brightest=False):
+    """
+    Return ADQL query for a cone search.
+
+    See retrieve_gaia() for a description of the parameters.
+    """
+    gaia_query_line1 = f'SELECT TOP {nmax} SOURCE_ID, ref_epoch, ' \
+                       'ra, ra_error, dec, dec_error, ' \
+                       'parallax, parallax_error, ' \
+                       'pmra, pmra_error, pmdec, pmdec_error, ' \
+                       'phot_g_mean_mag, bp_rp, ' \
+                       'radial_velocity, radial_velocity_error'
+    gaia_query_line2 = f'FROM {gaiadr_source}'
+    gaia_query_line3 = f'''WHERE CONTAINS(POINT('ICRS',{gaiadr_source}.ra,{gaiadr_source}.dec), ''' + \
+                       '''CIRCLE('ICRS',''' + \
+                       f'{ra_deg},{dec_deg},{radius_deg}' + \
+                       '))=1'
+    gaia_query_line4 = f'AND phot_g_mean_mag < {magnitude}'
+    gaia_query_line = gaia_query_line1 + ' ' + gaia_query_line2 + ' ' + gaia_query_line3 + ' ' + gaia_query_line4
+    if brightest:
+        gaia_query_line += ' ORDER BY phot_g_mean_mag'
+    return gaia_query_line
+
+
+def launch_query(gaia_query_line):
+    """Execute query in the Gaia archive (None is returned on failure)."""
+    # astroquery is only imported when the remote archive is employed
+    from astroquery.gaia import Gaia
+    # retrieve GAIA data (see example in https://www.cosmos.esa.int/web/gaia-users/archive/use-cases#ClusterAnalysisPythonTutorial)
+    try:
+        job = Gaia.launch_job_async(gaia_query_line)
+        job_result = job.get_results()
+    except:
+        job_result = None
+    return job_result
+
+
+def retrieve_gaia(gaiadr_source, ra_deg, dec_deg, radius_deg, magnitude, loggaia, cache=None, brightest=False):
     """
     Retrieve GAIA data.
 
     Cone search around ra_deg, dec_deg, within a radius given by
     radius_deg, and within a given limiting magnitude.
 
+    By default, at most NMAXGAIA arbitrary objects are returned (the
+    caller must check whether this limit has been reached). When
+    brightest is True, the query is sorted by phot_g_mean_mag, so that
+    the NMAXGAIA brightest objects are returned.
+
+    When a cache is given, it is consulted before querying the Gaia
+    archive. On a cache miss, the brightest objects within an enlarged
+    cone are retrieved so that the result can be stored in the cache
+    (tiles fully contained in the enlarged cone); if the cache still
+    cannot answer the query, the original query is performed.
+
     Parameters
     ==========
     gaiadr_source : str
         String identifying the Gaia DR version to be used.
         For example: 'gaiadr3.gaia_source'. This string is
-        declared in the file setup_filabres.yaml.
+        declared in the file setup_filabres.yaml. A local
+        catalogue (see local_gaia.py) is employed when this
+        string is 'local:<directory>'.
     ra_deg : float
         Right ascension of the central point.
     dec_deg : float
@@ -36,6 +89,10 @@ def retrieve_gaia(gaiadr_source, ra_deg, dec_deg, radius_deg, magnitude, loggaia
         Limiting magnitude.
     loggaia : file handler
         Log file to store intermediate results.
+    cache : instance of GaiaCache or None
+        Global cache of Gaia data.
+    brightest : bool
+        If True, return the NMAXGAIA brightest objects.
 
     Returns
     =======
@@ -44,27 +101,43 @@ def retrieve_gaia(gaiadr_source, ra_deg, dec_deg, radius_deg, magnitude, loggaia
     job_result : astropy table
         Result of the cone search
     """
-    gaia_query_line1 = f'SELECT TOP {NMAXGAIA} SOURCE_ID, ref_epoch, ' \
-                       'ra, ra_error, dec, dec_error, ' \
-                       'parallax, parallax_error, ' \
-                       'pmra, pmra_error, pmdec, pmdec_error, ' \
-                       'phot_g_mean_mag, bp_rp, ' \
-                       'radial_velocity, radial_velocity_error'
-    gaia_query_line2 = f'FROM {gaiadr_source}'
-    gaia_query_line3 = f'''WHERE CONTAINS(POINT('ICRS',{gaiadr_source}.ra,{gaiadr_source}.dec), ''' + \
-                       '''CIRCLE('ICRS',''' + \
-                       f'{ra_deg},{dec_deg},{radius_deg}' + \
-                       '))=1'
-    gaia_query_line4 = f'AND phot_g_mean_mag < {magnitude}'
-    gaia_query_line = gaia_query_line1 + ' ' + gaia_query_line2 + ' ' + gaia_query_line3 + ' ' + gaia_query_line4
+    gaia_query_line = gaia_query(gaiadr_source, ra_deg, dec_deg, radius_deg, magnitude, brightest=brightest)
 
     loggaia.write('Querying GAIA data with phot_g_mean_mag={:.2f}\n'.format(magnitude))
 
     loggaia.write(gaia_query_line + '\n')
-    # retrieve GAIA data (see example in https://www.cosmos.esa.int/web/gaia-users/archive/use-cases#ClusterAnalysisPythonTutorial)
-    try:
-        job = Gaia.launch_job_async(gaia_query_line)
-        job_result = job.get_results()
-    except:
-        job_result = None
-    return gaia_query_line, job_result
+
+    if is_local_source(gaiadr_source):
+        catalogue = LocalGaiaCatalogue.from_source(gaiadr_source)
+        return gaia_query_line, catalogue.query(ra_deg, dec_deg, radius_deg, magnitude, nmax=NMAXGAIA)
+
+    if cache is None:
+        return gaia_query_line, launch_query(gaia_query_line)
+
+    job_result = cache.lookup(ra_deg, dec_deg, radius_deg, magnitude, nmax=NMAXGAIA)
+    if job_result is not None:
+        loggaia.write('-> query answered from Gaia cache {}\n'.format(cache.cachedir))
+        return gaia_query_line, job_result
+
+    # the number of objects requested in the enlarged cone is increased
+    # proportionally to its area (with some additional margin)
+    radius_enlarged_deg = radius_deg + cache.margin_deg
+    nmax_enlarged = int(1.2 * NMAXGAIA * (radius_enlarged_deg / radius_deg) ** 2)
+    loggaia.write('-> query not found in Gaia cache: retrieving {} objects within radius={} '
+                  'to fill the cache\n'.format(nmax_enlarged, radius_enlarged_deg))
+    job_result = launch_query(gaia_query(gaiadr_source, ra_deg, dec_deg, radius_enlarged_deg, magnitude,
+                                         nmax=nmax_enlarged, brightest=True))
+    if job_result is not None:
+        # the result is complete down to the magnitude of the faintest object
+        # when the requested number of objects has been reached
+        if len(job_result) < nmax_enlarged:
+            maglim = magnitude
+        else:
+            maglim = float(np.max(job_result['phot_g_mean_mag']))
+        nstored = cache.store(ra_deg, dec_deg, radius_enlarged_deg, maglim, job_result)
+        loggaia.write('-> {} sky tiles stored in Gaia cache (maglim={})\n'.format(nstored, maglim))
+        job_result = cache.lookup(ra_deg, dec_deg, radius_deg, magnitude, nmax=NMAXGAIA)
+        if job_result is not None:
+            return gaia_query_line, job_result
+    # the cache cannot answer the query
+    return gaia_query_line, launch_query(gaia_query_line)
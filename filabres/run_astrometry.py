@@ -15,22 +15,45 @@ from astropy.time import Time
 from astropy.wcs import WCS
 from astropy.wcs import NoConvergence
 from astropy.wcs.utils import proj_plane_pixel_scales
+from concurrent.futures import ThreadPoolExecutor
 import glob
-import json
 import numpy as np
 import os
 import pkgutil
 import shutil
+import threading
+import time
 
 from .cmdexecute import CmdExecute
+from .gaia_cache import GaiaCache
+from .instrumentation import StageTimer
+from .instrumentation import stage
 from .load_scamp_cat import load_scamp_cat
+from .load_setup import DEFAULT_GAIA_QUERY_MODE
 from .retrieve_gaia import retrieve_gaia
+from .scamp_reference import MAX_NTARGETS_LINEAR
+from .scamp_reference import MIN_NTARGETS_REFERENCE
+from .scamp_reference import ScampReference
+from .scamp_reference import replace_distortion
+from .scamp_reference import write_ahead
+from .staging import COPY
+from .staging import stage_file
 from .plot_astrometry import plot_astrometry
+from .plot_astrometry import submit_background_plots
+from .provenance import file_checksum
+from .pointing_index import PointingIndex
+from .proper_motion import apply_proper_motion
+from .tologfile import ToLogFile
+from .warm_start import MAXDIST_FACTOR
+from .warm_start import RADIUS_FACTOR
+from .warm_start import SCALE_TOLERANCE
+from .warm_start import SolvedFieldIndex
+from .warm_start import shifted_wcs
 
 NMAXGAIA = 2000
 
 
-def save_auxfiles(output_fname, nightdir, workdir, logfile):
+def save_auxfiles(output_fname, nightdir, workdir, logfile, astrometry_plots=None):
     """
     Auxiliary function to store relevant files after astrometric calibration
 
@@ -45,6 +68,9 @@ def save_auxfiles(output_fname, nightdir, workdir, logfile):
         takes place.
     logfile : instance of ToLogFile
        Log file to store information.
+    astrometry_plots : str or None
+        If 'background', the plots of the astrometric calibration are
+        generated from the saved data in background processes.
     """
     basename = os.path.basename(output_fname)
     backupsubdir = basename[:-5]
@@ -63,23 +89,619 @@ def save_auxfiles(output_fname, nightdir, workdir, logfile):
         os.makedirs(backupsubdirfull)
     tobesaved = \
         ['astrometry-net.pdf', 'astrometry-scamp.pdf',
-         'xxx.new', 'full_1.cat', 'merged_1.cat',
+         'astrometry-net.npz', 'astrometry-scamp.npz',
+         'xxx.new', 'xxx.wcs', 'xxx.ahead', 'full_1.cat', 'merged_1.cat',
          'default.param', 'config.sex', 'config.scamp'
         ]
 
-    cmd = CmdExecute(logfile)
-
     for filename in tobesaved:
         if os.path.isfile('{}/{}'.format(workdir, filename)):
-            command = 'cp {} ../{}/'.format(filename, backupsubdir)
-            cmd.run(command, cwd=workdir)
+            stage_file('{}/{}'.format(workdir, filename), backupsubdirfull, logfile)
+
+    if astrometry_plots == 'background':
+        for suffix in ['net', 'scamp']:
+            npzfname = '{}/astrometry-{}.npz'.format(backupsubdirfull, suffix)
+            if os.path.isfile(npzfname):
+                submit_background_plots(npzfname, logfile)
+
+
+def index_cache_fname(indexdir, indexid, pvalue, checksum):
+    """
+    Return file name of a previously built Astrometry.net index file.
+
+    Parameters
+    ----------
+    indexdir : str
+        Index subdirectory (indexNNNNNN) with the GAIA data.
+    indexid : int
+        Identification of the index.
+    pvalue : int
+        P value employed by build-astrometry-index (scale number).
+    checksum : str
+        Checksum of the file with the GAIA data (GaiaDRX-query.fits).
+
+    Returns
+    -------
+    fname : str
+        File name.
+    """
+    return '{}/index-image_I{:06d}_P{}_{}.fits'.format(indexdir, indexid, pvalue, checksum)
+
+
+def radec_deg(instrument, ra, dec):
+    """
+    Convert RA and DEC from the image header to decimal degrees.
+
+    Parameters
+    ----------
+    instrument : str
+        Instrument name.
+    ra : float or str
+        Right ascension, as stored in the image header.
+    dec : float or str
+        Declination, as stored in the image header.
+
+    Returns
+    -------
+    ra_deg, dec_deg : float
+        Coordinates (degrees).
+    """
+    if instrument == 'lsss':
+        # convert RA and DEC to DD.ddddd +/- DD.ddddd
+        ra_h, ra_m, ra_s = ra.split()
+        ra_deg = (float(ra_h) + float(ra_m)/60.0 + float(ra_s)/3600.0) * 15
+        dec_sign = dec[0]
+        dec_d, dec_m, dec_s = dec[1:].split()
+        dec_deg = (float(dec_d) + float(dec_m)/60.0 + float(dec_s)/3600.0)
+        if dec_sign == '-':
+            dec_deg = -dec_deg
+        return ra_deg, dec_deg
+    return float(ra), float(dec)
+
+
+def query_gaia_field(ra_deg, dec_deg, search_radius_arcmin, setupdata, loggaia, logfile):
+    """
+    Retrieve the GAIA objects to be employed in the calibration of a field.
+
+    The retrieval strategy is set by gaia_query_mode in
+    setup_filabres.yaml.
+
+    Parameters
+    ----------
+    ra_deg, dec_deg : float
+        Central coordinates (J2000, degrees) of the cone search.
+    search_radius_arcmin : float
+        Radius (arcmin) of the cone search.
+    setupdata : dict
+        Setup data stored as a Python dictionary.
+    loggaia : file handler
+        Log file to store intermediate results.
+    logfile : instance of ToLogFile
+        Logfile to store reduction information.
+
+    Returns
+    -------
+    gaia_query_line : str
+        Last query.
+    gaia_result : astropy table or None
+        GAIA objects. None if the data could not be retrieved.
+    """
+    loggaia.write('Querying GAIA data...\n')
+    search_radius_degree = search_radius_arcmin / 60
+    # define Gaia DR version
+    gaiadr_source = setupdata['gaiadr_source']
+    # global cache of Gaia data (None if not defined in setup_filabres.yaml)
+    cache = GaiaCache.from_setup(setupdata)
+    # retrieval mode (see setup_filabres.yaml)
+    gaia_query_mode = setupdata.get('gaia_query_mode', DEFAULT_GAIA_QUERY_MODE)
+    if gaia_query_mode == 'brightest':
+        # single query returning the NMAXGAIA brightest objects
+        gaia_query_line, gaia_result = retrieve_gaia(gaiadr_source, ra_deg, dec_deg,
+                                                     search_radius_degree, 30, loggaia, cache=cache,
+                                                     brightest=True)
+        if gaia_result is not None:
+            logfile.print('-> Gaia data: brightest objects: {}'.format(len(gaia_result)))
+    elif gaia_query_mode == 'bisection':
+        # loop in phot_g_mean_mag
+        # ---
+        mag_minimum = 0
+        gaia_query_line, gaia_result = retrieve_gaia(gaiadr_source, ra_deg, dec_deg,
+                                                     search_radius_degree, mag_minimum, loggaia, cache=cache)
+        if gaia_result is None:
+            nobjects_mag_minimum = 0
+        else:
+            nobjects_mag_minimum = len(gaia_result)
+        logfile.print('-> Gaia data: magnitude, nobjects: {:.3f}, {}'.format(
+            mag_minimum, nobjects_mag_minimum))
+        if nobjects_mag_minimum >= NMAXGAIA:
+            raise SystemError('Unexpected')
+        # ---
+        mag_maximum = 30
+        gaia_query_line, gaia_result = retrieve_gaia(gaiadr_source, ra_deg, dec_deg,
+                                                     search_radius_degree, mag_maximum, loggaia, cache=cache)
+        if gaia_result is None:
+            nobjects_mag_maximum = 0
+        else:
+            nobjects_mag_maximum = len(gaia_result)
+        logfile.print('-> Gaia data: magnitude, nobjects: {:.3f}, {}'.format(
+            mag_maximum, nobjects_mag_maximum))
+        if nobjects_mag_maximum < NMAXGAIA:
+            loop_in_gaia = False
+        else:
+            loop_in_gaia = True
+        # ---
+        niter = 0
+        nitermax = 50
+        while loop_in_gaia:
+            niter += 1
+            loggaia.write(f'Iteration {niter}\n')
+            mag_medium = (mag_minimum + mag_maximum) / 2
+            gaia_query_line, gaia_result = retrieve_gaia(gaiadr_source, ra_deg, dec_deg,
+                                                         search_radius_degree, mag_medium, loggaia,
+                                                         cache=cache)
+            if gaia_result is None:
+                msg = 'WARNING: unable to retrieve GAIA data (gaia_result is None)'
+                logfile.print(msg)
+            else:
+                nobjects = len(gaia_result)
+                logfile.print(f'-> Gaia data: magnitude, nobjects: {mag_medium:.3f}, {nobjects}')
+                if nobjects < NMAXGAIA:
+                    if mag_maximum - mag_minimum < 0.1:
+                        loop_in_gaia = False
+                    else:
+                        mag_minimum = mag_medium
+                else:
+                    mag_maximum = mag_medium
+            if niter > nitermax:
+                loggaia.write('ERROR: nitermax reached while retrieving GAIA data')
+                loop_in_gaia = False
+    else:
+        msg = 'Invalid gaia_query_mode: {}'.format(gaia_query_mode)
+        raise SystemError(msg)
+    return gaia_query_line, gaia_result
+
+
+def save_gaia_index(gaia_query_line, gaia_result, dateobs, outfname, logfile, debug=False):
+    """
+    Save GAIA objects, corrected from proper motion, in a FITS binary table.
+
+    Parameters
+    ----------
+    gaia_query_line : str
+        Query employed to retrieve the GAIA objects.
+    gaia_result : astropy table
+        GAIA objects.
+    dateobs : str
+        Date of the observation. The coordinates are propagated
+        to this date.
+    outfname : str
+        Output file name (GaiaDRX-query.fits within the index
+        subdirectory).
+    logfile : instance of ToLogFile
+        Logfile to store reduction information.
+    debug : bool or None
+        Display additional debugging information.
+    """
+    # proper motion correction
+    logfile.print('-> Applying proper motion correction...')
+    source_id = np.asarray(gaia_result['SOURCE_ID'])
+    phot_g_mean_mag = np.asarray(gaia_result['phot_g_mean_mag'])
+    ra_corrected, dec_corrected = apply_proper_motion(
+        gaia_result['ra'], gaia_result['dec'],
+        gaia_result['pmra'], gaia_result['pmdec'],
+        gaia_result['ref_epoch'], dateobs
+    )
+    if debug:
+        for irecord, record in enumerate(gaia_result):
+            print(irecord, record['ra'], ra_corrected[irecord], record['dec'], dec_corrected[irecord])
+
+    # save GAIA objects in FITS binary table
+    hdr = fits.Header()
+    hdr.add_history('GAIA objets selected with following query:')
+    hdr.add_history(gaia_query_line)
+    hdr.add_history('---')
+    hdr.add_history('Note that RA and DEC have been corrected from proper motion')
+    primary_hdu = fits.PrimaryHDU(header=hdr)
+    col1 = fits.Column(name='source_id', format='K', array=source_id)
+    col2 = fits.Column(name='ra', format='D', array=ra_corrected)
+    col3 = fits.Column(name='dec', format='D', array=dec_corrected)
+    col4 = fits.Column(name='phot_g_mean_mag', format='E', array=phot_g_mean_mag)
+    hdu = fits.BinTableHDU.from_columns([col1, col2, col3, col4])
+    hdul = fits.HDUList([primary_hdu, hdu])
+    hdul.writeto(outfname, overwrite=True)
+    logfile.print('-> Saving {}'.format(outfname))
+
+
+def solve_field_pvalue(trialdir, pvalue, indexid, indexdir, gaia_checksum, solve_command, logfile,
+                       timer=None, cancel=None):
+    """
+    Try to solve the field using an index file built with a given P value.
+
+    Parameters
+    ----------
+    trialdir : str
+        Directory containing xxx.fits, GaiaDRX-query.fits and
+        myastrometry.cfg, where the output files are generated.
+    pvalue : int
+        P value for build-astrometry-index (scale number).
+    indexid : int
+        Identification of the index.
+    indexdir : str
+        Index subdirectory (indexNNNNNN) with the GAIA data, where
+        the index files are also stored for subsequent images.
+    gaia_checksum : str
+        Checksum of GaiaDRX-query.fits.
+    solve_command : str
+        Command line to execute solve-field.
+    logfile : instance of ToLogFile
+        Logfile to store reduction information.
+    timer : instance of StageTimer or None
+        Object accumulating the elapsed time of the different
+        astrometric calibration stages.
+    cancel : instance of threading.Event or None
+        Event employed to cancel the execution.
+
+    Returns
+    -------
+    solved : bool
+        True if the field has been solved.
+    """
+    cmd = CmdExecute(logfile, cancel=cancel)
+
+    # generate index file with GAIA data (reusing the index file
+    # built for a previous image with the same GAIA data and P value)
+    cachedindex = index_cache_fname(indexdir, indexid, pvalue, gaia_checksum)
+    with stage(timer, 'build_index'):
+        if os.path.isfile(cachedindex):
+            logfile.print('-> Reusing index file {}'.format(cachedindex))
+            stage_file(cachedindex, '{}/index-image.fits'.format(trialdir))
+        else:
+            # remove previous index file (which may be linked to the saved one)
+            if os.path.isfile('{}/index-image.fits'.format(trialdir)):
+                os.remove('{}/index-image.fits'.format(trialdir))
+            command = 'build-astrometry-index -i GaiaDRX-query.fits'
+            command += ' -o index-image.fits'
+            command += ' -A ra -D dec -S phot_g_mean_mag'
+            command += ' -P {}'.format(pvalue)
+            command += ' -E -I {}'.format(indexid)
+            cmd.run(command, cwd=trialdir)
+            if os.path.isfile('{}/index-image.fits'.format(trialdir)) and \
+                    (cancel is None or not cancel.is_set()):
+                stage_file('{}/index-image.fits'.format(trialdir), cachedindex)
+                logfile.print('-> Saving index file {}'.format(cachedindex))
+
+    with stage(timer, 'solve_field'):
+        cmd.run(solve_command, cwd=trialdir)
+
+    if cancel is not None and cancel.is_set():
+        return False
+    return os.path.isfile('{}/xxx.solved'.format(trialdir))
+
+
+def solve_field_concurrent(workdir, pvalues, ntrials, indexid, indexdir, gaia_checksum, solve_command, logfile,
+                           timer=None):
+    """
+    Try to solve the field with several P values simultaneously.
+
+    Each P value is tried in a scratch subdirectory of workdir, with
+    at most ntrials simultaneous trials. The trials are examined in the
+    order given by pvalues: the first one that solves the field is
+    selected (cancelling the remaining trials) and its output files are
+    moved to workdir, so that the result is the same as when the P
+    values are tried one after another.
+
+    Parameters
+    ----------
+    workdir : str
+        Auxiliary working directory containing xxx.fits (and the list
+        of objects xxx.xyls, if available), GaiaDRX-query.fits and
+        myastrometry.cfg.
+    pvalues : list of int
+        P values for build-astrometry-index in the preferred order.
+    ntrials : int
+        Maximum number of simultaneous trials.
+    indexid, indexdir, gaia_checksum, solve_command, logfile :
+        See solve_field_pvalue().
+    timer : instance of StageTimer or None
+        Object accumulating the elapsed time of the astrometric
+        calibration stages. Since the trials overlap, the longest
+        index generation among the trials is charged to build_index,
+        and the remaining elapsed time to solve_field.
+
+    Returns
+    -------
+    pvalue : int or None
+        P value that solved the field. None if no P value was
+        successful.
+    """
+    t0 = time.perf_counter()
+    cancel = threading.Event()
+    trialdirs = []
+    trialogs = []
+    for pvalue in pvalues:
+        trialdir = '{}/pvalue{}'.format(workdir, pvalue)
+        os.makedirs(trialdir)
+        for fname in ['xxx.fits', 'xxx.xyls', 'GaiaDRX-query.fits', 'myastrometry.cfg']:
+            if os.path.isfile('{}/{}'.format(workdir, fname)):
+                stage_file('{}/{}'.format(workdir, fname), trialdir)
+        trialdirs.append(trialdir)
+        trialogs.append(ToLogFile(workdir=trialdir, basename='trial.log'))
+    # each trial accumulates its own timings
+    trialtimers = [StageTimer() for pvalue in pvalues]
+
+    selected = None
+    nexamined = 0
+    with ThreadPoolExecutor(max_workers=ntrials) as executor:
+        futures = [executor.submit(solve_field_pvalue, trialdir, pvalue, indexid, indexdir, gaia_checksum,
+                                   solve_command, triallog, timer=trialtimer, cancel=cancel)
+                   for trialdir, pvalue, triallog, trialtimer in zip(trialdirs, pvalues, trialogs, trialtimers)]
+        for pvalue, future in zip(pvalues, futures):
+            nexamined += 1
+            if future.result():
+                selected = pvalue
+                cancel.set()
+                for other in futures:
+                    other.cancel()
+                break
+
+    # log of the examined trials (in the preferred order)
+    for pvalue, trialdir, triallog in zip(pvalues[:nexamined], trialdirs, trialogs):
+        triallog.close()
+        logfile.print('-> Trial with P={} in {}'.format(pvalue, trialdir))
+        with open(triallog.fname) as f:
+            logfile.print(f.read().rstrip('\n'))
+        if pvalue != selected:
+            logfile.print('WARNING: field did not solve.')
+    for triallog in trialogs[nexamined:]:
+        triallog.close()
+
+    if selected is not None:
+        trialdir = trialdirs[pvalues.index(selected)]
+        logfile.print('-> Field solved with P={}'.format(selected))
+        for fname in os.listdir(trialdir):
+            if fname != 'trial.log':
+                os.replace('{}/{}'.format(trialdir, fname), '{}/{}'.format(workdir, fname))
+    for trialdir in trialdirs:
+        shutil.rmtree(trialdir)
+    if timer is not None:
+        build_index = max([trialtimer.timings.get('build_index', 0.0) for trialtimer in trialtimers])
+        timer.add('build_index', build_index)
+        timer.add('solve_field', max(time.perf_counter() - t0 - build_index, 0.0))
+    return selected
+
+
+def solve_field_options(astroconf, header, logfile, xylist=False):
+    """
+    Return solve-field options defined in the instrument configuration.
+
+    Parameters
+    ----------
+    astroconf : dict or None
+        Astrometry section of the instrument configuration. The
+        following keywords are employed (all of them are optional):
+        'pixscale_keyword' (FITS keyword with the unbinned pixel scale
+        in arcsec/pixel), 'binning_keywords' (FITS keywords with the
+        binning factors), 'scale_tolerance' (relative range of pixel
+        scales), 'downsample' (downsampling factor prior to source
+        detection), 'max_objects' (maximum number of sources employed),
+        'cpulimit_seconds' (maximum CPU time) and 'plots' (generate
+        solve-field plots).
+    header : astropy header
+        Header of the image.
+    logfile : instance of ToLogFile
+        Logfile to store reduction information.
+    xylist : bool
+        If True, solve-field is executed with a list of objects
+        (generated by image2xy) instead of the image. In this case the
+        downsampling factor is not included (it must be employed by
+        image2xy).
+
+    Returns
+    -------
+    options : str
+        Options to be employed in every solve-field execution.
+    scale_options : str
+        Options constraining the pixel scale (empty string when the
+        pixel scale is not defined).
+    """
+    if astroconf is None:
+        astroconf = dict()
+
+    options = ''
+    if not astroconf.get('plots', False):
+        options += ' -p'
+    if astroconf.get('downsample') is not None and not xylist:
+        options += ' --downsample {}'.format(astroconf['downsample'])
+    if astroconf.get('max_objects') is not None:
+        options += ' --objs {}'.format(astroconf['max_objects'])
+    if astroconf.get('cpulimit_seconds') is not None:
+        options += ' --cpulimit {}'.format(astroconf['cpulimit_seconds'])
+
+    scale_options = ''
+    if 'pixscale_keyword' in astroconf:
+        keywords = [astroconf['pixscale_keyword']] + astroconf.get('binning_keywords', [])
+        missing = [keyword for keyword in keywords if keyword not in header]
+        if missing:
+            logfile.print('WARNING: keyword(s) {} not found. Pixel scale not constrained.'.format(missing))
+        else:
+            pixscale = float(header[astroconf['pixscale_keyword']])
+            binning = [int(header[keyword]) for keyword in astroconf.get('binning_keywords', [])]
+            if len(binning) == 0:
+                binning = [1]
+            tolerance = astroconf.get('scale_tolerance', 0.1)
+            scale_options += ' --scale-units arcsecperpix'
+            scale_options += ' --scale-low {}'.format(pixscale * min(binning) * (1 - tolerance))
+            scale_options += ' --scale-high {}'.format(pixscale * max(binning) * (1 + tolerance))
+
+    return options, scale_options
+
+
+def saturated_objects(x, y, saturpix):
+    """
+    Identify objects located on saturated pixels.
+
+    Parameters
+    ----------
+    x, y : array_like
+        Object coordinates (FITS convention: first pixel is 1).
+    saturpix : numpy 2D array
+        Array storing the location of saturated pixels.
+
+    Returns
+    -------
+    saturated : numpy array
+        Boolean mask (objects outside the image are not considered
+        saturated).
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    naxis2, naxis1 = saturpix.shape
+    valid = np.isfinite(x) & np.isfinite(y)
+    ix = np.zeros(x.shape, dtype=int)
+    iy = np.zeros(y.shape, dtype=int)
+    ix[valid] = np.floor(x[valid] + 0.5).astype(int)
+    iy[valid] = np.floor(y[valid] + 0.5).astype(int)
+    inside = valid & (ix >= 1) & (ix <= naxis1) & (iy >= 1) & (iy <= naxis2)
+    saturated = np.zeros(x.shape, dtype=bool)
+    saturated[inside] = saturpix[iy[inside] - 1, ix[inside] - 1]
+    return saturated
+
+
+def remove_saturated_objects(fname, saturpix, logfile):
+    """
+    Remove objects located on saturated pixels from a list of objects.
+
+    Parameters
+    ----------
+    fname : str
+        FITS file with the list of objects (columns X and Y), as
+        generated by image2xy or solve-field (xxx.axy).
+    saturpix : numpy 2D array
+        Array storing the location of saturated pixels.
+    logfile : instance of ToLogFile
+        Log file to store information.
+
+    Returns
+    -------
+    nsaturated : int
+        Number of removed objects.
+    """
+    with fits.open(fname, 'update') as hdul_table:
+        tbl = hdul_table[1].data
+        saturated = saturated_objects(tbl['X'], tbl['Y'], saturpix)
+        nsaturated = int(np.sum(saturated))
+        logfile.print('Checking file: {}'.format(fname))
+        logfile.print('Number of saturated objects found: {}/{}'.format(nsaturated, tbl.shape[0]))
+        if nsaturated > 0:
+            for row in tbl[saturated]:
+                logfile.print('Saturated object: {}'.format(row))
+            hdul_table[1].data = tbl[~saturated]
+            logfile.print('File: {} updated\n'.format(fname))
+    return nsaturated
+
+
+def remove_sip_solution(newheader, oldheader):
+    """
+    Remove SIP parameters and Astrometry.net comments from header.
+
+    The deleted SIP parameters are recorded as COMMENT cards. The
+    HISTORY and COMMENT cards of the Astrometry.net WCS solution, the
+    additional comments inserted by new-wcs, and the blank comments
+    are removed. The header is rebuilt in a single pass over its cards.
+
+    Parameters
+    ----------
+    newheader : instance of astropy.io.fits.Header
+        Header with the Astrometry.net WCS solution (it is modified).
+    oldheader : instance of astropy.io.fits.Header
+        Header of the WCS solution computed by solve-field (xxx.wcs).
+
+    Returns
+    -------
+    newheader : instance of astropy.io.fits.Header
+        Updated header.
+    """
+    newheader['history'] = '--Deleting SIP from Astrometry.net WCS solution--'
+    newheader.add_comment('--Deleted SIP from Astrometry.net WCS solution--')
+    sip_param = []
+    for p in ['', 'P']:
+        for c in ['A', 'B']:
+            sip_param += ['{}{}_ORDER'.format(c, p)]
+            sip_param += ['{}{}_{}_{}'.format(c, p, i, j) for i in range(3) for j in range(3) if i + j < 3]
+    for kwd in sip_param:
+        newheader.add_comment('deleted {:8} = {:20} / {}'.format(kwd, newheader[kwd], newheader.comments[kwd]))
+
+    # number of cards to be removed with each value (the first occurrences
+    # of each value are removed)
+    tobedeleted = dict()
+    for item in list(oldheader['HISTORY']) + list(oldheader['COMMENT']) + \
+            ['Original key: "END"',
+             '--Start of Astrometry.net WCS solution--',
+             '--Put in by the new-wcs program--',
+             '--End of Astrometry.net WCS--',
+             '--(Put in by the new-wcs program)--']:
+        tobedeleted[item] = tobedeleted.get(item, 0) + 1
+
+    sip_param = set(sip_param)
+    cards = []
+    for card in newheader.cards:
+        if card.keyword in sip_param:
+            continue
+        value = card.value
+        if isinstance(value, str):
+            if value == '':
+                continue
+            if tobedeleted.get(value, 0) > 0:
+                tobedeleted[value] -= 1
+                continue
+        cards.append(card)
+    return fits.Header(cards)
+
+
+def read_tpv_solution(fname):
+    """
+    Read the TPV solution computed by SCAMP.
+
+    Parameters
+    ----------
+    fname : str
+        File name (xxx.head).
+
+    Returns
+    -------
+    cards : list of tuples
+        Keywords (keyword, value, comment) of the TPV solution.
+    history : list of str
+        HISTORY entries.
+    """
+    cards = []
+    history = []
+    with open(fname) as tpvfile:
+        for line in tpvfile:
+            kwd = line[:8].strip()
+            if kwd.find('END') > -1:
+                break
+            if kwd == 'COMMENT':
+                pass  # Avoid problem with non-standard ASCII characters
+            elif kwd == 'HISTORY':
+                history.append(line[10:].rstrip())
+            else:
+                # note the blank spaces to avoid problem with "S/N"
+                kwd_value, kwd_comment = line[11:].split(' / ')
+                try:
+                    value = float(kwd_value.replace('\'', ' '))
+                except ValueError:
+                    value = kwd_value.replace('\'', ' ')
+                cards.append((kwd, value, kwd_comment.rstrip()))
+    return cards, history
 
 
 def run_astrometry(image2d, mask2d, saturpix, header,
                    no_reuse_gaia, maxfieldview_arcmin, fieldfactor, pvalues,
                    nightdir, output_fname,
                    setupdata,
-                   interactive, logfile, debug=False):
+                   interactive, logfile, debug=False, timer=None, pvalue_trials=None,
+                   astrometry_plots=None, signature=None, astroconf=None):
     """
     Compute astrometric solution of image.
 
@@ -121,6 +743,28 @@ def run_astrometry(image2d, mask2d, saturpix, header,
         Logfile to store reduction information.
     debug : bool or None
         Display additional debugging information.
+    timer : instance of StageTimer or None
+        Object accumulating the elapsed time of the different
+        astrometric calibration stages.
+    pvalue_trials : int or None
+        If larger than 1, number of P values tried simultaneously
+        (see solve_field_concurrent()).
+    astrometry_plots : str or None
+        Generation of the plots of the astrometric calibration: 'now'
+        (default), 'background' or 'none' (see plot_astrometry()).
+    signature : str or None
+        Signature of the image (see signature_string()). If not None,
+        the WCS solution of a previous image with the same signature
+        and a close pointing is verified before solving the field from
+        scratch (see SolvedFieldIndex). In addition, the reference
+        distortion computed by SCAMP for previous images with the same
+        signature is employed as a priori solution (see ScampReference).
+    astroconf : dict or None
+        Astrometry section of the instrument configuration, defining
+        additional solve-field options (see solve_field_options()) and
+        the thresholds in the number of targets to employ a SCAMP
+        solution as reference ('scamp_reference_min_targets') and to fit
+        only the linear terms with SCAMP ('scamp_linear_max_targets').
 
     Returns
     -------
@@ -136,6 +780,8 @@ def run_astrometry(image2d, mask2d, saturpix, header,
     ierr_astr = 0
     astrsumm1 = None
     astrsumm2 = None
+    if astroconf is None:
+        astroconf = dict()
 
     # creating work subdirectory
     workdir = nightdir + '/work'
@@ -182,19 +828,9 @@ def run_astrometry(image2d, mask2d, saturpix, header,
     logfile.print('Central coordinates:')
     logfile.print(str(c_fk5_dateobs))
     logfile.print(str(c_fk5_j2000))
-    ra_center = c_fk5_j2000.ra.deg * np.pi / 180
-    dec_center = c_fk5_j2000.dec.deg * np.pi / 180
-    xj2000 = np.cos(ra_center) * np.cos(dec_center)
-    yj2000 = np.sin(ra_center) * np.cos(dec_center)
-    zj2000 = np.sin(dec_center)
-
-    # read JSON file with central coordinates of fields already calibrated
-    jsonfname = '{}/central_pointings.json'.format(nightdir)
-    if os.path.exists(jsonfname):
-        with open(jsonfname) as jfile:
-            ccbase = json.load(jfile)
-    else:
-        ccbase = dict()
+
+    # central coordinates of fields already calibrated
+    ccbase = PointingIndex(nightdir)
 
     # decide whether new GAIA data is needed
     retrieve_new_gaia_data = True
@@ -202,30 +838,7 @@ def run_astrometry(image2d, mask2d, saturpix, header,
     if no_reuse_gaia:
         logfile.print('-> Forcing downloading of GAIA catalogue close the field pointing')
     else:
-        nindices = len(ccbase)
-        if nindices > 0:
-            dist_arcmin_min = None
-            for i, ikey in enumerate(ccbase):
-                x = ccbase[ikey]['x']
-                y = ccbase[ikey]['y']
-                z = ccbase[ikey]['z']
-                search_radius_arcmin = ccbase[ikey]['search_radius_arcmin']
-                # angular distance (radians)
-                dotprodcut = x * xj2000 + y * yj2000 + z * zj2000
-                if abs(dotprodcut) > 1:  # avoid RuntimeWarning when dotproduct = 1.0000000000000002
-                    dist_rad = 0.0
-                else:
-                    dist_rad = np.arccos(x * xj2000 + y * yj2000 + z * zj2000)
-                # angular distance (arcmin)
-                dist_arcmin = dist_rad * 180 / np.pi * 60
-                if (maxfieldview_arcmin / 2) + dist_arcmin < search_radius_arcmin:
-                    if dist_arcmin_min is None:
-                        dist_arcmin_min = dist_arcmin
-                        indexid = int(ikey[-6:])
-                    else:
-                        if dist_arcmin < dist_arcmin_min:
-                            dist_arcmin_min = dist_arcmin
-                            indexid = int(ikey[-6:])
+        indexid = ccbase.find(c_fk5_j2000.ra.deg, c_fk5_j2000.dec.deg, maxfieldview_arcmin)
         if indexid is not None:
             logfile.print('-> Reusing previously downloaded GAIA catalogue (indexid={})'.format(indexid))
             retrieve_new_gaia_data = False
@@ -248,136 +861,25 @@ def run_astrometry(image2d, mask2d, saturpix, header,
         else:
             msg = 'ERROR: subdirectory {} already exists'.format(newsubdir)
             raise SystemError(msg)
-        # generate additional logfile for retrieval of GAIA data
-        loggaianame = '{}/gaialog.log'.format(newsubdir)
-        loggaia = open(loggaianame, 'wt')
-        logfile.print('-> Creating {}'.format(loggaianame))
-        loggaia.write('Querying GAIA data...\n')
-        # generate query for GAIA
-        search_radius_arcmin = fieldfactor * (maxfieldview_arcmin / 2)
-        search_radius_degree = search_radius_arcmin / 60
-        # define Gaia DR version
-        gaiadr_source = setupdata['gaiadr_source']
-        # loop in phot_g_mean_mag
-        # ---
-        mag_minimum = 0
-        gaia_query_line, gaia_result = retrieve_gaia(gaiadr_source,
-                                                     c_fk5_j2000.ra.deg, c_fk5_j2000.dec.deg, search_radius_degree,
-                                                     mag_minimum, loggaia)
-        if gaia_result is None:
-            nobjects_mag_minimum = 0
-        else:
-            nobjects_mag_minimum = len(gaia_result)
-        logfile.print('-> Gaia data: magnitude, nobjects: {:.3f}, {}'.format(mag_minimum, nobjects_mag_minimum))
-        if nobjects_mag_minimum >= NMAXGAIA:
-            raise SystemError('Unexpected')
-        # ---
-        mag_maximum = 30
-        gaia_query_line, gaia_result = retrieve_gaia(gaiadr_source,
-                                                     c_fk5_j2000.ra.deg, c_fk5_j2000.dec.deg, search_radius_degree,
-                                                     mag_maximum, loggaia)
-        if gaia_result is None:
-            nobjects_mag_maximum = 0
-        else:
-            nobjects_mag_maximum = len(gaia_result)
-        logfile.print('-> Gaia data: magnitude, nobjects: {:.3f}, {}'.format(mag_maximum, nobjects_mag_maximum))
-        if nobjects_mag_maximum < NMAXGAIA:
-            loop_in_gaia = False
-        else:
-            loop_in_gaia = True
-        # ---
-        niter = 0
-        nitermax = 50
-        while loop_in_gaia:
-            niter += 1
-            loggaia.write(f'Iteration {niter}\n')
-            mag_medium = (mag_minimum + mag_maximum) / 2
-            gaia_query_line, gaia_result = retrieve_gaia(gaiadr_source,
-                                                         c_fk5_j2000.ra.deg, c_fk5_j2000.dec.deg, search_radius_degree,
-                                                         mag_medium, loggaia)
+        with stage(timer, 'gaia'):
+            # generate additional logfile for retrieval of GAIA data
+            loggaianame = '{}/gaialog.log'.format(newsubdir)
+            loggaia = open(loggaianame, 'wt')
+            logfile.print('-> Creating {}'.format(loggaianame))
+            search_radius_arcmin = fieldfactor * (maxfieldview_arcmin / 2)
+            gaia_query_line, gaia_result = query_gaia_field(c_fk5_j2000.ra.deg, c_fk5_j2000.dec.deg,
+                                                            search_radius_arcmin, setupdata, loggaia, logfile)
             if gaia_result is None:
-                msg = 'WARNING: unable to retrieve GAIA data (gaia_result is None)'
-                logfile.print(msg)
-            else:
-                nobjects = len(gaia_result)
-                logfile.print(f'-> Gaia data: magnitude, nobjects: {mag_medium:.3f}, {nobjects}')
-                if nobjects < NMAXGAIA:
-                    if mag_maximum - mag_minimum < 0.1:
-                        loop_in_gaia = False
-                    else:
-                        mag_minimum = mag_medium
-                else:
-                    mag_maximum = mag_medium
-            if niter > nitermax:
-                loggaia.write('ERROR: nitermax reached while retrieving GAIA data')
-                loop_in_gaia = False
-
-        if gaia_result is None:
-            raise SystemError('FATAL ERROR: unable to retrieve GAIA data (gaia_result is None; check http connection)')
-
-        loggaia.write(str(gaia_result) + '\n')
-        loggaia.close()
+                msg = 'FATAL ERROR: unable to retrieve GAIA data (gaia_result is None; check http connection)'
+                raise SystemError(msg)
+            loggaia.write(str(gaia_result) + '\n')
+            loggaia.close()
+            logfile.print('Querying GAIA data: {} objects found'.format(len(gaia_result)))
+            save_gaia_index(gaia_query_line, gaia_result, dateobs, newsubdir + '/GaiaDRX-query.fits',
+                            logfile, debug=debug)
 
-        logfile.print('Querying GAIA data: {} objects found'.format(len(gaia_result)))
-
-        # proper motion correction
-        logfile.print('-> Applying proper motion correction...')
-        source_id = []
-        ra_corrected = []
-        dec_corrected = []
-        phot_g_mean_mag = []
-        for irecord, record in enumerate(gaia_result):
-            source_id.append(record['SOURCE_ID'])
-            phot_g_mean_mag.append(record['phot_g_mean_mag'])
-            ra, dec = record['ra'], record['dec']
-            pmra, pmdec = record['pmra'], record['pmdec']
-            ref_epoch = record['ref_epoch']
-            if not np.isnan(pmra) and not np.isnan(pmdec):
-                t0 = Time(ref_epoch, format='decimalyear')
-                c = SkyCoord(ra=ra * u.degree,
-                             dec=dec * u.degree,
-                             pm_ra_cosdec=pmra * u.mas / u.yr,
-                             pm_dec=pmdec * u.mas / u.yr,
-                             obstime=t0
-                             )
-                dt = Time(dateobs) - t0
-                c_corrected = c.apply_space_motion(dt=dt.jd * u.day)
-                if debug:
-                    print(irecord, ra, c_corrected.ra.value, dec, c_corrected.dec.value)
-                ra_corrected.append(c_corrected.ra.value)
-                dec_corrected.append(c_corrected.dec.value)
-            else:
-                ra_corrected.append(ra)
-                dec_corrected.append(dec)
-
-        # save GAIA objects in FITS binary table
-        hdr = fits.Header()
-        hdr.add_history('GAIA objets selected with following query:')
-        hdr.add_history(gaia_query_line)
-        hdr.add_history('---')
-        hdr.add_history('Note that RA and DEC have been corrected from proper motion')
-        primary_hdu = fits.PrimaryHDU(header=hdr)
-        col1 = fits.Column(name='source_id', format='K', array=source_id)
-        col2 = fits.Column(name='ra', format='D', array=ra_corrected)
-        col3 = fits.Column(name='dec', format='D', array=dec_corrected)
-        col4 = fits.Column(name='phot_g_mean_mag', format='E', array=phot_g_mean_mag)
-        hdu = fits.BinTableHDU.from_columns([col1, col2, col3, col4])
-        hdul = fits.HDUList([primary_hdu, hdu])
-        outfname = nightdir + '/' + subdir + '/GaiaDRX-query.fits'
-        hdul.writeto(outfname, overwrite=True)
-        logfile.print('-> Saving {}'.format(outfname))
-
-        # update JSON file with central coordinates of fields already calibrated
-        ccbase[subdir] = {
-            'ra': c_fk5_j2000.ra.degree,
-            'dec': c_fk5_j2000.dec.degree,
-            'x': xj2000,
-            'y': yj2000,
-            'z': zj2000,
-            'search_radius_arcmin': search_radius_arcmin
-        }
-        with open(jsonfname, 'w') as outfile:
-            json.dump(ccbase, outfile, indent=2)
+        # update database with central coordinates of fields already calibrated
+        ccbase.add(subdir, c_fk5_j2000.ra.deg, c_fk5_j2000.dec.deg, search_radius_arcmin)
 
     else:
         # check that directory with the old index does exist
@@ -387,8 +889,8 @@ def run_astrometry(image2d, mask2d, saturpix, header,
             msg = 'ERROR: subdirectory {} does not exist!'
             raise SystemError(msg)
 
-    command = 'cp {}/{}/GaiaDRX-query.fits {}/work/'.format(nightdir, subdir, nightdir)
-    cmd.run(command)
+    stage_file('{}/{}/GaiaDRX-query.fits'.format(nightdir, subdir), workdir, logfile)
+    gaia_checksum = file_checksum('{}/GaiaDRX-query.fits'.format(workdir))
 
     # image dimensions
     naxis2, naxis1 = image2d.shape
@@ -396,82 +898,119 @@ def run_astrometry(image2d, mask2d, saturpix, header,
     # save temporary FITS file
     tmpfname = '{}/xxx.fits'.format(workdir)
     header.add_history('--Computing Astrometry.net WCS solution--')
-    hdu = fits.PrimaryHDU(image2d, header)
-    hdu.writeto(tmpfname, overwrite=True)
+    with stage(timer, 'fits_write'):
+        hdu = fits.PrimaryHDU(image2d, header)
+        hdu.writeto(tmpfname, overwrite=True)
     logfile.print('\nGenerating reduced image {}/xxx.fits (after bias '
                   'subtraction and flatfielding)\n'.format(workdir))
 
     logfile.print('\n*** Using Astrometry.net tools ***')
-    ip = 0
-    loop = True
-    while loop:
-        # generate index file with GAIA data
-        command = 'build-astrometry-index -i GaiaDRX-query.fits'
-        command += ' -o index-image.fits'
-        command += ' -A ra -D dec -S phot_g_mean_mag'
-        command += ' -P {}'.format(pvalues[ip])
-        command += ' -E -I {}'.format(indexid)
-        cmd.run(command, cwd=workdir)
 
-        # solve fieldmormo
-        command = 'solve-field -p'
-        command += ' --config myastrometry.cfg --overwrite'
-        command += ' --ra ' + str(c_fk5_j2000.ra.degree)
-        command += ' --dec ' + str(c_fk5_j2000.dec.degree)
-        command += ' --radius {}'.format(maxfieldview_arcmin / 120)
-        command += ' --tweak-order {}'.format(setupdata['tweak_order_astrometry'])
-        command += ' xxx.fits'
-        cmd.run(command, cwd=workdir)
-
-        # check that the field solved
-        if not os.path.isfile('{}/xxx.solved'.format(workdir)):
-            logfile.print('WARNING: field did not solve.')
-            if ip < len(pvalues) - 1:
-                logfile.print('WARNING: trying with new P value.')
-                ip += 1
-            else:
-                ierr_astr = 1
-                msg = 'Unable to solve the field with Astrometry.net'
-                logfile.print(msg)
-                header.add_history(msg)
-                hdu = fits.PrimaryHDU(image2d, header)
-                hdu.writeto(output_fname, overwrite=True)
-                logfile.print('-> file {} created'.format(output_fname))
-                save_auxfiles(output_fname=output_fname, nightdir=nightdir, workdir=workdir, logfile=logfile)
-                return ierr_astr, astrsumm1, astrsumm2
+    # detect objects and remove the saturated ones before solving the field
+    # (otherwise the field must be solved again after removing them)
+    use_xylist = shutil.which('image2xy') is not None
+    if use_xylist:
+        command = 'image2xy -O'
+        if astroconf.get('downsample') is not None:
+            command += ' -d {}'.format(astroconf['downsample'])
+        command += ' -o xxx.xyls xxx.fits'
+        with stage(timer, 'image2xy'):
+            cmd.run(command, cwd=workdir)
+        use_xylist = os.path.isfile('{}/xxx.xyls'.format(workdir))
+    if use_xylist:
+        remove_saturated_objects('{}/xxx.xyls'.format(workdir), saturpix, logfile)
+
+    # solve field
+    options, scale_options = solve_field_options(astroconf, header, logfile, xylist=use_xylist)
+    command_start = 'solve-field' + options
+    command_start += ' --config myastrometry.cfg --overwrite'
+    if use_xylist:
+        command_start += ' --width {} --height {}'.format(naxis1, naxis2)
+        command_start += ' --x-column X --y-column Y --sort-column FLUX'
+    command_end = ' --tweak-order {}'.format(setupdata['tweak_order_astrometry'])
+    if use_xylist:
+        command_end += ' xxx.xyls'
+    else:
+        command_end += ' xxx.fits'
+    solve_command = command_start
+    solve_command += ' --ra ' + str(c_fk5_j2000.ra.degree)
+    solve_command += ' --dec ' + str(c_fk5_j2000.dec.degree)
+    solve_command += ' --radius {}'.format(maxfieldview_arcmin / 120)
+    solve_command += scale_options
+    solve_command += command_end
+
+    # warm start: verify the WCS solution of a previous image of the same field
+    solved = False
+    wcsbase = SolvedFieldIndex(nightdir)
+    previous = None
+    if signature is not None:
+        previous = wcsbase.find(signature, c_fk5_j2000.ra.deg, c_fk5_j2000.dec.deg,
+                                MAXDIST_FACTOR * maxfieldview_arcmin)
+    if previous is not None:
+        logfile.print('-> Warm start from the WCS solution in {}'.format(wcsbase.path(previous)))
+        ra_centre, dec_centre, pixscale = shifted_wcs(wcsbase.path(previous), previous['ra'], previous['dec'],
+                                                      c_fk5_j2000.ra.deg, c_fk5_j2000.dec.deg, naxis1, naxis2,
+                                                      '{}/previous.wcs'.format(workdir))
+        warm_command = command_start
+        warm_command += ' --ra {} --dec {}'.format(ra_centre, dec_centre)
+        warm_command += ' --radius {}'.format(RADIUS_FACTOR * maxfieldview_arcmin / 60)
+        warm_command += ' --scale-units arcsecperpix'
+        warm_command += ' --scale-low {} --scale-high {}'.format(pixscale * (1 - SCALE_TOLERANCE),
+                                                                 pixscale * (1 + SCALE_TOLERANCE))
+        warm_command += ' --verify previous.wcs'
+        warm_command += command_end
+        pvalue = previous['pvalue']
+        solved = solve_field_pvalue(workdir, pvalue, indexid, newsubdir, gaia_checksum, warm_command,
+                                    logfile, timer=timer)
+        if not solved:
+            logfile.print('WARNING: warm start failed. Solving the field from scratch.')
+
+    if not solved:
+        if pvalue_trials is not None and pvalue_trials > 1:
+            pvalue = solve_field_concurrent(workdir, pvalues, pvalue_trials, indexid, newsubdir, gaia_checksum,
+                                            solve_command, logfile, timer=timer)
+            solved = pvalue is not None
         else:
-            loop = False
+            for ip, pvalue in enumerate(pvalues):
+                if ip > 0:
+                    logfile.print('WARNING: trying with new P value.')
+                solved = solve_field_pvalue(workdir, pvalue, indexid, newsubdir, gaia_checksum, solve_command,
+                                            logfile, timer=timer)
+                if solved:
+                    break
+                logfile.print('WARNING: field did not solve.')
+
+    # check that the field solved
+    if not solved:
+        ierr_astr = 1
+        msg = 'Unable to solve the field with Astrometry.net'
+        logfile.print(msg)
+        header.add_history(msg)
+        with stage(timer, 'fits_write'):
+            hdu = fits.PrimaryHDU(image2d, header)
+            hdu.writeto(output_fname, overwrite=True)
+        logfile.print('-> file {} created'.format(output_fname))
+        save_auxfiles(output_fname=output_fname, nightdir=nightdir, workdir=workdir, logfile=logfile,
+                      astrometry_plots=astrometry_plots)
+        return ierr_astr, astrsumm1, astrsumm2
 
     # check for saturated objects
-    with fits.open('{}/xxx.axy'.format(workdir), 'update') as hdul_table:
-        tbl = hdul_table[1].data
-        isaturated = []
-        for i in range(tbl.shape[0]):
-            ix = int(tbl['X'][i] + 0.5)
-            iy = int(tbl['Y'][i] + 0.5)
-            if saturpix[iy - 1, ix - 1]:
-                isaturated.append(i)
-        logfile.print('Checking file: {}/xxx.axy'.format(workdir))
-        logfile.print('Number of saturated objects found: {}/{}'.format(len(isaturated), tbl.shape[0]))
-        if len(isaturated) > 0:
-            for i in isaturated:
-                logfile.print('Saturated object: {}'.format(tbl[i]))
-        if len(isaturated) > 0:
-            hdul_table[1].data = np.delete(tbl, isaturated)
-            logfile.print('File: {}/xxx.axy updated\n'.format(workdir))
-
-    if len(isaturated) > 0:
+    nsaturated = remove_saturated_objects('{}/xxx.axy'.format(workdir), saturpix, logfile)
+
+    if nsaturated > 0:
         # rerun code
-        command = 'solve-field -p'
+        command = 'solve-field' + options
         command += ' --config myastrometry.cfg --continue'
         command += ' --width {} --height {}'.format(naxis1, naxis2)
         command += ' --x-column X --y-column Y --sort-column FLUX'
         command += ' --ra ' + str(c_fk5_j2000.ra.degree)
         command += ' --dec ' + str(c_fk5_j2000.dec.degree)
         command += ' --radius {}'.format(maxfieldview_arcmin / 120)
+        command += scale_options
         command += ' --tweak-order {}'.format(setupdata['tweak_order_astrometry'])
         command += ' xxx.axy'
-        cmd.run(command, cwd=workdir)
+        with stage(timer, 'solve_field'):
+            cmd.run(command, cwd=workdir)
 
         # check that the field solved
         if not os.path.isfile('{}/xxx.solved'.format(workdir)):
@@ -479,12 +1018,20 @@ def run_astrometry(image2d, mask2d, saturpix, header,
             msg = 'Unable to solve the field with Astrometry.net'
             logfile.print(msg)
             header.add_history(msg)
-            hdu = fits.PrimaryHDU(image2d, header)
-            hdu.writeto(output_fname, overwrite=True)
+            with stage(timer, 'fits_write'):
+                hdu = fits.PrimaryHDU(image2d, header)
+                hdu.writeto(output_fname, overwrite=True)
             logfile.print('-> file {} created'.format(output_fname))
-            save_auxfiles(output_fname=output_fname, nightdir=nightdir, workdir=workdir, logfile=logfile)
+            save_auxfiles(output_fname=output_fname, nightdir=nightdir, workdir=workdir, logfile=logfile,
+                          astrometry_plots=astrometry_plots)
             return ierr_astr, astrsumm1, astrsumm2
 
+    # register the WCS solution (saved with the auxiliary files) for subsequent images
+    if signature is not None:
+        backupsubdir = os.path.basename(output_fname)[:-5]
+        wcsbase.add(signature, c_fk5_j2000.ra.deg, c_fk5_j2000.dec.deg, pvalue, '{}/xxx.wcs'.format(backupsubdir))
+
+    if nsaturated > 0 or use_xylist:
         # insert new WCS into image header
         command = 'new-wcs -i xxx.fits -w xxx.wcs -o xxx.new -d'
         cmd.run(command, cwd=workdir)
@@ -512,18 +1059,19 @@ def run_astrometry(image2d, mask2d, saturpix, header,
         tcorr = hdul_table[1].data
 
     # generate plots
-    astrsumm1 = plot_astrometry(
-        output_fname=output_fname,
-        image2d=image2d,
-        mask2d=mask2d,
-        peak_x=tcorr.field_x, peak_y=tcorr.field_y,
-        pred_x=tcorr.index_x, pred_y=tcorr.index_y,
-        xcatag=xgaia, ycatag=ygaia,
-        pixel_scales_arcsec_pix=pixel_scales_arcsec_pix,
-        workdir=workdir,
-        interactive=interactive, logfile=logfile,
-        suffix='net'
-    )
+    with stage(timer, 'plots'):
+        astrsumm1 = plot_astrometry(
+            output_fname=output_fname,
+            image2d=image2d,
+            mask2d=mask2d,
+            peak_x=tcorr.field_x, peak_y=tcorr.field_y,
+            pred_x=tcorr.index_x, pred_y=tcorr.index_y,
+            xcatag=xgaia, ycatag=ygaia,
+            pixel_scales_arcsec_pix=pixel_scales_arcsec_pix,
+            workdir=workdir,
+            interactive=interactive, logfile=logfile,
+            suffix='net', plots=astrometry_plots or 'now'
+        )
 
     # open result and update header
     result_fname = '{}/xxx.new'.format(workdir)
@@ -545,8 +1093,8 @@ def run_astrometry(image2d, mask2d, saturpix, header,
                 if initfname[0] != '/':
                     initfname = os.getcwd() + '/' + initfname
                 if os.path.exists(initfname):
-                    command = 'cp {} {}/'.format(initfname, workdir)
-                    cmd.run(command)
+                    # copy (the user may modify the original file)
+                    stage_file(initfname, workdir, logfile, mode=COPY)
                 else:
                     raise SystemError('The file {} given in setup_filabres.yaml does not exist!'.format(initfname))
             else:
@@ -559,11 +1107,30 @@ def run_astrometry(image2d, mask2d, saturpix, header,
 
         # run sextractor
         command = 'sex xxx.new -c config.sex -CATALOG_NAME xxx.ldac'
-        cmd.run(command, cwd=workdir)
+        with stage(timer, 'sex'):
+            cmd.run(command, cwd=workdir)
+
+        # a priori distortion computed for previous images with the same signature
+        scampref = None
+        reffname = None
+        linear_only = False
+        if signature is not None:
+            scampref = ScampReference(os.path.dirname(nightdir) or '.')
+            reffname = scampref.get(signature)
+        if reffname is not None:
+            write_ahead(reffname, '{}/xxx.ahead'.format(workdir))
+            logfile.print('-> Using a priori distortion from {}'.format(reffname))
+            linear_only = astrsumm1.ntargets < astroconf.get('scamp_linear_max_targets', MAX_NTARGETS_LINEAR)
 
         # run scamp
         command = 'scamp xxx.ldac -c config.scamp'
-        cmd.run(command, cwd=workdir)
+        if linear_only:
+            logfile.print('-> Sparse field ({} targets): fitting only the linear terms'.format(astrsumm1.ntargets))
+            command += ' -DISTORT_DEGREES 1'
+        with stage(timer, 'scamp'):
+            cmd.run(command, cwd=workdir)
+        if linear_only and os.path.exists('{}/xxx.head'.format(workdir)):
+            replace_distortion('{}/xxx.head'.format(workdir), reffname)
 
         # check there is a useful result
         if os.path.exists('{}/xxx.head'.format(workdir)):
@@ -590,79 +1157,25 @@ def run_astrometry(image2d, mask2d, saturpix, header,
         newheader['history'] = '- ntargets: {}'.format(astrsumm1.ntargets)
         newheader['history'] = '- meanerr: {}'.format(astrsumm1.meanerr)
         newheader['history'] = '-------------------------------------------------------'
-        hdu = fits.PrimaryHDU(image2d, newheader)
-        hdu.writeto(output_fname, overwrite=True)
+        with stage(timer, 'fits_write'):
+            hdu = fits.PrimaryHDU(image2d, newheader)
+            hdu.writeto(output_fname, overwrite=True)
         logfile.print('-> file {} created'.format(output_fname))
-        save_auxfiles(output_fname=output_fname, nightdir=nightdir, workdir=workdir, logfile=logfile)
+        save_auxfiles(output_fname=output_fname, nightdir=nightdir, workdir=workdir, logfile=logfile,
+                      astrometry_plots=astrometry_plots)
         return ierr_astr, astrsumm1, astrsumm2
 
-    # remove SIP parameters in newheader
-    newheader['history'] = '--Deleting SIP from Astrometry.net WCS solution--'
-    newheader.add_comment('--Deleted SIP from Astrometry.net WCS solution--')
-    sip_param = []
-    for p in ['', 'P']:
-        for c in ['A', 'B']:
-            sip_param += ['{}{}_ORDER'.format(c, p)]
-            sip_param += ['{}{}_{}_{}'.format(c, p, i, j) for i in range(3) for j in range(3) if i + j < 3]
-    for kwd in sip_param:
-        kwd_value = newheader[kwd]
-        kwd_comment = newheader.comments[kwd]
-        newheader['comment'] = 'deleted {:8} = {:20} / {}'.format(kwd, kwd_value, kwd_comment)
-        del newheader[kwd]
-    # remove HISTORY and COMMENT entries from astrometry.net
+    # remove SIP parameters and Astrometry.net comments in newheader
     with fits.open('{}/xxx.wcs'.format(workdir)) as hdul:
         oldheader = hdul[0].header
-    for kwd in ['HISTORY', 'COMMENT']:
-        for itemval in oldheader[kwd]:
-            try:
-                idel = list(newheader.values()).index(itemval)
-            except ValueError:
-                idel = -1
-            if idel > -1:
-                del newheader[idel]
-    # delete additional comment lines
-    tobedeleted = ['Original key: "END"',
-                   '--Start of Astrometry.net WCS solution--',
-                   '--Put in by the new-wcs program--',
-                   '--End of Astrometry.net WCS--',
-                   '--(Put in by the new-wcs program)--']
-    for item in tobedeleted:
-        try:
-            idel = list(newheader.values()).index(item)
-        except ValueError:
-            idel = -1
-        if idel > -1:
-            del newheader[idel]
-    # remove blank COMMENTS
-    idel = 0
-    while idel > -1:
-        try:
-            idel = list(newheader.values()).index('')
-        except ValueError:
-            idel = -1
-        if idel > -1:
-            del newheader[idel]
+    newheader = remove_sip_solution(newheader, oldheader)
 
     # set the TPV solution obtained with sextractor+scamp
     newheader['history'] = '--Computing new solution with SEXTRACTOR+SCAMP--'
-    with open('{}/xxx.head'.format(workdir)) as tpvfile:
-        tpvheader = tpvfile.readlines()
-    for line in tpvheader:
-        kwd = line[:8].strip()
-        if kwd.find('END') > -1:
-            break
-        if kwd == 'COMMENT':
-            pass  # Avoid problem with non-standard ASCII characters
-        elif kwd == 'HISTORY':
-            newheader[kwd] = line[10:].rstrip()
-        else:
-            # note the blank spaces to avoid problem with "S/N"
-            kwd_value, kwd_comment = line[11:].split(' / ')
-            try:
-                value = float(kwd_value.replace('\'', ' '))
-            except ValueError:
-                value = kwd_value.replace('\'', ' ')
-            newheader[kwd] = (value, kwd_comment.rstrip())
+    tpvcards, tpvhistory = read_tpv_solution('{}/xxx.head'.format(workdir))
+    newheader.extend(tpvcards, update=True)
+    for item in tpvhistory:
+        newheader.add_history(item)
 
     # set CTYPE1 and CTYPE2 from 'RA---TAN' and 'DEC--TAN' to 'RA---TPV' and 'DEC--TPV'
     newheader['CTYPE1'] = 'RA---TPV'
@@ -685,18 +1198,25 @@ def run_astrometry(image2d, mask2d, saturpix, header,
     xgaia, ygaia = w.wcs_world2pix(gaiadr2.ra, gaiadr2.dec, 1)
 
     # generate plots
-    astrsumm2 = plot_astrometry(
-        output_fname=output_fname,
-        image2d=image2d,
-        mask2d=mask2d,
-        peak_x=peak_x, peak_y=peak_y,
-        pred_x=pred_x, pred_y=pred_y,
-        xcatag=xgaia, ycatag=ygaia,
-        pixel_scales_arcsec_pix=pixel_scales_arcsec_pix,
-        workdir=workdir,
-        interactive=interactive, logfile=logfile,
-        suffix='scamp'
-    )
+    with stage(timer, 'plots'):
+        astrsumm2 = plot_astrometry(
+            output_fname=output_fname,
+            image2d=image2d,
+            mask2d=mask2d,
+            peak_x=peak_x, peak_y=peak_y,
+            pred_x=pred_x, pred_y=pred_y,
+            xcatag=xgaia, ycatag=ygaia,
+            pixel_scales_arcsec_pix=pixel_scales_arcsec_pix,
+            workdir=workdir,
+            interactive=interactive, logfile=logfile,
+            suffix='scamp', plots=astrometry_plots or 'now'
+        )
+
+    # update the reference distortion for subsequent images with the same signature
+    if scampref is not None and not linear_only:
+        scampref.update(signature, '{}/xxx.head'.format(workdir), astrsumm2.ntargets, astrsumm2.meanerr,
+                        os.path.basename(output_fname), logfile,
+                        min_ntargets=astroconf.get('scamp_reference_min_targets', MIN_NTARGETS_REFERENCE))
 
     # store astrometric summaries in history
     newheader['history'] = '-------------------------------------------------------'
@@ -712,11 +1232,13 @@ def run_astrometry(image2d, mask2d, saturpix, header,
     newheader['history'] = '-------------------------------------------------------'
 
     # save result
-    hdu = fits.PrimaryHDU(image2d, newheader)
-    hdu.writeto(output_fname, overwrite=True)
+    with stage(timer, 'fits_write'):
+        hdu = fits.PrimaryHDU(image2d, newheader)
+        hdu.writeto(output_fname, overwrite=True)
     logfile.print('-> file {} created'.format(output_fname))
 
     # storing relevant files in corresponding subdirectory
-    save_auxfiles(output_fname=output_fname, nightdir=nightdir, workdir=workdir, logfile=logfile)
+    save_auxfiles(output_fname=output_fname, nightdir=nightdir, workdir=workdir, logfile=logfile,
+                  astrometry_plots=astrometry_plots)
 
     return ierr_astr, astrsumm1, astrsumm2
@@ -15,7 +15,15 @@ import numpy as np
 import os
 import sys
 
+from .dependants import DependantsIndex
+from .instrumentation import StageTimer
+from .instrumentation import span_begin
+from .instrumentation import span_end
+from .journal import DatabaseJournal
+from .journal import load_database
 from .maskfromflat import maskfromflat
+from .provenance import provenance_hash
+from .retrieve_calibration import calibration_fname
 from .retrieve_calibration import retrieve_calibration
 from .signature import getkey_from_signature
 from .signature import signature_string
@@ -26,8 +34,42 @@ from .version import version
 from filabres import LISTDIR
 
 
+def block_provenance(redustep, imgblock, imagedb, signature, instconf, use_supermasters=False):
+    """
+    Compute the provenance hash of a combined calibration image.
+
+    Parameters
+    ----------
+    redustep : str
+        Reduction step.
+    imgblock : list of str
+        Original FITS files to be combined.
+    imagedb : dict
+        Image database of the night.
+    signature : dict
+        Signature of the combined image.
+    instconf : dict
+        Instrument configuration.
+    use_supermasters : bool
+        If True, prefer the super-masters when selecting the master
+        bias (see select_calibration()).
+
+    Returns
+    -------
+    provenance : str
+        Provenance hash (see provenance_hash()): original files, master
+        bias (flat-imaging) and instrument configuration.
+    """
+    calibration_fnames = []
+    if redustep == 'flat-imaging' and instconf['imagetypes'][redustep]['basicreduction']:
+        mjdobs = imagedb[redustep][os.path.basename(imgblock[0])]['MJD-OBS']
+        calibration_fnames.append(calibration_fname(instconf['instname'], 'bias', signature, mjdobs,
+                                                    use_supermasters=use_supermasters))
+    return provenance_hash(imgblock, calibration_fnames, instconf, redustep)
+
+
 def run_calibration_step(redustep, setupdata, list_of_nights,
-                         instconf, force, verbose=False, debug=False):
+                         instconf, force, force_if_changed=False, verbose=False, debug=False):
     """
     Execute reduction step.
 
@@ -44,6 +86,9 @@ def run_calibration_step(redustep, setupdata, list_of_nights,
         details.
     force : bool
         If True, recompute reduction of calibration images.
+    force_if_changed : bool
+        If True, recompute the reduction of the calibration images
+        whose provenance (see provenance_hash()) has changed.
     verbose : bool
         If True, display intermediate information.
     debug : bool
@@ -52,17 +97,24 @@ def run_calibration_step(redustep, setupdata, list_of_nights,
 
     datadir = setupdata['datadir']
     instrument = instconf['instname']
+    # prefer the super-masters when retrieving the calibrations
+    use_supermasters = setupdata.get('use_supermasters', False)
 
     # set the results database: note that for calibration images, this
     # database is stored in a single JSON file in the current directory
+    # (the blocks reduced in a previous interrupted execution are
+    # recovered from the journal)
     databasefile = 'filabres_db_{}_{}.json'.format(instrument, redustep)
     try:
-        with open(databasefile) as jfile:
-            database = json.load(jfile)
+        database = load_database(databasefile, redustep, checkpoint=True)
     except FileNotFoundError:
         database = {}
     if verbose:
         print('\nResults database set to {}'.format(databasefile))
+    journal = DatabaseJournal(databasefile)
+
+    # reverse index: reduced images depending on each master calibration
+    depindex = DependantsIndex(instrument)
 
     # check for subdirectory in current directory to store results
     if os.path.isdir(redustep):
@@ -85,6 +137,7 @@ def run_calibration_step(redustep, setupdata, list_of_nights,
     for inight, night in enumerate(list_of_nights):
 
         print('\n* Working with night {} ({}/{})'.format(night, inight + 1, len(list_of_nights)))
+        span_begin(night, 'night')
 
         # read local image database for current night
         jsonfname = LISTDIR + night + '/imagedb_'
@@ -224,12 +277,37 @@ def run_calibration_step(redustep, setupdata, list_of_nights,
                     output_mname = output_fname + '_mask.fits'
                     output_lname = output_fname + '_red.log'
                     output_fname += '_red.fits'
+
+                    # the provenance is only computed when it is needed
+                    provenance = None
                     execute_reduction = True
                     if os.path.exists(output_fname) and not force:
                         execute_reduction = False
-                        print('File {} already exists: skipping reduction.'.format(output_fname))
+                        ssig = signature_string(signaturekeys, signature)
+                        previous = [entry.get('provenance')
+                                    for entry in database.get(redustep, dict()).get(ssig, dict()).values()
+                                    if entry['fname'] == output_fname]
+                        if len(previous) == 0:
+                            # file generated in an interrupted execution before
+                            # updating the database
+                            execute_reduction = True
+                            print('File {} not found in database: repeating reduction.'.format(output_fname))
+                        elif force_if_changed:
+                            provenance = block_provenance(redustep, imgblock, imagedb, signature, instconf,
+                                                          use_supermasters)
+                            if provenance not in previous:
+                                execute_reduction = True
+                                print('Provenance of {} has changed: repeating reduction.'.format(output_fname))
+                        if not execute_reduction:
+                            print('File {} already exists: skipping reduction.'.format(output_fname))
 
                     if execute_reduction:
+                        if provenance is None:
+                            provenance = block_provenance(redustep, imgblock, imagedb, signature, instconf,
+                                                          use_supermasters)
+                        span_begin(os.path.basename(output_fname), 'block', nfiles=nfiles)
+                        # elapsed time and resource usage of the reduction stages
+                        timer = StageTimer()
                         # generate string with signature values
                         ssig = signature_string(signaturekeys, signature)
                         logfile = ToLogFile(basename=output_lname, verbose=verbose)
@@ -242,6 +320,8 @@ def run_calibration_step(redustep, setupdata, list_of_nights,
                         for fname in imgblock:
                             logfile.print(' - {}'.format(fname))
                         logfile.print('-> Output fname will be: {}'.format(output_fname))
+                        # reduced images may depend on a previous version
+                        recomputed = os.path.exists(output_fname)
 
                         # note: the following step must be performed before
                         # saving the combined image; otherwise, the cleanup
@@ -255,6 +335,7 @@ def run_calibration_step(redustep, setupdata, list_of_nights,
                                 msg = 'ERROR: signaturekeys have changed when reducing {} images'.format(redustep)
                                 raise SystemError(msg)
 
+                        mjdobs_to_be_deleted = []
                         if ssig not in database[redustep]:
                             # update main database with new signature if not present
                             database[redustep][ssig] = dict()
@@ -264,8 +345,11 @@ def run_calibration_step(redustep, setupdata, list_of_nights,
                             # some entries of the main database must be removed
                             # and the associated reduced images deleted
                             if len(database[redustep][ssig]) > 0:
-                                mjdobs_to_be_deleted = []
                                 for mjdobs in database[redustep][ssig]:
+                                    # super-masters (see run_supermaster_step) share their
+                                    # individual images with the nightly calibrations
+                                    if database[redustep][ssig][mjdobs].get('supermaster', False):
+                                        continue
                                     old_originf = database[redustep][ssig][mjdobs]['originf']
                                     # is there a conflict?
                                     conflict = list(set(originf) & set(old_originf))
@@ -276,6 +360,8 @@ def run_calibration_step(redustep, setupdata, list_of_nights,
                                         if os.path.exists(fname):
                                             logfile.print('Deleting {}'.format(fname))
                                             os.remove(fname)
+                                            if fname != output_fname:
+                                                depindex.warn_outdated(fname, logfile)
                                         if os.path.exists(mname):
                                             logfile.print('Deleting {}'.format(mname))
                                             os.remove(mname)
@@ -298,9 +384,10 @@ def run_calibration_step(redustep, setupdata, list_of_nights,
                             fname = imgblock[i]
                             basename = os.path.basename(fname)
                             exptime[i] = imagedb[redustep][basename]['EXPTIME']
-                            with fits.open(fname) as hdulist:
-                                image_header = hdulist[0].header
-                                image_data = hdulist[0].data
+                            with timer.stage('fits_read'):
+                                with fits.open(fname) as hdulist:
+                                    image_header = hdulist[0].header
+                                    image_data = hdulist[0].data
                             if i == 0:
                                 output_header = image_header
                                 output_header.add_history("---")
@@ -338,15 +425,17 @@ def run_calibration_step(redustep, setupdata, list_of_nights,
                         # ---------------------------------------------------------
                         if redustep == 'bias':
                             # median combination
-                            image2d = np.median(image3d, axis=0)
+                            with timer.stage('combine'):
+                                image2d = np.median(image3d, axis=0)
                             output_header.add_history('Combination method: median')
                             # compute statistical analysis and update the image header
-                            image2d_statsumm = statsumm(
-                                image2d=image2d,
-                                header=output_header,
-                                redustep=redustep,
-                                rm_nan=True
-                            )
+                            with timer.stage('statsumm'):
+                                image2d_statsumm = statsumm(
+                                    image2d=image2d,
+                                    header=output_header,
+                                    redustep=redustep,
+                                    rm_nan=True
+                                )
                             mask2d = None
                         # ---------------------------------------------------------
                         elif redustep == 'flat-imaging':
@@ -354,16 +443,18 @@ def run_calibration_step(redustep, setupdata, list_of_nights,
                             basicreduction = instconf['imagetypes'][redustep]['basicreduction']
                             if basicreduction:
                                 mjdobs = output_header['MJD-OBS']
-                                # retrieve master bias
-                                ierr_bias, delta_mjd_bias, image2d_bias, bias_fname = retrieve_calibration(
-                                        instrument, 'bias', signature, mjdobs, logfile=logfile)
-                                # subtract bias
-                                output_header.add_history('Subtracting master bias:')
-                                output_header.add_history(bias_fname)
-                                if debug:
-                                    logfile.print('bias level:', np.median(image2d_bias))
-                                for i in range(nfiles):
-                                    image3d[i, :, :] -= image2d_bias
+                                with timer.stage('bias'):
+                                    # retrieve master bias
+                                    ierr_bias, delta_mjd_bias, image2d_bias, bias_fname = retrieve_calibration(
+                                            instrument, 'bias', signature, mjdobs, logfile=logfile,
+                                            use_supermasters=use_supermasters)
+                                    # subtract bias
+                                    output_header.add_history('Subtracting master bias:')
+                                    output_header.add_history(bias_fname)
+                                    if debug:
+                                        logfile.print('bias level:', np.median(image2d_bias))
+                                    for i in range(nfiles):
+                                        image3d[i, :, :] -= image2d_bias
                                 # stack all the images for the computation of a single mask
                                 # for all the individual images
                                 image2d = np.sum(image3d, axis=0)
@@ -374,10 +465,13 @@ def run_calibration_step(redustep, setupdata, list_of_nights,
                                     msg = 'WARNING: mediansignal={} is not > 0'.format(mediansignal)
                                     logfile.print(msg)
                                     ierr_flat = 1
-                                mask2d = maskfromflat(image2d)
+                                with timer.stage('maskfromflat'):
+                                    mask2d = maskfromflat(image2d)
                                 for i in range(nfiles):
                                     # perform statistical analysis in useful region
-                                    image2d_statsumm = statsumm(image2d=image3d[i, :, :], mask2d=mask2d, rm_nan=True)
+                                    with timer.stage('statsumm'):
+                                        image2d_statsumm = statsumm(image2d=image3d[i, :, :], mask2d=mask2d,
+                                                                    rm_nan=True)
                                     # normalize by the median value in the useful region
                                     mediansignal = image2d_statsumm['QUANT500']
                                     logfile.print('Median value in frame #{}/{}: {}'.format(i+1, nfiles, mediansignal))
@@ -391,33 +485,37 @@ def run_calibration_step(redustep, setupdata, list_of_nights,
                                 msg = 'WARNING: skipping basic reduction when generating {}'.format(output_fname)
                                 logfile.print(msg)
                             # median combination of normalized images
-                            image2d = np.median(image3d, axis=0)
+                            with timer.stage('combine'):
+                                image2d = np.median(image3d, axis=0)
                             # set to 1.0 pixels with values <= 0
                             image2d[image2d <= 0.0] = 1.0
                             output_header.add_history('Combination method: median of normalized images')
                             # perform statistical analysis in the useful region and update the image header
-                            mask2d = maskfromflat(image2d)
-                            image2d_statsumm = statsumm(
-                                image2d=image2d,
-                                mask2d=mask2d,
-                                header=output_header,
-                                redustep=redustep,
-                                rm_nan=True
-                            )
+                            with timer.stage('maskfromflat'):
+                                mask2d = maskfromflat(image2d)
+                            with timer.stage('statsumm'):
+                                image2d_statsumm = statsumm(
+                                    image2d=image2d,
+                                    mask2d=mask2d,
+                                    header=output_header,
+                                    redustep=redustep,
+                                    rm_nan=True
+                                )
                         # ---------------------------------------------------------
                         else:
                             msg = '* ERROR: combination of {} not implemented yet'.format(redustep)
                             raise SystemError(msg)
 
                         # save result
-                        hdu = fits.PrimaryHDU(image2d, output_header)
-                        hdu.writeto(output_fname, overwrite=True)
-                        logfile.print('Creating {}'.format(output_fname), f=True)
-                        # save mask
-                        if mask2d is not None:
-                            hdu = fits.PrimaryHDU(mask2d, output_header)
-                            hdu.writeto(output_mname, overwrite=True)
-                            logfile.print('Creating {}'.format(output_mname), f=True)
+                        with timer.stage('fits_write'):
+                            hdu = fits.PrimaryHDU(image2d, output_header)
+                            hdu.writeto(output_fname, overwrite=True)
+                            logfile.print('Creating {}'.format(output_fname), f=True)
+                            # save mask
+                            if mask2d is not None:
+                                hdu = fits.PrimaryHDU(mask2d, output_header)
+                                hdu.writeto(output_mname, overwrite=True)
+                                logfile.print('Creating {}'.format(output_mname), f=True)
 
                         # update database with result using the mean MJD-OBS of
                         # the combined images as index
@@ -435,6 +533,7 @@ def run_calibration_step(redustep, setupdata, list_of_nights,
                         database[redustep][ssig][mjdobs]['masterkeywords'] = dumdict
                         database[redustep][ssig][mjdobs]['norigin'] = nfiles
                         database[redustep][ssig][mjdobs]['originf'] = originf
+                        database[redustep][ssig][mjdobs]['provenance'] = provenance
                         if ierr_bias is not None:
                             database[redustep][ssig][mjdobs]['ierr_bias'] = ierr_bias
                         if delta_mjd_bias is not None:
@@ -443,6 +542,17 @@ def run_calibration_step(redustep, setupdata, list_of_nights,
                             database[redustep][ssig][mjdobs]['bias_fname'] = bias_fname
                         if ierr_flat is not None:
                             database[redustep][ssig][mjdobs]['ierr_flat'] = ierr_flat
+                        timings = timer.summary()
+                        database[redustep][ssig][mjdobs]['timings'] = timings
+                        # commit block to the journal
+                        journal.commit(signaturekeys, ssig, mjdobs, database[redustep][ssig][mjdobs],
+                                       mjdobs_to_be_deleted)
+
+                        # update reverse index of master calibrations
+                        if recomputed:
+                            depindex.warn_outdated(output_fname, logfile)
+                        depindex.register(output_fname, [bias_fname])
+                        timer.print_summary(logfile, timings)
 
                         # close logfile
                         datetime_end = datetime.datetime.now()
@@ -450,6 +560,7 @@ def run_calibration_step(redustep, setupdata, list_of_nights,
                         logfile.print('-> Reduction ends at...: {}'.format(datetime_end))
                         logfile.print('-> Time span...........: {}'.format(datetime_end - datetime_ini))
                         logfile.close()
+                        span_end(os.path.basename(output_fname), 'block')
 
                     # set to reduced status the images that have been reduced
                     for key in imgblock:
@@ -466,7 +577,7 @@ def run_calibration_step(redustep, setupdata, list_of_nights,
             # skipping night (no images of sought type found)
             if verbose:
                 print('No {} images found. Skipping night!'.format(redustep))
+        span_end(night, 'night')
 
     # update results database
-    with open(databasefile, 'w') as outfile:
-        json.dump(database, outfile, indent=2)
+    journal.checkpoint(database)
@@ -15,22 +15,115 @@ import numpy as np
 import os
 import sys
 
-from .cmdexecute import CmdExecute
+from .dependants import DependantsIndex
+from .gaia_prefetch import GaiaPrefetcher
+from .gaia_prefetch import pointings_from_imagedb
+from .instrumentation import StageTimer
+from .instrumentation import span_begin
+from .instrumentation import span_end
+from .journal import load_database
 from .maskfromflat import maskfromflat
+from .plot_astrometry import wait_background_plots
+from .provenance import provenance_hash
+from .retrieve_calibration import calibration_fname
 from .retrieve_calibration import retrieve_calibration
+from .run_astrometry import radec_deg
 from .run_astrometry import run_astrometry
 from .run_astrometry import save_auxfiles
 from .signature import getkey_from_signature
+from .signature import signature_string
+from .staging import COPY
+from .staging import stage_file
 from .statsumm import statsumm
 from .tologfile import ToLogFile
 from .version import version
 
 from filabres import LISTDIR
 SATURATION_LEVEL = 65000
+# enlargement of the field of view when retrieving GAIA data
+FIELDFACTOR = 1.1
+# solve-field pvalues employed when not set in the instrument configuration
+DEFAULT_PVALUES = {
+    'cafos': [2, 3, 1, 0, 4, 5, 6],
+    'lsss': [6, 7, 8, 5, 4, 3, 2, 9]
+}
+
+
+def image_provenance(redustep, fname, imagedb, imgsignature, input_fname, instconf, setupdata, no_astrometry,
+                     caldatabases=None):
+    """
+    Provenance of a reduced science image: original file, master
+    calibrations, instrument configuration and setup.
+
+    Parameters
+    ----------
+    redustep : str
+        Reduction step.
+    fname : str
+        Original file name (without path).
+    imagedb : dict
+        Image database of the corresponding night.
+    imgsignature : dict
+        Signature of the image.
+    input_fname : str
+        Original file name (with path).
+    instconf : dict
+        Instrument configuration.
+    setupdata : dict
+        Setup data.
+    no_astrometry : bool
+        If True, the astrometric calibration is not performed.
+    caldatabases : dict or None
+        Calibration databases already loaded, using the reduction step
+        as key (see load_calibration_databases()).
+
+    Returns
+    -------
+    provenance : str
+        Provenance hash (see provenance_hash()).
+    """
+    instrument = instconf['instname']
+    if caldatabases is None:
+        caldatabases = dict()
+    calibration_fnames = []
+    if instconf['imagetypes'][redustep]['basicreduction']:
+        mjdobs = imagedb[redustep][fname]['MJD-OBS']
+        for calstep in ['bias', 'flat-imaging']:
+            calibration_fnames.append(calibration_fname(instrument, calstep, imgsignature, mjdobs,
+                                                        use_supermasters=setupdata.get('use_supermasters', False),
+                                                        database=caldatabases.get(calstep)))
+    return provenance_hash([input_fname], calibration_fnames, instconf, redustep, setupdata,
+                           options={'no_astrometry': no_astrometry})
+
+
+def load_calibration_databases(instrument):
+    """
+    Load the calibration databases employed to reduce science images.
+
+    Parameters
+    ----------
+    instrument : str
+        Instrument name.
+
+    Returns
+    -------
+    caldatabases : dict
+        Bias and flat-imaging databases (None when not available),
+        using the reduction step as key.
+    """
+    caldatabases = dict()
+    for calstep in ['bias', 'flat-imaging']:
+        databasefile = 'filabres_db_{}_{}.json'.format(instrument, calstep)
+        try:
+            caldatabases[calstep] = load_database(databasefile, calstep)
+        except FileNotFoundError:
+            caldatabases[calstep] = None
+    return caldatabases
 
 
 def run_reduction_step(redustep, interactive, setupdata, list_of_nights, filename,
                        no_astrometry, no_reuse_gaia, instconf, force,
+                       prefetch_gaia=None, pvalue_trials=None, astrometry_plots=None, force_if_changed=False,
                        verbose=False, debug=False):
     """
     Execute reduction step.
@@ -57,6 +150,20 @@ def run_reduction_step(redustep, interactive, setupdata, list_of_nights, filenam
         details.
     force : bool
         If True, recompute reduction of calibration images.
+    prefetch_gaia : int or None
+        If not None, the GAIA data required by the astrometric
+        calibration of all the selected nights are retrieved in
+        advance, performing this number of simultaneous queries.
+    pvalue_trials : int or None
+        If larger than 1, number of P values (scale numbers of the
+        index files) tried simultaneously when solving the field with
+        Astrometry.net.
+    astrometry_plots : str or None
+        Generation of the plots of the astrometric calibration: 'now'
+        (default), 'background' or 'none'.
+    force_if_changed : bool
+        If True, recompute the reduction of the images whose
+        provenance (see provenance_hash()) has changed.
     verbose : bool
         If True, display intermediate information.
     debug : bool
@@ -71,6 +178,16 @@ def run_reduction_step(redustep, interactive, setupdata, list_of_nights, filenam
             raise SystemError(msg)
 
     instrument = instconf['instname']
+    # prefer the super-masters when retrieving the calibrations
+    use_supermasters = setupdata.get('use_supermasters', False)
+
+    # reverse index: reduced images depending on each master calibration
+    depindex = DependantsIndex(instrument)
+
+    # calibration databases (read only once)
+    caldatabases = dict()
+    if instconf['imagetypes'][redustep]['basicreduction']:
+        caldatabases = load_calibration_databases(instrument)
 
     # check for subdirectory in current directory to store results
     if os.path.isdir(redustep):
@@ -89,11 +206,62 @@ def run_reduction_step(redustep, interactive, setupdata, list_of_nights, filenam
 
     # define signature keys
     signaturekeys = instconf['imagetypes'][redustep]['signature']
+    # signature keys excluding the pointing (employed to reuse the WCS
+    # solution of previous images of the same field)
+    instrument_keys = [key for key in signaturekeys if key not in ['RA', 'DEC']]
+
+    # retrieve in advance (in a background thread) the GAIA data
+    # required by the astrometric calibration of all the nights
+    prefetcher = None
+    if prefetch_gaia is not None and not no_astrometry and not no_reuse_gaia:
+        if 'maxfieldview_arcmin' not in instconf['imagetypes'][redustep]:
+            msg = 'maxfieldview_arcmin missing in instrument configuration'
+            raise SystemError(msg)
+        maxfieldview_arcmin = instconf['imagetypes'][redustep]['maxfieldview_arcmin']
+        prefetcher = GaiaPrefetcher(setupdata=setupdata, nqueries=prefetch_gaia, verbose=verbose)
+        for night in list_of_nights:
+            jsonfname = LISTDIR + night + '/imagedb_' + instrument + '.json'
+            if not os.path.isfile(jsonfname):
+                continue
+            with open(jsonfname) as jfile:
+                imagedb = json.load(jfile)
+            nightdir = redustep + '/' + night
+            # results database of the night (to check the provenance of
+            # the images already reduced)
+            database = dict()
+            databasefile = nightdir + '/filabres_db_{}_{}.json'.format(instrument, redustep)
+            if force_if_changed and os.path.isfile(databasefile):
+                with open(databasefile) as jfile:
+                    database = json.load(jfile)
+            list_of_images = []
+            for fname in sorted(imagedb.get(redustep, {})):
+                if filename is not None and fname != filename:
+                    continue
+                output_fname = nightdir + '/' + redustep + '_' + fname[:-5] + '_red.fits'
+                if force or not os.path.exists(output_fname):
+                    list_of_images.append(fname)
+                elif force_if_changed:
+                    # same decision as in the reduction loop below
+                    imgsignature = dict()
+                    for keyword in signaturekeys:
+                        imgsignature[keyword] = imagedb[redustep][fname][keyword]
+                    provenance = image_provenance(redustep, fname, imagedb, imgsignature,
+                                                  datadir + night + '/' + fname, instconf, setupdata,
+                                                  no_astrometry, caldatabases)
+                    previous = database.get(redustep, dict()).get(fname, dict()).get('provenance')
+                    if previous != provenance:
+                        list_of_images.append(fname)
+            if len(list_of_images) > 0:
+                os.makedirs(nightdir, exist_ok=True)
+                pointings = pointings_from_imagedb(imagedb, redustep, list_of_images, instrument)
+                prefetcher.add_night(nightdir, pointings, maxfieldview_arcmin, FIELDFACTOR)
+        prefetcher.start()
 
     # loop in night
     for inight, night in enumerate(list_of_nights):
 
         print('\n* Working with night {} ({}/{})'.format(night, inight + 1, len(list_of_nights)))
+        span_begin(night, 'night')
 
         # read local image database for current night
         jsonfname = LISTDIR + night + '/imagedb_'
@@ -139,8 +307,13 @@ def run_reduction_step(redustep, interactive, setupdata, list_of_nights, filenam
                     print('Subdirectory {} not found. Creating it!'.format(nightdir))
                 os.makedirs(nightdir)
 
+            # install the GAIA data retrieved in advance
+            if prefetcher is not None:
+                prefetcher.wait(nightdir)
+
             # execute reduction for all the selected files
             for ifname, fname in enumerate(list_of_images):
+                span_begin(fname, 'image')
                 # define ToLogFile object
                 logfile = ToLogFile(workdir=nightdir, basename='reduction.log', verbose=verbose)
                 logfile.print('\nBasic reduction of {}'.format(fname))
@@ -171,15 +344,33 @@ def run_reduction_step(redustep, interactive, setupdata, list_of_nights, filenam
                 logfile.print('-> Output file name will be: {}'.format(output_fname), f=True)
                 datetime_ini = datetime.datetime.now()
                 logfile.print('-> Reduction starts at.....: {}'.format(datetime_ini), f=True)
+
+                # signature of particular image
+                imgsignature = dict()
+                for keyword in signaturekeys:
+                    imgsignature[keyword] = imagedb[redustep][fname][keyword]
+
+                # the provenance is only computed when it is needed
+                provenance = None
                 if os.path.exists(output_fname) and not force:
                     execute_reduction = False
-                    logfile.print('File {} already exists: skipping reduction.'.format(output_fname), f=True)
+                    if force_if_changed:
+                        provenance = image_provenance(redustep, fname, imagedb, imgsignature, input_fname, instconf,
+                                                      setupdata, no_astrometry, caldatabases)
+                        previous = database.get(redustep, dict()).get(fname, dict()).get('provenance')
+                        if previous != provenance:
+                            execute_reduction = True
+                            logfile.print('Provenance of {} has changed: repeating reduction.'.format(output_fname),
+                                          f=True)
+                    if not execute_reduction:
+                        logfile.print('File {} already exists: skipping reduction.'.format(output_fname), f=True)
 
                 if execute_reduction:
-                    # signature of particular image
-                    imgsignature = dict()
-                    for keyword in signaturekeys:
-                        imgsignature[keyword] = imagedb[redustep][fname][keyword]
+                    if provenance is None:
+                        provenance = image_provenance(redustep, fname, imagedb, imgsignature, input_fname, instconf,
+                                                      setupdata, no_astrometry, caldatabases)
+                    # elapsed time and resource usage of the reduction stages
+                    timer = StageTimer()
 
                     # note: the following step must be performed before
                     # saving the combined image; otherwise, the cleanup
@@ -198,9 +389,10 @@ def run_reduction_step(redustep, interactive, setupdata, list_of_nights, filenam
                     naxis2 = getkey_from_signature(imgsignature, 'NAXIS2')
                     image2d_saturpix = np.zeros((naxis2, naxis1), dtype=bool)
 
-                    with fits.open(input_fname) as hdulist:
-                        image_header = hdulist[0].header
-                        image2d = hdulist[0].data.astype(float)
+                    with timer.stage('fits_read'):
+                        with fits.open(input_fname) as hdulist:
+                            image_header = hdulist[0].header
+                            image2d = hdulist[0].data.astype(float)
                     output_header = image_header
                     output_header.add_history("---")
                     output_header.add_history('Using filabres v.{}'.format(version))
@@ -242,23 +434,28 @@ def run_reduction_step(redustep, interactive, setupdata, list_of_nights, filenam
                         if basicreduction:
                             mjdobs = output_header['MJD-OBS']
                             # retrieve and subtract bias
-                            ierr_bias, delta_mjd_bias, image2d_bias, bias_fname = retrieve_calibration(
-                                    instrument, 'bias', imgsignature, mjdobs, logfile=logfile)
-                            output_header.add_history('Subtracting master bias:')
-                            output_header.add_history(bias_fname)
-                            if debug:
-                                logfile.print('bias level: {}'.format(np.median(image2d_bias)), f=True)
-                            image2d -= image2d_bias
+                            with timer.stage('bias'):
+                                ierr_bias, delta_mjd_bias, image2d_bias, bias_fname = retrieve_calibration(
+                                        instrument, 'bias', imgsignature, mjdobs, logfile=logfile,
+                                        use_supermasters=use_supermasters, database=caldatabases['bias'])
+                                output_header.add_history('Subtracting master bias:')
+                                output_header.add_history(bias_fname)
+                                if debug:
+                                    logfile.print('bias level: {}'.format(np.median(image2d_bias)), f=True)
+                                image2d -= image2d_bias
                             # retrieve and divide by flatfield
-                            ierr_flat, delta_mjd_flat, image2d_flat, flat_fname = retrieve_calibration(
-                                    instrument, 'flat-imaging', imgsignature, mjdobs, logfile=logfile)
-                            output_header.add_history('Applying master flatfield:')
-                            output_header.add_history(flat_fname)
-                            if debug:
-                                logfile.print('flat level: {}'.format(np.median(image2d_flat)), f=True)
-                            image2d /= image2d_flat
+                            with timer.stage('flat'):
+                                ierr_flat, delta_mjd_flat, image2d_flat, flat_fname = retrieve_calibration(
+                                        instrument, 'flat-imaging', imgsignature, mjdobs, logfile=logfile,
+                                        use_supermasters=use_supermasters, database=caldatabases['flat-imaging'])
+                                output_header.add_history('Applying master flatfield:')
+                                output_header.add_history(flat_fname)
+                                if debug:
+                                    logfile.print('flat level: {}'.format(np.median(image2d_flat)), f=True)
+                                image2d /= image2d_flat
                             # generate useful region mask from flatfield
-                            mask2d = maskfromflat(image2d_flat)
+                            with timer.stage('maskfromflat'):
+                                mask2d = maskfromflat(image2d_flat)
                             if debug:
                                 logfile.print('masked pixels: {}/{}'.format(np.sum(mask2d == 0.0), naxis1 * naxis2),
                                               f=True)
@@ -269,16 +466,18 @@ def run_reduction_step(redustep, interactive, setupdata, list_of_nights, filenam
                         # apply useful region mask
                         image2d *= mask2d
                         # compute statistical analysis and update the image header
-                        image2d_statsumm = statsumm(
-                            image2d=image2d,
-                            mask2d=mask2d,
-                            header=output_header,
-                            redustep=redustep,
-                            rm_nan=True)
+                        with timer.stage('statsumm'):
+                            image2d_statsumm = statsumm(
+                                image2d=image2d,
+                                mask2d=mask2d,
+                                header=output_header,
+                                redustep=redustep,
+                                rm_nan=True)
                         if no_astrometry:
                             workdir = nightdir + '/work'
-                            hdu = fits.PrimaryHDU(image2d, output_header)
-                            hdu.writeto(output_fname, overwrite=True)
+                            with timer.stage('fits_write'):
+                                hdu = fits.PrimaryHDU(image2d, output_header)
+                                hdu.writeto(output_fname, overwrite=True)
                             logfile.print('-> Skipping astrometric calibration')
                             logfile.print('-> file {} created'.format(output_fname))
                             save_auxfiles(output_fname=output_fname, nightdir=nightdir, workdir=workdir,
@@ -293,36 +492,34 @@ def run_reduction_step(redustep, interactive, setupdata, list_of_nights, filenam
                             else:
                                 msg = 'maxfieldview_arcmin missing in instrument configuration'
                                 raise SystemError(msg)
-                            # define possible P values for build-astrometry-index (scale number)
+                            # possible P values for build-astrometry-index (scale number)
                             # in the order to be employed (if one fails, the next one is used)
-                            # [see help of build-astrometry-index for details]; in addition, convert
-                            # RA and DEC to DD.ddddd +/- DD.ddddd when necessary
-                            if instrument == 'cafos':
-                                pvalues = [2, 3, 1, 0, 4, 5, 6]
-                            elif instrument == 'lsss':
-                                pvalues = [6, 7, 8, 5, 4, 3, 2, 9]
-                                ra_initial = output_header['ra']
-                                ra_h, ra_m, ra_s = ra_initial.split()
-                                ra_final = (float(ra_h) + float(ra_m)/60.0 + float(ra_s)/3600.0) * 15
-                                output_header['ra'] = ra_final
-                                dec_initial = output_header['dec']
-                                dec_sign = dec_initial[0]
-                                dec_d, dec_m, dec_s = dec_initial[1:].split()
-                                dec_final = (float(dec_d) + float(dec_m)/60.0 + float(dec_s)/3600.0)
-                                if dec_sign == '-':
-                                    dec_final = -dec_final
-                                output_header['dec'] = dec_final
-                            else:
+                            # [see help of build-astrometry-index for details], and additional
+                            # solve-field options, are defined in the instrument configuration
+                            astroconf = instconf.get('astrometry', dict())
+                            pvalues = astroconf.get('pvalues', DEFAULT_PVALUES.get(instrument))
+                            if pvalues is None:
+                                msg = 'pvalues missing in astrometry section of instrument configuration'
+                                raise SystemError(msg)
+                            # convert RA and DEC to DD.ddddd +/- DD.ddddd when necessary
+                            if instrument == 'lsss':
+                                output_header['ra'], output_header['dec'] = radec_deg(
+                                    instrument, output_header['ra'], output_header['dec'])
+                            elif instrument != 'cafos':
                                 msg = 'ERROR: instrument not included here!'
                                 raise SystemError(msg)
                             ierr_astr, astrsumm1, astrsumm2 = run_astrometry(
                                 image2d=image2d, mask2d=mask2d, saturpix=image2d_saturpix,
                                 header=output_header,
                                 no_reuse_gaia=no_reuse_gaia,
-                                maxfieldview_arcmin=maxfieldview_arcmin, fieldfactor=1.1, pvalues=pvalues,
+                                maxfieldview_arcmin=maxfieldview_arcmin, fieldfactor=FIELDFACTOR, pvalues=pvalues,
                                 nightdir=nightdir, output_fname=output_fname,
                                 setupdata=setupdata,
-                                interactive=interactive, logfile=logfile, debug=False
+                                interactive=interactive, logfile=logfile, debug=False,
+                                timer=timer, pvalue_trials=pvalue_trials,
+                                astrometry_plots=astrometry_plots,
+                                signature=signature_string(instrument_keys, imgsignature),
+                                astroconf=astroconf
                             )
                     # ---------------------------------------------------------
                     else:
@@ -346,6 +543,7 @@ def run_reduction_step(redustep, interactive, setupdata, list_of_nights, filenam
                     database[redustep][fname]['ierr_flat'] = ierr_flat
                     database[redustep][fname]['delta_mjd_flat'] = delta_mjd_flat
                     database[redustep][fname]['flat_fname'] = flat_fname
+                    database[redustep][fname]['provenance'] = provenance
                     database[redustep][fname]['ierr_astr'] = ierr_astr
                     if astrsumm1 is not None:
                         database[redustep][fname]['astr1_pixscale'] = astrsumm1.pixscale
@@ -355,6 +553,10 @@ def run_reduction_step(redustep, interactive, setupdata, list_of_nights, filenam
                         database[redustep][fname]['astr2_pixscale'] = astrsumm2.pixscale
                         database[redustep][fname]['astr2_ntargets'] = astrsumm2.ntargets
                         database[redustep][fname]['astr2_meanerr'] = astrsumm2.meanerr
+                    timings = timer.summary()
+                    database[redustep][fname]['timings'] = timings
+                    timer.print_summary(logfile, timings)
+                    depindex.register(output_fname, [bias_fname, flat_fname])
 
                 # update results database
                 with open(databasefile, 'w') as outfile:
@@ -372,12 +574,12 @@ def run_reduction_step(redustep, interactive, setupdata, list_of_nights, filenam
                     backupsubdir = basename[:-5]
                     backupsubdirfull = '{}/{}'.format(nightdir, backupsubdir)
                     if os.path.isdir(backupsubdirfull):
-                        command = 'cp {} {}/'.format(logfile.fname, backupsubdirfull)
-                        cmd = CmdExecute()
-                        cmd.run(command)
+                        # copy (the log file is rewritten in place for the next image)
+                        stage_file(logfile.fname, backupsubdirfull, mode=COPY)
                     else:
                         msg = 'ERROR: espected subdir {} not found'.format(backupsubdirfull)
                         raise SystemError(msg)
+                span_end(fname, 'image')
 
                 if interactive:
                     ckey = input("Press 'x' + <ENTER> to stop, or simply <ENTER> to continue... ")
@@ -387,3 +589,8 @@ def run_reduction_step(redustep, interactive, setupdata, list_of_nights, filenam
         else:
             # skipping night (no images of sought type found)
             print('No {} images found. Skipping night!'.format(redustep))
+        span_end(night, 'night')
+
+    # wait for the plots generated in background
+    if astrometry_plots == 'background':
+        wait_background_plots(verbose=verbose)
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2020 Universidad Complutense de Madrid
+#
+# This file is part of filabres
+#
+# SPDX-License-Identifier: GPL-3.0+
+# License-Filename: LICENSE.txt
+#
+
+"""
+Reference distortion solutions computed with SCAMP.
+
+The geometric distortion of an instrument configuration (detector,
+binning, filter,...) does not change from image to image. For each image
+signature (ignoring the pointing), the TPV distortion terms (PVi_j) of the
+best SCAMP solution obtained so far (largest number of targets) are kept
+in the reduction step directory as a text header
+(scamp_reference_<hash>.ahead), registered in scamp_references.json.
+This reference is given to SCAMP as an a priori header (xxx.ahead) for
+subsequent images with the same signature. In sparse fields only the
+linear terms are fitted by SCAMP, and the reference distortion terms are
+adopted in the final solution.
+"""
+
+import hashlib
+import json
+import os
+
+REFERENCES_FNAME = 'scamp_references.json'
+
+# minimum number of targets of a solution employed as reference
+MIN_NTARGETS_REFERENCE = 100
+# fields with fewer targets (Astrometry.net solution) are considered
+# sparse: only the linear terms are fitted when a reference is available
+MAX_NTARGETS_LINEAR = 50
+
+
+def read_distortion(fname):
+    """
+    Read the distortion terms (PVi_j) of a SCAMP header.
+
+    Parameters
+    ----------
+    fname : str
+        File name (text header generated by SCAMP).
+
+    Returns
+    -------
+    cards : list of str
+        Header lines with the PVi_j keywords.
+    """
+    cards = []
+    with open(fname) as headfile:
+        for line in headfile:
+            kwd = line[:8].strip()
+            if kwd == 'END':
+                break
+            if kwd.startswith('PV'):
+                cards.append(line.rstrip('\n'))
+    return cards
+
+
+def write_ahead(reffname, outfname):
+    """
+    Write a priori header for SCAMP with the reference distortion.
+
+    Parameters
+    ----------
+    reffname : str
+        File name of the reference distortion.
+    outfname : str
+        Output file name (e.g. xxx.ahead for xxx.ldac).
+    """
+    with open(outfname, 'wt') as f:
+        f.write('{:8s}= {:20s} / {}\n'.format('CTYPE1', "'RA---TPV'", 'WCS projection type for this axis'))
+        f.write('{:8s}= {:20s} / {}\n'.format('CTYPE2', "'DEC--TPV'", 'WCS projection type for this axis'))
+        for card in read_distortion(reffname):
+            f.write(card + '\n')
+        f.write('END\n')
+
+
+def replace_distortion(headfname, reffname):
+    """
+    Replace the distortion terms of a SCAMP header by the reference ones.
+
+    The remaining keywords (e.g. the linear terms CRVALi, CRPIXi and
+    CDi_j fitted by SCAMP) are preserved.
+
+    Parameters
+    ----------
+    headfname : str
+        File name of the header generated by SCAMP (e.g. xxx.head).
+    reffname : str
+        File name of the reference distortion.
+    """
+    with open(headfname) as headfile:
+        lines = [line.rstrip('\n') for line in headfile]
+    iend = [i for i, line in enumerate(lines) if line[:8].strip() == 'END']
+    iend = iend[0] if iend else len(lines)
+    lines = [line for line in lines[:iend] if not line[:8].strip().startswith('PV')]
+    lines += read_distortion(reffname) + ['END']
+    with open(headfname, 'wt') as headfile:
+        headfile.write('\n'.join(lines) + '\n')
+
+
+class ScampReference(object):
+    """
+    Reference distortion solutions for the different image signatures.
+
+    Parameters
+    ----------
+    refdir : str
+        Directory where the reference solutions are stored (the
+        reduction step directory, common to all the nights).
+    """
+    def __init__(self, refdir):
+        self.refdir = refdir
+        self.entries = dict()
+        jsonfname = os.path.join(refdir, REFERENCES_FNAME)
+        if os.path.exists(jsonfname):
+            with open(jsonfname) as jfile:
+                self.entries = json.load(jfile)
+
+    def fname(self, signature):
+        """Return file name of the reference solution for a signature."""
+        sha1 = hashlib.sha1(signature.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.refdir, 'scamp_reference_{}.ahead'.format(sha1))
+
+    def get(self, signature):
+        """
+        Return file name of the reference solution (None if not available).
+
+        Parameters
+        ----------
+        signature : str
+            Signature of the image (see signature_string()).
+        """
+        if signature not in self.entries or not os.path.isfile(self.fname(signature)):
+            return None
+        return self.fname(signature)
+
+    def update(self, signature, headfname, ntargets, meanerr, image, logfile,
+               min_ntargets=MIN_NTARGETS_REFERENCE):
+        """
+        Store a SCAMP solution when it improves the current reference.
+
+        Parameters
+        ----------
+        signature : str
+            Signature of the image (see signature_string()).
+        headfname : str
+            File name of the header generated by SCAMP (e.g. xxx.head).
+        ntargets : int
+            Number of targets of the SCAMP solution.
+        meanerr : float
+            Mean error (arcsec) of the SCAMP solution.
+        image : str
+            Name of the reduced image.
+        logfile : instance of ToLogFile
+            Logfile to store reduction information.
+        min_ntargets : int
+            Minimum number of targets of a reference solution.
+
+        Returns
+        -------
+        updated : bool
+            True if the reference solution has been updated.
+        """
+        if ntargets < min_ntargets:
+            return False
+        if signature in self.entries and self.get(signature) is not None:
+            if ntargets <= self.entries[signature]['ntargets']:
+                return False
+        reffname = self.fname(signature)
+        with open(reffname + '.tmp', 'wt') as f:
+            for card in read_distortion(headfname):
+                f.write(card + '\n')
+            f.write('END\n')
+        os.replace(reffname + '.tmp', reffname)
+        self.entries[signature] = {
+            'ntargets': int(ntargets),
+            'meanerr': float(meanerr),
+            'image': image
+        }
+        jsonfname = os.path.join(self.refdir, REFERENCES_FNAME)
+        with open(jsonfname + '.tmp', 'wt') as jfile:
+            json.dump(self.entries, jfile, indent=2)
+        os.replace(jsonfname + '.tmp', jsonfname)
+        logfile.print('-> Reference SCAMP distortion updated: {}'.format(reffname))
+        return True
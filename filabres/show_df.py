@@ -8,12 +8,6 @@
 # License-Filename: LICENSE.txt
 #
 
-import matplotlib.pyplot as plt
-import pandas as pd
-from pandas.plotting import scatter_matrix
-
-from .ximshow import ximshow_file
-
 
 def show_df(df, n, list_mode, imagetype, args_keyword_sort, args_ndecimal,
             args_plotxy, args_plotimage):
@@ -63,6 +57,7 @@ def show_df(df, n, list_mode, imagetype, args_keyword_sort, args_ndecimal,
             if df.shape[0] > 0:
                 # start dataframe index at 1 instead of 0
                 df.index += 1
+                import pandas as pd
                 if args_keyword_sort is not None:
                     kwds = [item[0].upper() for item in args_keyword_sort]
                     kwds.append('file')
@@ -80,6 +75,8 @@ def show_df(df, n, list_mode, imagetype, args_keyword_sort, args_ndecimal,
             if df.shape[0] > 0:
                 # scatter plots
                 if args_plotxy:
+                    import matplotlib.pyplot as plt
+                    from pandas.plotting import scatter_matrix
                     # remove the 'file' column and convert to float the remaining columns
                     scatter_matrix(df.drop(['file'], axis=1).astype(float, errors='ignore'))
                     print('Press "q" to continue...', end='')
@@ -89,6 +86,7 @@ def show_df(df, n, list_mode, imagetype, args_keyword_sort, args_ndecimal,
                     print('')
                 # display images
                 if args_plotimage:
+                    from .ximshow import ximshow_file
                     # preserve sorted dataframe if args_keyword_sort is not None
                     for i in df.index.values:
                         fname = df.loc[i, 'file']
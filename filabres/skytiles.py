@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2020 Universidad Complutense de Madrid
+#
+# This file is part of filabres
+#
+# SPDX-License-Identifier: GPL-3.0+
+# License-Filename: LICENSE.txt
+#
+
+"""
+Partition of the celestial sphere in sky tiles.
+
+The sphere is divided in declination bands of constant height. Each band
+is divided in right ascension cells whose width (measured along the band
+edge closest to the equator) does not exceed the band height, so that
+all the tiles have similar areas (as in HEALPix, but with tile boundaries
+following meridians and parallels, which simplifies the computation of
+the tiles overlapping a cone).
+"""
+
+import numpy as np
+
+
+def angular_distance_deg(ra1_deg, dec1_deg, ra2_deg, dec2_deg):
+    """
+    Compute angular distance between two points (or arrays of points).
+
+    Parameters
+    ----------
+    ra1_deg, dec1_deg : float or numpy array
+        Coordinates (degrees) of the first point(s).
+    ra2_deg, dec2_deg : float or numpy array
+        Coordinates (degrees) of the second point(s).
+
+    Returns
+    -------
+    distance : float or numpy array
+        Angular distance (degrees), computed with the haversine formula.
+    """
+    ra1 = np.radians(ra1_deg)
+    dec1 = np.radians(dec1_deg)
+    ra2 = np.radians(ra2_deg)
+    dec2 = np.radians(dec2_deg)
+    sdec = np.sin((dec2 - dec1) / 2)
+    sra = np.sin((ra2 - ra1) / 2)
+    hav = sdec ** 2 + np.cos(dec1) * np.cos(dec2) * sra ** 2
+    return np.degrees(2 * np.arcsin(np.sqrt(np.clip(hav, 0, 1))))
+
+
+class SkyTiling(object):
+    """
+    Partition of the celestial sphere in tiles of similar area.
+
+    Each tile is identified by an integer: iband * NRA_MAX + ira.
+
+    Parameters
+    ----------
+    tile_deg : float
+        Approximate size (degrees) of the tiles.
+
+    Attributes
+    ----------
+    nbands : int
+        Number of declination bands.
+    height : float
+        Height (degrees) of each declination band.
+    nra : numpy array
+        Number of right ascension cells in each declination band.
+    """
+    NRA_MAX = 1000000
+
+    def __init__(self, tile_deg):
+        self.nbands = int(np.ceil(180 / tile_deg))
+        self.height = 180 / self.nbands
+        dec_lower = -90 + self.height * np.arange(self.nbands)
+        dec_upper = dec_lower + self.height
+        # declination closest to the equator within each band
+        dec_equator = np.where(dec_lower * dec_upper <= 0, 0, np.minimum(np.abs(dec_lower), np.abs(dec_upper)))
+        self.nra = np.maximum(1, np.ceil(360 * np.cos(np.radians(dec_equator)) / self.height)).astype(int)
+
+    @property
+    def diagonal_deg(self):
+        """Upper limit to the angular size of any tile."""
+        return self.height * np.sqrt(2)
+
+    def tile_of(self, ra_deg, dec_deg):
+        """
+        Return tile identification of each point.
+
+        Parameters
+        ----------
+        ra_deg, dec_deg : float or numpy array
+            Coordinates (degrees).
+
+        Returns
+        -------
+        tile : int or numpy array
+            Tile identification.
+        """
+        iband = np.clip(((np.asarray(dec_deg) + 90) / self.height).astype(int), 0, self.nbands - 1)
+        nra = self.nra[iband]
+        ira = np.clip((np.mod(ra_deg, 360) / 360 * nra).astype(int), 0, nra - 1)
+        return iband * self.NRA_MAX + ira
+
+    def bounds(self, tile):
+        """
+        Return boundaries of a tile.
+
+        Returns
+        -------
+        ra1, ra2, dec1, dec2 : float
+            Right ascension and declination limits (degrees).
+        """
+        iband, ira = divmod(int(tile), self.NRA_MAX)
+        width = 360 / self.nra[iband]
+        dec1 = -90 + iband * self.height
+        return ira * width, (ira + 1) * width, dec1, dec1 + self.height
+
+    def boundary_points(self, tile, npoints=9):
+        """Return coordinates of points sampling the boundary of a tile."""
+        ra1, ra2, dec1, dec2 = self.bounds(tile)
+        ra = np.linspace(ra1, ra2, npoints)
+        dec = np.linspace(dec1, dec2, npoints)
+        ra_border = np.concatenate([ra, ra, np.full(npoints, ra1), np.full(npoints, ra2)])
+        dec_border = np.concatenate([np.full(npoints, dec1), np.full(npoints, dec2), dec, dec])
+        return ra_border, dec_border
+
+    def tiles_in_cone(self, ra_deg, dec_deg, radius_deg):
+        """
+        Return tiles overlapping a cone.
+
+        Parameters
+        ----------
+        ra_deg, dec_deg : float
+            Coordinates (degrees) of the cone centre.
+        radius_deg : float
+            Cone radius (degrees).
+
+        Returns
+        -------
+        overlapping : list of int
+            Tiles overlapping the cone (the list may include a few
+            additional tiles close to the cone border).
+        inside : list of int
+            Subset of tiles fully contained within the cone.
+        """
+        # tolerance to account for the discrete sampling of the tile
+        # boundaries
+        tolerance = self.height / 8
+        iband1 = max(int((dec_deg - radius_deg + 90) / self.height), 0)
+        iband2 = min(int((dec_deg + radius_deg + 90) / self.height), self.nbands - 1)
+        if abs(dec_deg) + radius_deg >= 90:
+            delta_ra = 180
+        else:
+            delta_ra = np.degrees(np.arcsin(np.sin(np.radians(radius_deg)) / np.cos(np.radians(dec_deg))))
+        overlapping = []
+        inside = []
+        central_tile = self.tile_of(ra_deg, dec_deg)
+        for iband in range(iband1, iband2 + 1):
+            nra = self.nra[iband]
+            width = 360 / nra
+            if delta_ra >= 180 or nra == 1:
+                candidates = range(nra)
+            else:
+                ira1 = int(np.floor((ra_deg - delta_ra) / width))
+                ira2 = int(np.floor((ra_deg + delta_ra) / width))
+                candidates = sorted(set([ira % nra for ira in range(ira1, ira2 + 1)]))
+            for ira in candidates:
+                tile = iband * self.NRA_MAX + ira
+                ra_border, dec_border = self.boundary_points(tile)
+                distance = angular_distance_deg(ra_deg, dec_deg, ra_border, dec_border)
+                if tile == central_tile or np.min(distance) <= radius_deg + tolerance:
+                    overlapping.append(tile)
+                    if np.max(distance) <= radius_deg - tolerance:
+                        inside.append(tile)
+        return overlapping, inside
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2020 Universidad Complutense de Madrid
+#
+# This file is part of filabres
+#
+# SPDX-License-Identifier: GPL-3.0+
+# License-Filename: LICENSE.txt
+#
+
+"""
+Staging of auxiliary files without launching external processes.
+
+Files are preferably made available at the new location as hard links
+(no data are copied), falling back to a regular copy when the link
+cannot be created (e.g. different file systems). A hard link shares
+the contents with the original file, so it must only be employed when
+neither file is going to be modified in place (files that are replaced
+or removed, as those in the work subdirectory, are safe). The new file
+always appears atomically (os.replace).
+"""
+
+import os
+import shutil
+import threading
+
+LINK = 'link'
+COPY = 'copy'
+MOVE = 'move'
+
+
+def stage_file(src, dst, logfile=None, mode=LINK):
+    """
+    Make a file available at a new location.
+
+    Parameters
+    ----------
+    src : str
+        File name.
+    dst : str
+        New file name or existing directory.
+    logfile : instance of ToLogFile or None
+        Log file to store the performed operation.
+    mode : str
+        'link' (hard link, or copy if not possible), 'copy' or 'move'.
+
+    Returns
+    -------
+    dst : str
+        New file name.
+    """
+    if mode not in [LINK, COPY, MOVE]:
+        msg = 'Invalid staging mode: {}'.format(mode)
+        raise SystemError(msg)
+    if not os.path.isfile(src):
+        msg = 'File {} not found'.format(src)
+        raise SystemError(msg)
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+
+    done = None
+    if mode == MOVE:
+        try:
+            os.replace(src, dst)
+            done = 'moved'
+        except OSError:
+            # different file systems
+            pass
+    if done is None:
+        tmpfname = '{}.{}.{}.tmp'.format(dst, os.getpid(), threading.get_ident())
+        if mode == LINK:
+            try:
+                os.link(src, tmpfname)
+                done = 'linked'
+            except OSError:
+                pass
+        if done is None:
+            shutil.copyfile(src, tmpfname)
+            done = 'copied'
+        os.replace(tmpfname, dst)
+        if mode == MOVE:
+            os.remove(src)
+            done = 'moved'
+
+    if logfile is not None:
+        logfile.print('{} -> {} ({})'.format(src, dst, done))
+    return dst
@@ -0,0 +1,508 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2020 Universidad Complutense de Madrid
+#
+# This file is part of filabres
+#
+# SPDX-License-Identifier: GPL-3.0+
+# License-Filename: LICENSE.txt
+#
+
+"""
+Combination of calibration images from many nights into super-masters.
+
+The reduction of calibration images (run_calibration_step) combines the
+images of each night within maxtimespan_hours, keeping all of them in
+memory. Here all the images with the same signature in the selected nights
+are combined into a single master calibration, with bounded memory
+requirements: the input images are read by tiles of rows from
+memory-mapped files and spilled (after bias subtraction) into a
+disk-backed cube, from which the median is computed tile by tile.
+
+The super-masters are stored in the usual calibration database (with
+night set to 'supermaster'). When use_supermasters is set in the setup
+file, retrieve_calibration() prefers them for images observed within the
+time span of the combined images.
+"""
+
+from astropy.io import fits
+import datetime
+import json
+import numpy as np
+import os
+import sys
+
+from .dependants import DependantsIndex
+from .instrumentation import StageTimer
+from .journal import load_database
+from .journal import write_database
+from .maskfromflat import maskfromflat
+from .provenance import provenance_hash
+from .retrieve_calibration import calibration_fname
+from .retrieve_calibration import retrieve_calibration
+from .signature import getkey_from_signature
+from .signature import signature_string
+from .statsumm import statsumm
+from .tologfile import ToLogFile
+from .version import version
+
+from filabres import LISTDIR
+
+# subdirectory (within the reduction step subdirectory) for super-masters
+SUPERMASTER_DIR = 'supermaster'
+# default memory ceiling (Mb) for the tiles of the data cube
+DEFAULT_MAXMEM_MB = 1024
+# number of copies of each tile simultaneously in memory (the tile,
+# its normalized version and the temporary copy employed by np.median)
+TILE_COPIES = 3
+
+
+def rows_per_tile(nframes, naxis1, maxmem_mb):
+    """
+    Number of image rows per tile fitting within the memory ceiling.
+
+    Parameters
+    ----------
+    nframes : int
+        Number of images to be combined.
+    naxis1 : int
+        Number of pixels in each image row.
+    maxmem_mb : float
+        Memory ceiling (Mb).
+
+    Returns
+    -------
+    nrows : int
+        Number of rows (at least 1).
+    """
+    nbytes_row = nframes * naxis1 * np.dtype(np.float32).itemsize * TILE_COPIES
+    return max(1, int(maxmem_mb * 1024 * 1024 // nbytes_row))
+
+
+def spill_frames(fnames, spillfname, naxis1, naxis2, nrows, image2d_bias=None):
+    """
+    Copy the individual images into a disk-backed data cube.
+
+    Parameters
+    ----------
+    fnames : list of str
+        Individual images.
+    spillfname : str
+        File name of the disk-backed data cube.
+    naxis1 : int
+        NAXIS1 of the individual images.
+    naxis2 : int
+        NAXIS2 of the individual images.
+    nrows : int
+        Number of rows read at once from each image.
+    image2d_bias : numpy 2D array or None
+        If not None, master bias subtracted from each image.
+
+    Returns
+    -------
+    stack : numpy memmap
+        Data cube with shape (nframes, naxis2, naxis1).
+    image2d_sum : numpy 2D array
+        Sum of the individual images.
+    """
+    stack = np.memmap(spillfname, dtype=np.float32, mode='w+', shape=(len(fnames), naxis2, naxis1))
+    image2d_sum = np.zeros((naxis2, naxis1), dtype=float)
+    for i, fname in enumerate(fnames):
+        # note: memory mapping is employed when possible (it is not
+        # compatible with scaled data); in any case only the requested
+        # section of the image is read
+        with fits.open(fname) as hdul:
+            if hdul[0].header['NAXIS1'] != naxis1 or hdul[0].header['NAXIS2'] != naxis2:
+                msg = 'ERROR: unexpected image dimensions in {}'.format(fname)
+                raise SystemError(msg)
+            for i1 in range(0, naxis2, nrows):
+                i2 = min(i1 + nrows, naxis2)
+                tile = hdul[0].section[i1:i2, :].astype(float)
+                if image2d_bias is not None:
+                    tile -= image2d_bias[i1:i2, :]
+                stack[i, i1:i2, :] = tile
+                image2d_sum[i1:i2, :] += tile
+    stack.flush()
+    return stack, image2d_sum
+
+
+def tiled_median(stack, nrows, scale=None):
+    """
+    Median combination of a data cube computed by tiles of rows.
+
+    Parameters
+    ----------
+    stack : numpy array or memmap
+        Data cube with shape (nframes, naxis2, naxis1).
+    nrows : int
+        Number of rows in each tile.
+    scale : numpy 1D array or None
+        If not None, each image is divided by the corresponding value
+        before computing the median.
+
+    Returns
+    -------
+    image2d : numpy 2D array
+        Median image.
+    """
+    nframes, naxis2, naxis1 = stack.shape
+    image2d = np.zeros((naxis2, naxis1), dtype=float)
+    for i1 in range(0, naxis2, nrows):
+        i2 = min(i1 + nrows, naxis2)
+        tile = np.array(stack[:, i1:i2, :])
+        if scale is not None:
+            tile /= scale.astype(tile.dtype)[:, np.newaxis, np.newaxis]
+        image2d[i1:i2, :] = np.median(tile, axis=0)
+    return image2d
+
+
+def supermaster_provenance(redustep, imgblock, signature, mjdobs, instconf, use_supermasters=False):
+    """
+    Compute the provenance hash of a super-master.
+
+    Parameters
+    ----------
+    redustep : str
+        Reduction step ('bias' or 'flat-imaging').
+    imgblock : list of str
+        Original FITS files to be combined.
+    signature : dict
+        Signature of the super-master.
+    mjdobs : float
+        Mean MJD-OBS of the combined images (employed to select the
+        master bias in flat-imaging).
+    instconf : dict
+        Instrument configuration.
+    use_supermasters : bool
+        If True, prefer the bias super-masters (see select_calibration()).
+
+    Returns
+    -------
+    provenance : str
+        Provenance hash (see provenance_hash()).
+    """
+    calibration_fnames = []
+    if redustep == 'flat-imaging' and instconf['imagetypes'][redustep]['basicreduction']:
+        calibration_fnames.append(calibration_fname(instconf['instname'], 'bias', signature, mjdobs,
+                                                    use_supermasters=use_supermasters))
+    return provenance_hash(imgblock, calibration_fnames, instconf, redustep, options={'supermaster': True})
+
+
+def run_supermaster_step(redustep, setupdata, list_of_nights, instconf, force, force_if_changed=False,
+                         maxmem_mb=None, verbose=False, debug=False):
+    """
+    Combine the calibration images of the selected nights.
+
+    Parameters
+    ==========
+    redustep : str
+        Reduction step to be executed ('bias' or 'flat-imaging').
+    setupdata : dict
+        Setup data stored as a Python dictionary.
+    list_of_nights : list
+        List of nights matching the selection filter.
+    instconf : dict
+        Instrument configuration. See file configuration.json for
+        details.
+    force : bool
+        If True, recompute the super-masters.
+    force_if_changed : bool
+        If True, recompute the super-masters whose provenance (see
+        provenance_hash()) has changed.
+    maxmem_mb : float or None
+        Memory ceiling (Mb) for the tiles of the data cube. If None,
+        DEFAULT_MAXMEM_MB is employed.
+    verbose : bool
+        If True, display intermediate information.
+    debug : bool
+        Display additional debugging information.
+    """
+
+    if redustep not in ['bias', 'flat-imaging']:
+        msg = 'ERROR: super-masters are not available for {} images'.format(redustep)
+        raise SystemError(msg)
+    if maxmem_mb is None:
+        maxmem_mb = DEFAULT_MAXMEM_MB
+
+    datadir = setupdata['datadir']
+    instrument = instconf['instname']
+    # prefer the super-masters when retrieving the calibrations
+    use_supermasters = setupdata.get('use_supermasters', False)
+    signaturekeys = instconf['imagetypes'][redustep]['signature']
+
+    databasefile = 'filabres_db_{}_{}.json'.format(instrument, redustep)
+    try:
+        database = load_database(databasefile, redustep, checkpoint=True)
+    except FileNotFoundError:
+        database = {}
+    if redustep not in database:
+        database[redustep] = dict()
+    if 'signaturekeys' not in database:
+        database['signaturekeys'] = signaturekeys
+    elif signaturekeys != database['signaturekeys']:
+        msg = 'ERROR: signaturekeys have changed when reducing {} images'.format(redustep)
+        raise SystemError(msg)
+
+    depindex = DependantsIndex(instrument)
+
+    # group the images of all the selected nights by signature
+    list_of_signatures = []
+    images_with_signature = []
+    imageinfo = dict()
+    for night in list_of_nights:
+        jsonfname = LISTDIR + night + '/imagedb_' + instrument + '.json'
+        if verbose:
+            print('Reading file {}'.format(jsonfname))
+        try:
+            with open(jsonfname) as jfile:
+                imagedb = json.load(jfile)
+        except FileNotFoundError:
+            print('ERROR: file {} not found'.format(jsonfname))
+            msg = 'Try using -rs initialize'
+            raise SystemError(msg)
+        if instconf['version'] != imagedb['metainfo']['instconf']['version']:
+            msg = 'ERROR: different versions of instrument configuration'
+            raise SystemError(msg)
+        for fname in sorted(imagedb[redustep].keys()):
+            imgsignature = dict()
+            for keyword in signaturekeys:
+                imgsignature[keyword] = imagedb[redustep][fname][keyword]
+            if imgsignature not in list_of_signatures:
+                list_of_signatures.append(imgsignature)
+                images_with_signature.append([])
+            fullname = datadir + night + '/' + fname
+            images_with_signature[list_of_signatures.index(imgsignature)].append(fullname)
+            imageinfo[fullname] = (night, imagedb[redustep][fname])
+    print('Number of different signatures found: {}'.format(len(list_of_signatures)))
+
+    outdir = redustep + '/' + SUPERMASTER_DIR
+    os.makedirs(outdir, exist_ok=True)
+
+    for signature, imgblock in zip(list_of_signatures, images_with_signature):
+        nfiles = len(imgblock)
+        originf = [os.path.basename(dum) for dum in imgblock]
+        nights = sorted(set([imageinfo[fname][0] for fname in imgblock]))
+        ssig = signature_string(signaturekeys, signature)
+        # a super-master computed from a single night would replace the
+        # database entry of the corresponding nightly master (same images
+        # and mean MJD-OBS)
+        if len(nights) < 2:
+            print('Signature {} only found in night {}: skipping super-master.'.format(ssig, nights[0]))
+            continue
+        mjdobs_array = np.array([imageinfo[fname][1]['MJD-OBS'] for fname in imgblock])
+        mean_mjdobs = np.mean(mjdobs_array)
+
+        output_fname = outdir + '/' + redustep + '_super_' + originf[0][:-5]
+        output_mname = output_fname + '_mask.fits'
+        output_lname = output_fname + '_red.log'
+        output_fname += '_red.fits'
+
+        basicreduction = redustep == 'flat-imaging' and instconf['imagetypes'][redustep]['basicreduction']
+        # the provenance is only computed when it is needed
+        provenance = None
+        if os.path.exists(output_fname) and not force:
+            previous = [entry.get('provenance') for entry in database[redustep].get(ssig, dict()).values()
+                        if entry['fname'] == output_fname]
+            execute_reduction = False
+            if len(previous) == 0:
+                # file generated in an interrupted execution before
+                # updating the database
+                execute_reduction = True
+                print('File {} not found in database: repeating reduction.'.format(output_fname))
+            elif force_if_changed:
+                provenance = supermaster_provenance(redustep, imgblock, signature, mean_mjdobs, instconf,
+                                                    use_supermasters)
+                if provenance not in previous:
+                    execute_reduction = True
+                    print('Provenance of {} has changed: repeating reduction.'.format(output_fname))
+            if not execute_reduction:
+                print('File {} already exists: skipping reduction.'.format(output_fname))
+                continue
+
+        if provenance is None:
+            provenance = supermaster_provenance(redustep, imgblock, signature, mean_mjdobs, instconf, use_supermasters)
+        timer = StageTimer()
+        recomputed = os.path.exists(output_fname)
+        logfile = ToLogFile(basename=output_lname, verbose=verbose)
+        datetime_ini = datetime.datetime.now()
+        logfile.print('---', f=True)
+        logfile.print('-> Reduction starts at.: {}'.format(datetime_ini))
+        logfile.print('Working with signature {}'.format(ssig), f=True)
+        logfile.print('-> Number of images with expected signature: {} ({} nights)'.format(nfiles, len(nights)))
+        if debug:
+            for fname in imgblock:
+                logfile.print(' - {}'.format(fname))
+        logfile.print('-> Output fname will be: {}'.format(output_fname))
+
+        # remove previous super-masters computed with the same signature
+        for mjdobs in list(database[redustep].get(ssig, dict())):
+            if database[redustep][ssig][mjdobs].get('supermaster', False):
+                fname = database[redustep][ssig][mjdobs]['fname']
+                mname = database[redustep][ssig][mjdobs]['mname']
+                if fname != output_fname:
+                    for dumfile in [fname, mname]:
+                        if os.path.exists(dumfile):
+                            logfile.print('Deleting {}'.format(dumfile))
+                            os.remove(dumfile)
+                    depindex.warn_outdated(fname, logfile)
+                logfile.print('WARNING: deleting previous database entry:'
+                              ' {} --> {} --> {}'.format(redustep, ssig, mjdobs))
+                del database[redustep][ssig][mjdobs]
+
+        naxis1 = getkey_from_signature(signature, 'NAXIS1')
+        naxis2 = getkey_from_signature(signature, 'NAXIS2')
+        nrows = rows_per_tile(nfiles, naxis1, maxmem_mb)
+        logfile.print('-> Number of rows per tile: {}'.format(nrows))
+
+        # header of the first image, including the keywords modified when
+        # initializing the image databases
+        output_header = fits.getheader(imgblock[0])
+        output_header.add_history("---")
+        output_header.add_history('Using filabres v.{}'.format(version))
+        output_header.add_history('Date: ' + str(datetime.datetime.utcnow().isoformat()))
+        output_header.add_history(str(sys.argv))
+        if 'BLANK' in output_header:
+            del output_header['BLANK']
+        for keyword in instconf['masterkeywords']:
+            val2 = imageinfo[imgblock[0]][1][keyword]
+            if keyword in output_header:
+                val1 = output_header[keyword]
+                if val1 != val2:
+                    output_header[keyword] = val2
+                    logfile.print('WARNING: {} changed from {} to {}'.format(keyword, val1, val2))
+            else:
+                output_header[keyword] = val2
+                logfile.print('WARNING: missing {} set to {}'.format(keyword, val2))
+        output_header['MJD-OBS'] = mean_mjdobs
+        output_header.add_history('Using {} images from {} nights to compute {} super-master:'.format(
+            nfiles, len(nights), redustep))
+        for night in nights:
+            output_header.add_history(night)
+        output_header.add_history('Signature:')
+        for key in signature:
+            output_header.add_history(' - {}: {}'.format(key, signature[key]))
+
+        ierr_bias = None
+        delta_mjd_bias = None
+        bias_fname = None
+        image2d_bias = None
+        ierr_flat = None
+        if basicreduction:
+            with timer.stage('bias'):
+                ierr_bias, delta_mjd_bias, image2d_bias, bias_fname = retrieve_calibration(
+                    instrument, 'bias', signature, mean_mjdobs, logfile=logfile,
+                    use_supermasters=use_supermasters)
+            output_header.add_history('Subtracting master bias:')
+            output_header.add_history(bias_fname)
+
+        spillfname = output_fname[:-5] + '_cube.tmp'
+        try:
+            with timer.stage('fits_read'):
+                stack, image2d_sum = spill_frames(imgblock, spillfname, naxis1, naxis2, nrows, image2d_bias)
+            # ---------------------------------------------------------
+            if redustep == 'bias':
+                with timer.stage('combine'):
+                    image2d = tiled_median(stack, nrows)
+                output_header.add_history('Combination method: median')
+                mask2d = None
+                with timer.stage('statsumm'):
+                    image2d_statsumm = statsumm(image2d=image2d, header=output_header, redustep=redustep,
+                                                rm_nan=True)
+            # ---------------------------------------------------------
+            else:
+                ierr_flat = 0
+                scale = None
+                if basicreduction:
+                    # single mask for all the individual images
+                    mediansignal = np.median(image2d_sum)
+                    if mediansignal > 0:
+                        image2d_sum /= mediansignal
+                    else:
+                        logfile.print('WARNING: mediansignal={} is not > 0'.format(mediansignal))
+                        ierr_flat = 1
+                    with timer.stage('maskfromflat'):
+                        mask2d = maskfromflat(image2d_sum)
+                    # median value of each image in the useful region
+                    scale = np.ones(nfiles)
+                    for i in range(nfiles):
+                        with timer.stage('statsumm'):
+                            dumstatsumm = statsumm(image2d=np.array(stack[i]), mask2d=mask2d, rm_nan=True)
+                        mediansignal = dumstatsumm['QUANT500']
+                        logfile.print('Median value in frame #{}/{}: {}'.format(i+1, nfiles, mediansignal))
+                        if mediansignal > 0:
+                            scale[i] = mediansignal
+                        else:
+                            logfile.print('WARNING: mediansignal={} is not > 0'.format(mediansignal))
+                            ierr_flat = 1
+                else:
+                    logfile.print('WARNING: skipping basic reduction when generating {}'.format(output_fname))
+                with timer.stage('combine'):
+                    image2d = tiled_median(stack, nrows, scale=scale)
+                image2d[image2d <= 0.0] = 1.0
+                output_header.add_history('Combination method: median of normalized images')
+                with timer.stage('maskfromflat'):
+                    mask2d = maskfromflat(image2d)
+                with timer.stage('statsumm'):
+                    image2d_statsumm = statsumm(image2d=image2d, mask2d=mask2d, header=output_header,
+                                                redustep=redustep, rm_nan=True)
+            del stack
+        finally:
+            if os.path.exists(spillfname):
+                os.remove(spillfname)
+
+        # save result
+        with timer.stage('fits_write'):
+            hdu = fits.PrimaryHDU(image2d, output_header)
+            hdu.writeto(output_fname, overwrite=True)
+            logfile.print('Creating {}'.format(output_fname), f=True)
+            if mask2d is not None:
+                hdu = fits.PrimaryHDU(mask2d, output_header)
+                hdu.writeto(output_mname, overwrite=True)
+                logfile.print('Creating {}'.format(output_mname), f=True)
+
+        # update database using the mean MJD-OBS of the combined images as index
+        mjdobs = '{:.5f}'.format(mean_mjdobs)
+        if ssig not in database[redustep]:
+            database[redustep][ssig] = dict()
+        database[redustep][ssig][mjdobs] = dict()
+        database[redustep][ssig][mjdobs]['night'] = SUPERMASTER_DIR
+        database[redustep][ssig][mjdobs]['signature'] = signature
+        database[redustep][ssig][mjdobs]['fname'] = output_fname
+        database[redustep][ssig][mjdobs]['mname'] = output_mname
+        database[redustep][ssig][mjdobs]['lname'] = output_lname
+        database[redustep][ssig][mjdobs]['statsumm'] = image2d_statsumm
+        dumdict = dict()
+        for keyword in instconf['masterkeywords']:
+            dumdict[keyword] = output_header[keyword]
+        database[redustep][ssig][mjdobs]['masterkeywords'] = dumdict
+        database[redustep][ssig][mjdobs]['norigin'] = nfiles
+        database[redustep][ssig][mjdobs]['originf'] = originf
+        database[redustep][ssig][mjdobs]['provenance'] = provenance
+        database[redustep][ssig][mjdobs]['supermaster'] = True
+        database[redustep][ssig][mjdobs]['nights'] = nights
+        database[redustep][ssig][mjdobs]['mjd_min'] = float(np.min(mjdobs_array))
+        database[redustep][ssig][mjdobs]['mjd_max'] = float(np.max(mjdobs_array))
+        if ierr_bias is not None:
+            database[redustep][ssig][mjdobs]['ierr_bias'] = ierr_bias
+        if delta_mjd_bias is not None:
+            database[redustep][ssig][mjdobs]['delta_mjd_bias'] = delta_mjd_bias
+        if bias_fname is not None:
+            database[redustep][ssig][mjdobs]['bias_fname'] = bias_fname
+        if ierr_flat is not None:
+            database[redustep][ssig][mjdobs]['ierr_flat'] = ierr_flat
+        timings = timer.summary()
+        database[redustep][ssig][mjdobs]['timings'] = timings
+        timer.print_summary(logfile, timings)
+
+        if recomputed:
+            depindex.warn_outdated(output_fname, logfile)
+        depindex.register(output_fname, [bias_fname])
+
+        datetime_end = datetime.datetime.now()
+        logfile.print('Creating {}'.format(logfile.fname))
+        logfile.print('-> Reduction ends at...: {}'.format(datetime_end))
+        logfile.print('-> Time span...........: {}'.format(datetime_end - datetime_ini))
+        logfile.close()
+
+        # update results database
+        write_database(databasefile, database)
@@ -0,0 +1,40 @@
+from astropy.io import fits
+import numpy as np
+
+from filabres.load_instrument_configuration import load_instrument_configuration
+from filabres.run_astrometry import solve_field_options
+from filabres.tologfile import ToLogFile
+
+
+def test_astrometry_profile(tmp_path):
+    logfile = ToLogFile(workdir=str(tmp_path), basename='profile.log')
+    # previous behaviour when no profile is defined
+    assert solve_field_options(None, fits.Header(), logfile) == (' -p', '')
+
+    # the shipped configuration keeps the previous solve-field options
+    instconf = load_instrument_configuration({'instrument': 'cafos'}, 'science-imaging')
+    assert instconf['astrometry']['pvalues'][0] == 2
+    header = fits.Header()
+    header['INSTRSCL'] = 0.53
+    header['CCDBINX'] = 2
+    header['CCDBINY'] = 2
+    assert solve_field_options(instconf['astrometry'], header, logfile) == (' -p', '')
+
+    astroconf = {'pixscale_keyword': 'INSTRSCL', 'binning_keywords': ['CCDBINX', 'CCDBINY'],
+                 'scale_tolerance': 0.1, 'downsample': 2, 'max_objects': 1000, 'cpulimit_seconds': 300}
+    options, scale_options = solve_field_options(astroconf, header, logfile)
+    assert options == ' -p --downsample 2 --objs 1000 --cpulimit 300'
+    # the downsampling is performed by image2xy when using a list of objects
+    options, scale_options = solve_field_options(astroconf, header, logfile, xylist=True)
+    assert options == ' -p --objs 1000 --cpulimit 300'
+    words = scale_options.split()
+    assert words[:2] == ['--scale-units', 'arcsecperpix']
+    assert np.isclose(float(words[3]), 0.954)
+    assert np.isclose(float(words[5]), 1.166)
+    # the pixel scale is not constrained when the binning is unknown
+    del header['CCDBINY']
+    assert solve_field_options(astroconf, header, logfile)[1] == ''
+
+    instconf = load_instrument_configuration({'instrument': 'lsss'}, 'science-imaging')
+    assert solve_field_options(instconf['astrometry'], header, logfile) == (' -p', '')
+    logfile.close()
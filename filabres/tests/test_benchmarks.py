@@ -0,0 +1,15 @@
+from filabres.benchmarks.run_benchmarks import run_benchmarks
+
+
+def test_benchmarks(tmp_path):
+    selected = ['initialize', 'bias', 'flat-imaging', 'science-imaging', 'science-imaging-astrometry',
+                'list_reduced']
+    results = run_benchmarks(str(tmp_path / 'work'), naxis=256, nbias=2, nflat=2, nscience=1, nstars=2000,
+                             selected=selected, memory=False)
+    assert [result.name for result in results] == selected
+    for result in results:
+        assert result.asdict()['frames_per_s'] > 0
+    reduced = tmp_path / 'work' / 'science-imaging' / 'night001' / 'science-imaging_night001-0005-science_red.fits'
+    assert reduced.exists()
+    # index file built by build-astrometry-index saved for subsequent images
+    assert len(list((tmp_path / 'work' / 'science-imaging' / 'night001').glob('index*/index-image_I*_P*.fits'))) > 0
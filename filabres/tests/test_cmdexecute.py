@@ -0,0 +1,71 @@
+import asyncio
+import sys
+import threading
+import time
+
+import filabres.cmdexecute
+from filabres.cmdexecute import CmdExecute
+from filabres.cmdexecute import DEFAULT_MAX_CONCURRENT
+from filabres.cmdexecute import configure
+from filabres.tologfile import ToLogFile
+
+# command with a known exit status (note that commands are split by blanks)
+EXIT3 = sys.executable + ' -c raise(SystemExit(3))'
+
+
+def test_cmdexecute(tmp_path):
+    logfile = ToLogFile(workdir=str(tmp_path), basename='cmd.log')
+    cmd = CmdExecute(logfile)
+    (tmp_path / 'data.txt').write_text('line1\nline2\n')
+    assert cmd.run('cat data.txt', cwd=str(tmp_path)) == 0
+    assert cmd.run('ls nonexistent_file') != 0
+    assert cmd.run(EXIT3) == 3
+
+    # timeout
+    t0 = time.time()
+    assert cmd.run('sleep 30', timeout=0.5) is None
+    assert time.time() - t0 < 10
+
+    # simultaneous commands
+    t0 = time.time()
+    assert cmd.run_many(['sleep 1', 'sleep 1', EXIT3]) == [0, 0, 3]
+    assert time.time() - t0 < 5
+
+    # cancellation
+    cancel = threading.Event()
+    timer = threading.Timer(0.5, cancel.set)
+    timer.start()
+    t0 = time.time()
+    assert CmdExecute(logfile, cancel=cancel).run('sleep 30') is None
+    assert time.time() - t0 < 10
+    assert CmdExecute(logfile, cancel=cancel).run('ls') is None
+    logfile.close()
+
+    log = (tmp_path / 'cmd.log').read_text()
+    assert 'line1\nline2\n' in log
+    assert 'command killed after 0.5 seconds: sleep 30' in log
+    assert 'command cancelled: sleep 30' in log
+
+
+def test_cmdexecute_cancel_waiting(tmp_path):
+    logfile = ToLogFile(workdir=str(tmp_path), basename='cmd.log')
+    cmd = CmdExecute(logfile)
+    configure(max_concurrent=1)
+
+    async def run():
+        first = asyncio.ensure_future(cmd.run_async('sleep 1'))
+        await asyncio.sleep(0.2)
+        # task cancelled while waiting for the semaphore
+        second = asyncio.ensure_future(cmd.run_async('sleep 1'))
+        await asyncio.sleep(0.2)
+        second.cancel()
+        return await first
+
+    try:
+        assert asyncio.run(run()) == 0
+        # the slot is available again
+        assert filabres.cmdexecute._SEMAPHORE.acquire(blocking=False)
+        filabres.cmdexecute._SEMAPHORE.release()
+    finally:
+        configure(max_concurrent=DEFAULT_MAX_CONCURRENT)
+    logfile.close()
@@ -0,0 +1,46 @@
+import json
+
+from filabres.dependants import DependantsIndex
+
+
+def test_dependants(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for fname in ['bias1.fits', 'bias2.fits', 'flat1.fits']:
+        with open(fname, 'w') as f:
+            f.write('data')
+    depindex = DependantsIndex('cafos')
+    depindex.register('flat1.fits', ['bias1.fits'])
+    depindex.register('sci1.fits', ['bias1.fits', 'flat1.fits'])
+    depindex.register('sci2.fits', ['bias2.fits', 'flat1.fits'])
+    # dummy calibrations are ignored
+    depindex.register('sci3.fits', [None, 'None (no flat)'])
+
+    depindex = DependantsIndex('cafos')
+    assert depindex.dependants('bias1.fits', recursive=False) == ['flat1.fits', 'sci1.fits']
+    assert depindex.dependants('bias1.fits') == ['flat1.fits', 'sci1.fits', 'sci2.fits']
+    assert depindex.dependants('bias2.fits') == ['sci2.fits']
+    assert depindex.dependants('sci3.fits') == []
+
+    # reduction repeated with a different master bias
+    depindex.register('sci2.fits', ['bias1.fits', 'flat1.fits'])
+    assert depindex.dependants('bias2.fits') == []
+    depindex.remove_product('sci1.fits')
+    assert DependantsIndex('cafos').dependants('flat1.fits') == ['sci2.fits']
+
+    # append-only file: one record per registration or removal
+    with open('filabres_dependants_cafos.jsonl') as f:
+        assert len(f.readlines()) == 5
+
+
+def test_dependants_legacy(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for fname in ['bias1.fits', 'flat1.fits']:
+        with open(fname, 'w') as f:
+            f.write('data')
+    with open('filabres_dependants_cafos.json', 'w') as f:
+        json.dump({'bias1.fits': ['flat1.fits', 'sci1.fits'], 'flat1.fits': ['sci1.fits']}, f)
+    depindex = DependantsIndex('cafos')
+    assert not (tmp_path / 'filabres_dependants_cafos.json').exists()
+    assert depindex.dependants('bias1.fits', recursive=False) == ['flat1.fits', 'sci1.fits']
+    depindex.remove_product('sci1.fits')
+    assert DependantsIndex('cafos').dependants('bias1.fits') == ['flat1.fits']
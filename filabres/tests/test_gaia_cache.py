@@ -0,0 +1,104 @@
+import numpy as np
+from astropy.table import Table
+
+from filabres.gaia_cache import GaiaCache
+from filabres.skytiles import SkyTiling, angular_distance_deg
+
+
+def synthetic_table(ra, dec, radius, nstars, seed=1):
+    rng = np.random.default_rng(seed)
+    r = radius * np.sqrt(rng.uniform(size=nstars))
+    theta = rng.uniform(0, 2 * np.pi, size=nstars)
+    table = Table()
+    table['SOURCE_ID'] = np.arange(nstars, dtype=np.int64)
+    table['dec'] = dec + r * np.sin(theta)
+    table['ra'] = (ra + r * np.cos(theta) / np.cos(np.radians(dec))) % 360
+    table['phot_g_mean_mag'] = rng.uniform(10, 20, size=nstars)
+    return table
+
+
+def test_tiles_in_cone():
+    tiling = SkyTiling(1 / 16)
+    for ra, dec in [(0.01, 0), (180, 45), (359.99, -30), (10, 89.9)]:
+        overlapping, inside = tiling.tiles_in_cone(ra, dec, 0.2)
+        assert set(inside) <= set(overlapping)
+        # every point within the cone belongs to an overlapping tile
+        table = synthetic_table(ra, dec, 0.2, 2000)
+        distance = angular_distance_deg(ra, dec, table['ra'], table['dec'])
+        tiles = tiling.tile_of(table['ra'], table['dec'])[distance <= 0.2]
+        assert set(tiles) <= set(overlapping)
+
+
+def test_gaia_cache(tmp_path):
+    cache = GaiaCache(str(tmp_path), 'gaiadr3.gaia_source')
+    ra, dec = 359.95, 20.0
+    full = synthetic_table(ra, dec, 0.6, 20000)
+    radius = 0.15
+
+    assert cache.lookup(ra, dec, radius, 18) is None
+    complete = full[full['phot_g_mean_mag'] < 18]
+    assert cache.store(ra, dec, radius + cache.margin_deg, 18, complete) > 0
+
+    result = cache.lookup(ra, dec, radius, 17)
+    distance = angular_distance_deg(ra, dec, full['ra'], full['dec'])
+    expected = full[(distance <= radius) & (full['phot_g_mean_mag'] < 17)]
+    assert sorted(result['SOURCE_ID']) == sorted(expected['SOURCE_ID'])
+    assert np.all(np.diff(result['phot_g_mean_mag']) >= 0)
+    assert len(cache.lookup(ra, dec, radius, 17, nmax=10)) == 10
+
+    # deeper magnitude or a different field are not available
+    assert cache.lookup(ra, dec, radius, 19) is None
+    assert cache.lookup(ra + 1, dec, radius, 17) is None
+
+    # eviction of the least recently used files
+    cache.size_mb = 0
+    cache.store(ra + 1, dec, radius + cache.margin_deg, 18, complete)
+    assert cache.size_mb_used() == 0
+    assert cache.lookup(ra, dec, radius, 17) is None
+
+
+def test_retrieve_gaia_with_cache(tmp_path, monkeypatch):
+    import io
+    import re
+    from filabres import retrieve_gaia as module
+
+    ra, dec = 120.0, -10.0
+    full = synthetic_table(ra, dec, 0.6, 5000)
+    queries = []
+
+    def fake_launch_query(gaia_query_line):
+        queries.append(gaia_query_line)
+        ra0, dec0, radius = [float(item) for item in re.search(r"CIRCLE\('ICRS',([^)]*)\)", gaia_query_line)
+                             .group(1).split(',')]
+        magnitude = float(re.search(r'phot_g_mean_mag < ([0-9.]*)', gaia_query_line).group(1))
+        nmax = int(re.search(r'TOP ([0-9]*)', gaia_query_line).group(1))
+        distance = angular_distance_deg(ra0, dec0, full['ra'], full['dec'])
+        result = full[(distance <= radius) & (full['phot_g_mean_mag'] < magnitude)]
+        if 'ORDER BY phot_g_mean_mag' in gaia_query_line:
+            result.sort('phot_g_mean_mag')
+        return result[:nmax]
+
+    monkeypatch.setattr(module, 'launch_query', fake_launch_query)
+    cache = GaiaCache(str(tmp_path), 'gaiadr3.gaia_source')
+    loggaia = io.StringIO()
+    _, result1 = module.retrieve_gaia('gaiadr3.gaia_source', ra, dec, 0.1, 16, loggaia, cache=cache)
+    assert len(queries) == 1
+    # same field (observed e.g. in a different night)
+    _, result2 = module.retrieve_gaia('gaiadr3.gaia_source', ra + 0.01, dec, 0.1, 15, loggaia, cache=cache)
+    assert len(queries) == 1
+    _, expected = module.retrieve_gaia('gaiadr3.gaia_source', ra + 0.01, dec, 0.1, 15, loggaia)
+    assert sorted(result2['SOURCE_ID']) == sorted(expected['SOURCE_ID'])
+    assert len(result1) > len(result2) > 0
+
+    # brightest objects in a denser field: the cache is complete down to
+    # the magnitude of the faintest object retrieved to fill the cache
+    _, result3 = module.retrieve_gaia('gaiadr3.gaia_source', ra, dec, 0.4, 30, loggaia, cache=cache,
+                                      brightest=True)
+    assert len(queries) == 3
+    _, expected = module.retrieve_gaia('gaiadr3.gaia_source', ra, dec, 0.4, 30, loggaia, brightest=True)
+    assert len(result3) == module.NMAXGAIA
+    assert list(result3['SOURCE_ID']) == list(expected['SOURCE_ID'])
+    # (the same answer is obtained for the unsorted query reaching NMAXGAIA)
+    _, result4 = module.retrieve_gaia('gaiadr3.gaia_source', ra, dec, 0.4, 30, loggaia, cache=cache)
+    assert len(queries) == 4
+    assert list(result4['SOURCE_ID']) == list(expected['SOURCE_ID'])
@@ -0,0 +1,63 @@
+import numpy as np
+from astropy.table import Table
+
+import filabres.gaia_prefetch as gaia_prefetch
+from filabres.gaia_prefetch import GaiaPrefetcher, cluster_pointings, pointings_from_imagedb
+from filabres.local_gaia import write_local_catalogue
+from filabres.pointing_index import PointingIndex
+
+
+def local_setup(tmp_path):
+    rng = np.random.default_rng(3)
+    nstars = 5000
+    table = Table()
+    table['source_id'] = np.arange(nstars, dtype=np.int64)
+    table['ref_epoch'] = np.full(nstars, 2016.0)
+    table['ra'] = rng.uniform(9, 11, size=nstars)
+    table['dec'] = rng.uniform(19, 21, size=nstars)
+    table['pmra'] = rng.normal(0, 5, size=nstars)
+    table['pmdec'] = rng.normal(0, 5, size=nstars)
+    table['phot_g_mean_mag'] = rng.uniform(8, 21, size=nstars)
+    catdir = str(tmp_path / 'localgaia')
+    write_local_catalogue(table, catdir, tile_deg=0.5)
+    return {'gaiadr_source': 'local:' + catdir, 'gaia_query_mode': 'brightest'}
+
+
+def test_gaia_prefetch(tmp_path, monkeypatch):
+    setupdata = local_setup(tmp_path)
+    imagedb = {'science-imaging': {
+        'a.fits': {'RA': 10.0, 'DEC': 20.0, 'MJD-OBS': 58000.1},
+        'b.fits': {'RA': 10.004, 'DEC': 20.004, 'MJD-OBS': 58000.2},
+        'c.fits': {'RA': 10.5, 'DEC': 20.3, 'MJD-OBS': 58000.3},
+        'd.fits': {'RA': 10.496, 'DEC': 20.296, 'MJD-OBS': 58000.4},
+    }}
+    list_of_images = sorted(imagedb['science-imaging'])
+    pointings = pointings_from_imagedb(imagedb, 'science-imaging', list_of_images, 'cafos')
+    assert len(cluster_pointings(pointings, PointingIndex(), 16, 1.1)) == 2
+
+    # the first attempt of every query fails
+    nattempts = []
+    query_gaia_field = gaia_prefetch.query_gaia_field
+
+    def flaky_query(*args):
+        nattempts.append(args[:2])
+        if nattempts.count(args[:2]) == 1:
+            return None, None
+        return query_gaia_field(*args)
+    monkeypatch.setattr(gaia_prefetch, 'query_gaia_field', flaky_query)
+
+    nightdir = str(tmp_path / 'science-imaging' / 'night')
+    prefetcher = GaiaPrefetcher(setupdata, nqueries=2, retry_delay=0)
+    assert prefetcher.add_night(nightdir, pointings, 16, 1.1) == 2
+    prefetcher.start()
+    assert prefetcher.wait(nightdir) == 2
+    assert len(nattempts) == 4
+
+    ccbase = PointingIndex(nightdir)
+    assert sorted(ccbase) == ['index000001', 'index000002']
+    for subdir in ccbase:
+        assert (tmp_path / 'science-imaging' / 'night' / subdir / 'GaiaDRX-query.fits').is_file()
+    assert [ccbase.find(p['ra'], p['dec'], 16) for p in pointings] == [1, 1, 2, 2]
+
+    # all the fields are already covered
+    assert GaiaPrefetcher(setupdata).add_night(nightdir, pointings, 16, 1.1) == 0
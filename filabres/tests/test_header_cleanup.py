@@ -0,0 +1,35 @@
+from astropy.io import fits
+
+from filabres.benchmarks.stubs import stub_wcs_header
+from filabres.run_astrometry import read_tpv_solution, remove_sip_solution
+
+
+def test_remove_sip_solution(tmp_path):
+    oldheader = stub_wcs_header(10.0, 20.0, 100, 100)
+    newheader = fits.Header([('OBJECT', 'test')])
+    newheader.add_comment('--Put in by the new-wcs program--')
+    newheader.add_history('reduced')
+    newheader.add_history('reduced')
+    newheader.extend(oldheader.cards)
+    newheader.add_history(oldheader['HISTORY'][0])
+    newheader.append()
+
+    result = remove_sip_solution(newheader, oldheader)
+    assert 'A_ORDER' not in result and 'BP_2_0' not in result
+    assert result['CTYPE1'] == 'RA---TAN-SIP'
+    comments = list(result['COMMENT'])
+    assert '--Put in by the new-wcs program--' not in comments
+    assert len([item for item in comments if item.startswith('deleted ')]) == 2 * (2 * 6 + 2)
+    assert '' not in comments
+    # only the repeated entry is kept
+    assert list(result['HISTORY']) == ['reduced', 'reduced', oldheader['HISTORY'][0],
+                                       '--Deleting SIP from Astrometry.net WCS solution--']
+
+    (tmp_path / 'xxx.head').write_text("HISTORY   Astrometric solution by SCAMP\n"
+                                       "CRVAL1  =       1.000000000000E+01 / WCS Reference Coordinate (RA)\n"
+                                       "RADESYS = 'ICRS    '           / Astrometric system\n"
+                                       "END\n")
+    cards, history = read_tpv_solution(str(tmp_path / 'xxx.head'))
+    assert cards[0] == ('CRVAL1', 10.0, 'WCS Reference Coordinate (RA)')
+    assert cards[1][0] == 'RADESYS' and cards[1][1].strip() == 'ICRS'
+    assert history == ['Astrometric solution by SCAMP']
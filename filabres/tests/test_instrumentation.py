@@ -0,0 +1,61 @@
+import time
+
+import pytest
+
+from filabres.instrumentation import StageTimer, TIMING_KEYWORDS, stage
+
+
+def test_stage_timer():
+    timer = StageTimer()
+    for i in range(2):
+        with timer.stage('solve_field'):
+            time.sleep(0.01)
+    with stage(timer, 'fits_write'):
+        with open('/dev/null', 'w') as f:
+            f.write('x')
+    summary = timer.summary()
+    assert summary['time_solve_field'] >= 0.02
+    assert 'time_fits_write' in summary
+    assert 'time_gaia' not in summary
+    assert summary['time_total'] >= summary['time_solve_field']
+    assert set(summary.keys()) <= set(TIMING_KEYWORDS)
+
+
+def test_stage_without_timer():
+    with stage(None, 'gaia'):
+        pass
+
+
+def test_invalid_stage():
+    timer = StageTimer()
+    with pytest.raises(ValueError):
+        with timer.stage('undefined'):
+            pass
+
+
+@pytest.mark.parametrize('fname', ['trace.json', 'trace.jsonl'])
+def test_profile(tmp_path, fname):
+    import json
+    from filabres.cmdexecute import CmdExecute
+    from filabres.instrumentation import span_begin, span_end, start_profile, stop_profile
+
+    tracefile = str(tmp_path / fname)
+    start_profile(tracefile)
+    span_begin('night1', 'night')
+    with stage(StageTimer(), 'statsumm'):
+        pass
+    CmdExecute().run('echo hello')
+    span_end('night1', 'night')
+    stop_profile()
+
+    with open(tracefile) as f:
+        if fname.endswith('.jsonl'):
+            events = [json.loads(line) for line in f]
+        else:
+            events = json.load(f)
+    phases = [(event['name'], event['ph']) for event in events]
+    assert ('night1', 'B') in phases
+    assert ('night1', 'E') in phases
+    assert ('statsumm', 'X') in phases
+    assert ('echo', 'X') in phases
+    assert ('filabres', 'X') in phases
@@ -0,0 +1,49 @@
+import json
+import os
+
+from filabres.journal import DatabaseJournal
+from filabres.journal import load_database
+
+
+def test_journal(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    databasefile = 'filabres_db_cafos_bias.json'
+    journal = DatabaseJournal(databasefile)
+    assert journal.fname == 'filabres_db_cafos_bias.journal'
+    database = {'signaturekeys': ['NAXIS1'], 'bias': {'100': {'58000.10000': {'fname': 'bias0.fits'}}}}
+    journal.checkpoint(database)
+
+    # blocks reduced before an interruption
+    journal.commit(['NAXIS1'], '100', '58000.20000', {'fname': 'bias1.fits'}, ['58000.10000'])
+    journal.commit(['NAXIS1'], '200', '58001.10000', {'fname': 'bias2.fits'}, [])
+    with open(journal.fname, 'a') as f:
+        f.write('{"signaturekeys": ["NAXIS1"], "ssig": "300", ')
+
+    with open(databasefile) as jfile:
+        database = json.load(jfile)
+    assert DatabaseJournal(databasefile).replay(database, 'bias') == 2
+    assert database['bias'] == {'100': {'58000.20000': {'fname': 'bias1.fits'}},
+                                '200': {'58001.10000': {'fname': 'bias2.fits'}}}
+    journal.checkpoint(database)
+    assert not os.path.exists(journal.fname)
+    with open(databasefile) as jfile:
+        assert json.load(jfile) == database
+
+    # the pending changes are recovered (in memory) by any module loading
+    # the database, leaving both files unchanged
+    journal.commit(['NAXIS1'], '300', '58002.10000', {'fname': 'bias3.fits'}, [])
+    with open(databasefile) as f:
+        database_content = f.read()
+    with open(journal.fname) as f:
+        journal_content = f.read()
+    assert load_database(databasefile, 'bias')['bias']['300'] == {'58002.10000': {'fname': 'bias3.fits'}}
+    with open(databasefile) as f:
+        assert f.read() == database_content
+    with open(journal.fname) as f:
+        assert f.read() == journal_content
+
+    # the reduction step owning the database saves it and removes the journal
+    database = load_database(databasefile, 'bias', checkpoint=True)
+    assert not os.path.exists(journal.fname)
+    with open(databasefile) as jfile:
+        assert json.load(jfile) == database
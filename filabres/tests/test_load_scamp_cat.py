@@ -0,0 +1,32 @@
+import numpy as np
+
+from filabres.benchmarks.stubs import write_ldac
+from filabres.load_scamp_cat import load_scamp_cat
+
+
+def test_load_scamp_cat(tmp_path):
+    x = np.array([10.5, 20.25, 30.0])
+    y = np.array([1.0, 2.0, 3.0])
+    catalogue_number = np.array([1, 0, 1])
+    ra = np.array([120.1, 120.2])
+    dec = np.array([-5.0, -5.5])
+
+    # FITS_LDAC
+    write_ldac(str(tmp_path / 'full_1.cat'), [('X_IMAGE', x), ('Y_IMAGE', y), ('CATALOG_NUMBER', catalogue_number)])
+    write_ldac(str(tmp_path / 'merged_1.cat'), [('ALPHA_J2000', ra), ('DELTA_J2000', dec)])
+    col1, col2 = load_scamp_cat('full', str(tmp_path))
+    assert np.allclose(col1, [10.5, 30.0]) and np.allclose(col2, [1.0, 3.0])
+    col1, col2 = load_scamp_cat('merged', str(tmp_path))
+    assert np.allclose(col1, ra) and np.allclose(col2, dec)
+
+    # ASCII_HEAD (including a vector column)
+    with open(str(tmp_path / 'full_1.cat'), 'wt') as f:
+        f.write('#   1 NUMBER          Source index\n')
+        f.write('#   2 FLUX_APER       Flux vector within fixed circular aperture(s)\n')
+        f.write('#   4 CATALOG_NUMBER  File index\n')
+        f.write('#   5 X_IMAGE         Object position along x\n')
+        f.write('#   6 Y_IMAGE         Object position along y\n')
+        for i in range(3):
+            f.write('{} 1.0 2.0 {} {} {}\n'.format(i + 1, catalogue_number[i], x[i], y[i]))
+    col1, col2 = load_scamp_cat('full', str(tmp_path))
+    assert np.allclose(col1, [10.5, 30.0]) and np.allclose(col2, [1.0, 3.0])
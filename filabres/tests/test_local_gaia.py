@@ -0,0 +1,37 @@
+import io
+
+import numpy as np
+from astropy.table import Table
+
+from filabres.local_gaia import LocalGaiaCatalogue, write_local_catalogue
+from filabres.retrieve_gaia import retrieve_gaia
+from filabres.skytiles import angular_distance_deg
+
+
+def test_local_gaia(tmp_path):
+    rng = np.random.default_rng(2)
+    nstars = 20000
+    table = Table()
+    table['source_id'] = np.arange(nstars, dtype=np.int64)
+    table['ref_epoch'] = np.full(nstars, 2016.0)
+    table['ra'] = rng.uniform(-2, 2, size=nstars) % 360
+    table['dec'] = rng.uniform(-2, 2, size=nstars)
+    table['pmra'] = rng.normal(0, 5, size=nstars)
+    table['pmdec'] = rng.normal(0, 5, size=nstars)
+    table['phot_g_mean_mag'] = rng.uniform(8, 21, size=nstars)
+    catdir = str(tmp_path / 'localgaia')
+    assert write_local_catalogue(table, catdir, tile_deg=0.5) > 1
+
+    ra, dec, radius = 359.9, 0.3, 0.9
+    distance = angular_distance_deg(ra, dec, table['ra'], table['dec'])
+    for magnitude in [12, 30]:
+        expected = table[(distance <= radius) & (table['phot_g_mean_mag'] < magnitude)]
+        result = LocalGaiaCatalogue(catdir).query(ra, dec, radius, magnitude)
+        assert sorted(result['SOURCE_ID']) == sorted(expected['source_id'])
+        assert np.all(np.diff(result['phot_g_mean_mag']) >= 0)
+
+    # same query through the retrieve_gaia() interface
+    loggaia = io.StringIO()
+    _, result = retrieve_gaia('local:' + catdir, ra, dec, radius, 30, loggaia)
+    assert len(result) == 2000
+    assert np.all(result['phot_g_mean_mag'] <= np.sort(table['phot_g_mean_mag'][distance <= radius])[1999])
@@ -0,0 +1,42 @@
+from astropy.io import fits
+import numpy as np
+
+from filabres.plot_astrometry import plot_astrometry, replot_astrometry
+from filabres.plot_astrometry import submit_background_plots, wait_background_plots
+from filabres.tologfile import ToLogFile
+
+
+def test_plot_astrometry(tmp_path):
+    rng = np.random.default_rng(1234)
+    image2d = rng.normal(100, 10, (64, 64))
+    output_fname = str(tmp_path / 'image_red.fits')
+    fits.PrimaryHDU(image2d).writeto(output_fname)
+    peak_x = rng.uniform(1, 64, 20)
+    peak_y = rng.uniform(1, 64, 20)
+    logfile = ToLogFile(workdir=str(tmp_path), basename='plot.log')
+
+    astrsumm = plot_astrometry(output_fname=output_fname, image2d=image2d, mask2d=np.ones((64, 64), dtype=bool),
+                               peak_x=peak_x, peak_y=peak_y, pred_x=peak_x + 0.1, pred_y=peak_y,
+                               xcatag=peak_x, ycatag=peak_y, pixel_scales_arcsec_pix=np.array([0.5, 0.5]),
+                               workdir=str(tmp_path), interactive=False, logfile=logfile, suffix='net',
+                               plots='none')
+    # the data are not saved when the plots are generated immediately
+    plot_astrometry(output_fname=output_fname, image2d=image2d, mask2d=np.ones((64, 64), dtype=bool),
+                    peak_x=peak_x, peak_y=peak_y, pred_x=peak_x + 0.1, pred_y=peak_y,
+                    xcatag=peak_x, ycatag=peak_y, pixel_scales_arcsec_pix=np.array([0.5, 0.5]),
+                    workdir=str(tmp_path), interactive=False, logfile=logfile, suffix='scamp', plots='now')
+    assert (tmp_path / 'astrometry-scamp.pdf').exists()
+    assert not (tmp_path / 'astrometry-scamp.npz').exists()
+    logfile.close()
+    assert astrsumm.ntargets == 20
+    assert np.isclose(astrsumm.meanerr, 0.05)
+    assert (tmp_path / 'astrometry-net.npz').exists()
+    assert not (tmp_path / 'astrometry-net.pdf').exists()
+
+    assert replot_astrometry(str(tmp_path / 'astrometry-net.npz')) == str(tmp_path / 'astrometry-net.pdf')
+    assert (tmp_path / 'astrometry-net.pdf').stat().st_size > 0
+
+    (tmp_path / 'astrometry-net.pdf').unlink()
+    submit_background_plots(str(tmp_path / 'astrometry-net.npz'))
+    assert wait_background_plots() == 0
+    assert (tmp_path / 'astrometry-net.pdf').exists()
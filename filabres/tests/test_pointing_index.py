@@ -0,0 +1,53 @@
+import json
+
+import numpy as np
+
+import filabres.pointing_index as pointing_index
+from filabres.pointing_index import PointingIndex, unit_vector
+
+
+def find_loop(ccbase, ra_deg, dec_deg, maxfieldview_arcmin):
+    """Pointing lookup with an explicit loop."""
+    xj2000, yj2000, zj2000 = unit_vector(ra_deg, dec_deg)
+    indexid = None
+    dist_arcmin_min = None
+    for ikey in ccbase:
+        entry = ccbase[ikey]
+        dotproduct = np.clip(entry['x'] * xj2000 + entry['y'] * yj2000 + entry['z'] * zj2000, -1, 1)
+        dist_arcmin = np.arccos(dotproduct) * 180 / np.pi * 60
+        if (maxfieldview_arcmin / 2) + dist_arcmin < entry['search_radius_arcmin']:
+            if dist_arcmin_min is None or dist_arcmin < dist_arcmin_min:
+                dist_arcmin_min = dist_arcmin
+                indexid = int(ikey[-6:])
+    return indexid
+
+
+def test_pointing_index(tmp_path, monkeypatch):
+    rng = np.random.default_rng(7)
+    nightdir = str(tmp_path)
+    # file generated by previous versions
+    x, y, z = unit_vector(10.0, 20.0)
+    with open(tmp_path / 'central_pointings.json', 'w') as outfile:
+        json.dump({'index000001': {'ra': 10.0, 'dec': 20.0, 'x': x, 'y': y, 'z': z,
+                                   'search_radius_arcmin': 8.8}}, outfile)
+    ccbase = PointingIndex(nightdir)
+    assert ccbase.find(10.0, 20.0, 16) == 1
+    assert ccbase.find(12.0, 20.0, 16) is None
+    ra = rng.uniform(0, 30, size=1000)
+    dec = rng.uniform(0, 30, size=1000)
+    for i in range(1000):
+        ccbase.add('index{:06d}'.format(len(ccbase) + 1), ra[i], dec[i], rng.uniform(8, 80))
+
+    # append-only file
+    assert len(open(tmp_path / 'central_pointings.jsonl').readlines()) == 1000
+    ccbase = PointingIndex(nightdir)
+    assert len(ccbase) == 1001
+
+    ra_test = rng.uniform(0, 30, size=200)
+    dec_test = rng.uniform(0, 30, size=200)
+    expected = [find_loop(ccbase, ra_test[i], dec_test[i], 16) for i in range(200)]
+    assert any([indexid is not None for indexid in expected])
+    assert [ccbase.find(ra_test[i], dec_test[i], 16) for i in range(200)] == expected
+    # without KD-tree
+    monkeypatch.setattr(pointing_index, 'KDTREE_MIN_POINTINGS', 10000)
+    assert [ccbase.find(ra_test[i], dec_test[i], 16) for i in range(200)] == expected
@@ -0,0 +1,38 @@
+import numpy as np
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.table import MaskedColumn, Table
+from astropy.time import Time
+
+from filabres.proper_motion import apply_proper_motion
+
+
+def test_apply_proper_motion():
+    rng = np.random.default_rng(5)
+    nstars = 50
+    table = Table()
+    table['ra'] = rng.uniform(0, 360, size=nstars)
+    table['dec'] = rng.uniform(-89, 89, size=nstars)
+    pmra = rng.normal(0, 50, size=nstars)
+    pmra[::10] = np.nan
+    table['pmra'] = pmra
+    table['pmdec'] = MaskedColumn(rng.normal(0, 50, size=nstars), mask=np.arange(nstars) % 7 == 3)
+    table['ref_epoch'] = np.where(np.arange(nstars) % 2 == 0, 2015.5, 2016.0)
+    dateobs = '2019-03-14T21:30:00.0'
+
+    ra_corrected, dec_corrected = apply_proper_motion(table['ra'], table['dec'], table['pmra'], table['pmdec'],
+                                                      table['ref_epoch'], dateobs)
+
+    # per-star computation
+    for i, record in enumerate(table):
+        if np.isnan(pmra[i]) or table['pmdec'].mask[i]:
+            assert ra_corrected[i] == record['ra']
+            assert dec_corrected[i] == record['dec']
+            continue
+        t0 = Time(record['ref_epoch'], format='decimalyear')
+        c = SkyCoord(ra=record['ra'] * u.degree, dec=record['dec'] * u.degree,
+                     pm_ra_cosdec=record['pmra'] * u.mas / u.yr, pm_dec=record['pmdec'] * u.mas / u.yr,
+                     obstime=t0)
+        c_corrected = c.apply_space_motion(dt=(Time(dateobs) - t0).jd * u.day)
+        assert np.isclose(ra_corrected[i], c_corrected.ra.degree, rtol=0, atol=1e-10)
+        assert np.isclose(dec_corrected[i], c_corrected.dec.degree, rtol=0, atol=1e-10)
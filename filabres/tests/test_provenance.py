@@ -0,0 +1,39 @@
+import json
+import os
+import time
+
+from filabres.load_instrument_configuration import load_instrument_configuration
+from filabres.provenance import provenance_hash
+from filabres.retrieve_calibration import calibration_fname
+
+
+def test_provenance(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    instconf = load_instrument_configuration({'instrument': 'cafos'}, 'science-imaging')
+    signature = {'CCDNAME': 'SITE', 'NAXIS1': 100, 'NAXIS2': 100}
+    with open('filabres_db_cafos_flat-imaging.json', 'w') as outfile:
+        json.dump({'signaturekeys': ['CCDNAME', 'NAXIS1', 'NAXIS2'],
+                   'flat-imaging': {'SITE__100__100': {'58000.10000': {'fname': 'flat1.fits'},
+                                                       '58001.10000': {'fname': 'flat2.fits'}}}}, outfile)
+    assert calibration_fname('cafos', 'flat-imaging', signature, 58000.9) == 'flat2.fits'
+    assert calibration_fname('cafos', 'flat-imaging', dict(signature, NAXIS1=50), 58000.9) is None
+    assert calibration_fname('cafos', 'bias', signature, 58000.9) is None
+
+    for fname in ['raw.fits', 'flat2.fits']:
+        with open(fname, 'w') as f:
+            f.write('data')
+    setupdata = {'tweak_order_astrometry': 2}
+    hash0 = provenance_hash(['raw.fits'], [None, 'flat2.fits'], instconf, 'science-imaging', setupdata)
+    assert provenance_hash(['raw.fits'], [None, 'flat2.fits'], instconf, 'science-imaging', setupdata) == hash0
+    # different setup, options or calibration
+    assert provenance_hash(['raw.fits'], [None, 'flat2.fits'], instconf, 'science-imaging',
+                           {'tweak_order_astrometry': 3}) != hash0
+    assert provenance_hash(['raw.fits'], [None, 'flat2.fits'], instconf, 'science-imaging', setupdata,
+                           options={'no_astrometry': True}) != hash0
+    assert provenance_hash(['raw.fits'], [None, 'flat1.fits'], instconf, 'science-imaging', setupdata) != hash0
+    # modified master calibration
+    time.sleep(0.01)
+    with open('flat2.fits', 'w') as f:
+        f.write('new data')
+    os.utime('flat2.fits')
+    assert provenance_hash(['raw.fits'], [None, 'flat2.fits'], instconf, 'science-imaging', setupdata) != hash0
@@ -0,0 +1,51 @@
+import os
+
+from astropy.io import fits
+import numpy as np
+
+from filabres.benchmarks.stubs import install_stubs
+from filabres.instrumentation import StageTimer
+from filabres.run_astrometry import solve_field_concurrent, solve_field_pvalue
+from filabres.tologfile import ToLogFile
+
+
+def test_pvalue_trials(tmp_path, monkeypatch):
+    install_stubs(str(tmp_path / 'bin'))
+    monkeypatch.setenv('PATH', str(tmp_path / 'bin') + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('FILABRES_STUB_UNSOLVED_P', '2,3')
+    indexdir = tmp_path / 'index000001'
+    indexdir.mkdir()
+    solve_command = 'solve-field -p --config myastrometry.cfg --overwrite --ra 10.0 --dec 20.0 xxx.fits'
+    pvalues = [2, 3, 1, 0]
+
+    for ntrials in [1, 3]:
+        workdir = tmp_path / 'work{}'.format(ntrials)
+        workdir.mkdir()
+        fits.PrimaryHDU(np.zeros((64, 64))).writeto(workdir / 'xxx.fits')
+        fits.BinTableHDU.from_columns([
+            fits.Column(name='source_id', format='K', array=np.arange(3)),
+            fits.Column(name='ra', format='D', array=[10.0, 10.001, 9.999]),
+            fits.Column(name='dec', format='D', array=[20.0, 20.001, 19.999]),
+            fits.Column(name='phot_g_mean_mag', format='E', array=[10.0, 11.0, 12.0])
+        ]).writeto(workdir / 'GaiaDRX-query.fits')
+        (workdir / 'myastrometry.cfg').write_text('add_path .\nindex index-image')
+        logfile = ToLogFile(workdir=str(workdir), basename='reduction.log')
+        if ntrials == 1:
+            for pvalue in pvalues:
+                if solve_field_pvalue(str(workdir), pvalue, 1, str(indexdir), 'abc', solve_command, logfile):
+                    break
+        else:
+            timer = StageTimer()
+            pvalue = solve_field_concurrent(str(workdir), pvalues, ntrials, 1, str(indexdir), 'abc', solve_command,
+                                            logfile, timer=timer)
+            # the concurrent trials are included in the timings
+            assert set(timer.timings) == {'build_index', 'solve_field'}
+        logfile.close()
+        # first successful P value in the preferred order
+        assert pvalue == 1
+        assert (workdir / 'xxx.solved').is_file()
+        assert (workdir / 'index-image.fits').read_text() == '1'
+        assert sorted(os.listdir(workdir)) == sorted(['xxx.fits', 'GaiaDRX-query.fits', 'myastrometry.cfg',
+                                                      'reduction.log', 'index-image.fits', 'xxx.solved', 'xxx.wcs',
+                                                      'xxx.new', 'xxx.axy', 'xxx.corr'])
+    assert (indexdir / 'index-image_I000001_P3_abc.fits').read_text() == '3'
@@ -0,0 +1,16 @@
+import numpy as np
+
+from filabres.run_astrometry import saturated_objects
+
+
+def test_saturated_objects():
+    rng = np.random.default_rng(1234)
+    saturpix = rng.random((50, 80)) > 0.9
+    x = rng.uniform(0.5, 80.49, 1000)
+    y = rng.uniform(0.5, 50.49, 1000)
+    expected = [saturpix[int(yy + 0.5) - 1, int(xx + 0.5) - 1] for xx, yy in zip(x, y)]
+    assert np.array_equal(saturated_objects(x, y, saturpix), expected)
+
+    # objects outside the image
+    saturpix[:] = True
+    assert not np.any(saturated_objects([-3.0, 0.2, 81.0, np.nan], [10.0, 10.0, 10.0, 10.0], saturpix))
@@ -0,0 +1,48 @@
+from filabres.run_astrometry import read_tpv_solution
+from filabres.scamp_reference import ScampReference, replace_distortion, write_ahead
+from filabres.tologfile import ToLogFile
+
+
+def write_head(fname, pvvalue, maxindex):
+    with open(fname, 'wt') as f:
+        f.write('HISTORY   Astrometric solution\n')
+        f.write('{:8s}= {:20.12E} / {}\n'.format('CD1_1', -0.0001, 'Linear projection matrix'))
+        for axis in [1, 2]:
+            for i in range(maxindex + 1):
+                if i != 3:
+                    kwd = 'PV{}_{}'.format(axis, i)
+                    f.write('{:8s}= {:20.12E} / {}\n'.format(kwd, pvvalue, 'Projection distortion parameter'))
+        f.write('END\n')
+
+
+def test_scamp_reference(tmp_path):
+    logfile = ToLogFile(workdir=str(tmp_path), basename='scamp.log')
+    scampref = ScampReference(str(tmp_path))
+    assert scampref.get('sig1') is None
+    write_head(tmp_path / 'image1.head', 0.1, 10)
+    write_head(tmp_path / 'image2.head', 0.2, 10)
+    assert not scampref.update('sig1', str(tmp_path / 'image1.head'), 10, 0.1, 'image1.fits', logfile)
+    assert scampref.update('sig1', str(tmp_path / 'image1.head'), 200, 0.1, 'image1.fits', logfile)
+    assert not scampref.update('sig1', str(tmp_path / 'image2.head'), 150, 0.1, 'image2.fits', logfile)
+    # the reference is preserved
+    scampref = ScampReference(str(tmp_path))
+    reffname = scampref.get('sig1')
+    assert scampref.entries['sig1']['image'] == 'image1.fits'
+    assert scampref.get('sig2') is None
+
+    # a priori header
+    write_ahead(reffname, str(tmp_path / 'xxx.ahead'))
+    cards, history = read_tpv_solution(str(tmp_path / 'xxx.ahead'))
+    assert [card[0] for card in cards[:2]] == ['CTYPE1', 'CTYPE2']
+    assert len(cards) == 2 + 20
+
+    # linear solution completed with the reference distortion
+    write_head(tmp_path / 'xxx.head', 0.3, 2)
+    replace_distortion(str(tmp_path / 'xxx.head'), reffname)
+    cards, history = read_tpv_solution(str(tmp_path / 'xxx.head'))
+    values = dict((card[0], card[1]) for card in cards)
+    assert values['CD1_1'] == -0.0001
+    assert values['PV2_10'] == 0.1
+    assert values['PV1_0'] == 0.1
+    assert len(history) == 1
+    logfile.close()
@@ -0,0 +1,23 @@
+import os
+
+from filabres.staging import stage_file
+
+
+def test_staging(tmp_path):
+    src = tmp_path / 'src.txt'
+    src.write_text('data')
+    (tmp_path / 'dest').mkdir()
+
+    dst = stage_file(str(src), str(tmp_path / 'dest'))
+    assert dst == str(tmp_path / 'dest' / 'src.txt')
+    assert os.path.samefile(str(src), dst)
+
+    # an existing file is replaced
+    copied = stage_file(str(src), dst, mode='copy')
+    assert not os.path.samefile(str(src), copied)
+    assert (tmp_path / 'dest' / 'src.txt').read_text() == 'data'
+
+    moved = stage_file(str(src), str(tmp_path / 'moved.txt'), mode='move')
+    assert not src.exists()
+    assert open(moved).read() == 'data'
+    assert sorted(os.listdir(str(tmp_path / 'dest'))) == ['src.txt']
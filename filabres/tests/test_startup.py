@@ -0,0 +1,29 @@
+import subprocess
+import sys
+
+import pytest
+
+HEAVY_MODULES = ['pandas', 'matplotlib', 'scipy', 'astroquery', 'astropy.coordinates']
+
+
+def run_python(code):
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    return result.stdout.split()
+
+
+@pytest.mark.parametrize('module', ['filabres.filabres', 'filabres.list_reduced', 'filabres.list_classified'])
+def test_no_heavy_imports(module):
+    code = 'import sys\n' \
+           f'import {module}\n' \
+           f'print(" ".join(m for m in {HEAVY_MODULES} if m in sys.modules))'
+    assert run_python(code) == []
+
+
+def test_startup_imports():
+    # the command-line entry point must start without importing any of
+    # the heavy dependencies (checked instead of the elapsed time, which
+    # depends on the load of the machine)
+    code = 'import sys\n' \
+           'import filabres.filabres\n' \
+           'print(" ".join(m for m in ["astropy", "matplotlib", "scipy", "astroquery"] if m in sys.modules))'
+    assert run_python(code) == []
@@ -0,0 +1,71 @@
+from astropy.io import fits
+import json
+import numpy as np
+import os
+
+from filabres.load_instrument_configuration import load_instrument_configuration
+from filabres.retrieve_calibration import select_calibration
+from filabres.signature import signature_string
+from filabres.supermaster import rows_per_tile, run_supermaster_step, spill_frames, tiled_median
+
+
+def test_supermaster(tmp_path):
+    rng = np.random.default_rng(1234)
+    naxis2, naxis1 = 37, 20
+    fnames = []
+    images = []
+    for i in range(5):
+        data = rng.integers(1000, 2000, size=(naxis2, naxis1)).astype(np.uint16)
+        fname = str(tmp_path / 'frame{}.fits'.format(i))
+        fits.PrimaryHDU(data).writeto(fname)
+        fnames.append(fname)
+        images.append(data.astype(float) * (i + 1))
+    assert rows_per_tile(5, naxis1, 0.001) == 1
+    assert rows_per_tile(5, naxis1, 1000) > naxis2
+
+    image2d_bias = np.full((naxis2, naxis1), 100.0)
+    nrows = 4
+    stack, image2d_sum = spill_frames(fnames, str(tmp_path / 'cube.tmp'), naxis1, naxis2, nrows, image2d_bias)
+    cube = np.array([image / (i + 1) - 100.0 for i, image in enumerate(images)])
+    assert np.allclose(image2d_sum, np.sum(cube, axis=0))
+    assert np.allclose(tiled_median(stack, nrows), np.median(cube, axis=0))
+    scale = np.arange(1, 6, dtype=float)
+    assert np.allclose(tiled_median(stack, nrows, scale=scale),
+                       np.median(cube / scale[:, np.newaxis, np.newaxis], axis=0))
+
+
+def test_select_calibration():
+    entries = {'58000.10000': {}, '58003.10000': {},
+               '58010.50000': {'supermaster': True, 'mjd_min': 58000.0, 'mjd_max': 58020.0}}
+    # the super-masters are only preferred when requested
+    assert select_calibration(entries, 58003.0) == '58003.10000'
+    assert select_calibration(entries, 58012.0) == '58003.10000'
+    assert select_calibration(entries, 58003.0, use_supermasters=True) == '58010.50000'
+    assert select_calibration(entries, 57990.0, use_supermasters=True) == '58000.10000'
+    # no nightly calibration available
+    assert select_calibration({'58010.50000': entries['58010.50000']}, 57990.0) == '58010.50000'
+
+
+def test_supermaster_single_night(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    instconf = load_instrument_configuration({'instrument': 'cafos'}, 'bias')
+    signature = {'CCDNAME': 'SITE#1d_15', 'NAXIS1': 20, 'NAXIS2': 37, 'DATASEC': '[1,1,20,37]',
+                 'CCDBINX': 1, 'CCDBINY': 1}
+    imagedb = {'metainfo': {'instconf': {'version': instconf['version']}},
+               'bias': {'bias{}.fits'.format(i): dict(signature, **{'MJD-OBS': 58000.1 + i * 0.001})
+                        for i in range(3)}}
+    os.makedirs('lists/night001')
+    with open('lists/night001/imagedb_cafos.json', 'w') as f:
+        json.dump(imagedb, f)
+    # database with the nightly master computed from the same images
+    ssig = signature_string(instconf['imagetypes']['bias']['signature'], signature)
+    database = {'signaturekeys': instconf['imagetypes']['bias']['signature'],
+                'bias': {ssig: {'58000.10100': {'night': 'night001', 'fname': 'bias/night001/bias_red.fits'}}}}
+    with open('filabres_db_cafos_bias.json', 'w') as f:
+        json.dump(database, f)
+
+    run_supermaster_step('bias', {'datadir': str(tmp_path) + '/data/'}, ['night001'], instconf, force=False)
+    # the nightly master is preserved
+    with open('filabres_db_cafos_bias.json') as f:
+        assert json.load(f) == database
+    assert os.listdir('bias/supermaster') == []
@@ -0,0 +1,44 @@
+from astropy.io import fits
+from astropy.wcs import WCS
+import numpy as np
+
+from filabres.warm_start import SolvedFieldIndex, shifted_wcs
+
+
+def test_warm_start(tmp_path):
+    nightdir = str(tmp_path)
+    (tmp_path / 'image1').mkdir()
+    header = fits.Header()
+    header['CTYPE1'] = 'RA---TAN'
+    header['CTYPE2'] = 'DEC--TAN'
+    header['CRVAL1'] = 100.0
+    header['CRVAL2'] = 30.0
+    header['CRPIX1'] = 50.5
+    header['CRPIX2'] = 50.5
+    header['CD1_1'] = -0.5 / 3600
+    header['CD1_2'] = 0.0
+    header['CD2_1'] = 0.0
+    header['CD2_2'] = 0.5 / 3600
+    fits.PrimaryHDU(header=header).writeto(tmp_path / 'image1' / 'xxx.wcs')
+
+    wcsbase = SolvedFieldIndex(nightdir)
+    wcsbase.add('sig1', 100.01, 30.01, 2, 'image1/xxx.wcs')
+    wcsbase.add('sig1', 120.0, 30.0, 3, 'image2/xxx.wcs')
+    # records are preserved (the solution of image2 is not available)
+    wcsbase = SolvedFieldIndex(nightdir)
+    assert len(wcsbase) == 2
+    assert wcsbase.find('sig1', 100.02, 30.0, 4)['pvalue'] == 2
+    assert wcsbase.find('sig2', 100.02, 30.0, 4) is None
+    assert wcsbase.find('sig1', 100.2, 30.0, 4) is None
+    assert wcsbase.find('sig1', 120.0, 30.0, 4) is None
+
+    # the shifted solution is centred on the new pointing
+    outfname = str(tmp_path / 'previous.wcs')
+    ra, dec, pixscale = shifted_wcs(wcsbase.path(wcsbase.find('sig1', 100.02, 30.0, 4)),
+                                    100.01, 30.01, 100.02, 30.0, 100, 100, outfname)
+    assert np.isclose(ra, 100.01, atol=1e-4)
+    assert np.isclose(dec, 29.99, atol=1e-4)
+    assert np.isclose(pixscale, 0.5)
+    with fits.open(outfname) as hdul:
+        w = WCS(hdul[0].header)
+    assert np.allclose(w.all_pix2world(50.5, 50.5, 1), [ra, dec])
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2020 Universidad Complutense de Madrid
+#
+# This file is part of filabres
+#
+# SPDX-License-Identifier: GPL-3.0+
+# License-Filename: LICENSE.txt
+#
+
+"""
+Generate a local Gaia catalogue from pre-extracted Gaia data.
+
+The input files can be in any format readable by astropy.table.Table
+(e.g. FITS binary tables, VOTable or CSV files), containing at least the
+columns SOURCE_ID, ref_epoch, ra, dec, pmra, pmdec and phot_g_mean_mag.
+The resulting directory can be employed by setting
+gaiadr_source: local:<directory>
+in setup_filabres.yaml.
+"""
+
+import argparse
+from astropy.table import Table, vstack
+
+from filabres.local_gaia import DEFAULT_TILE_DEG
+from filabres.local_gaia import write_local_catalogue
+
+
+def main():
+    # parse command-line options
+    parser = argparse.ArgumentParser(description="Auxiliary script to generate a local Gaia catalogue")
+
+    parser.add_argument("filename", nargs='+', help="input file(s) with Gaia data")
+    parser.add_argument("--outdir", required=True, type=str, help="output directory")
+    parser.add_argument("--tile_deg", type=float, default=DEFAULT_TILE_DEG,
+                        help="approximate size (degrees) of the sky tiles")
+
+    args = parser.parse_args()
+
+    tables = [Table.read(fname) for fname in args.filename]
+    table = vstack(tables, metadata_conflicts='silent') if len(tables) > 1 else tables[0]
+    ntiles = write_local_catalogue(table, args.outdir, args.tile_deg)
+    print('{} sources stored in {} tiles under {}'.format(len(table), ntiles, args.outdir))
+
+
+if __name__ == "__main__":
+
+    main()
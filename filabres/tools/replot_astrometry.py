@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2020 Universidad Complutense de Madrid
+#
+# This file is part of filabres
+#
+# SPDX-License-Identifier: GPL-3.0+
+# License-Filename: LICENSE.txt
+#
+
+"""
+Generate the plots of the astrometric calibration of reduced science
+images from the data saved during the reduction (useful when the
+reduction was executed with --astrometry_plots none).
+"""
+
+import argparse
+import matplotlib
+import os
+
+from filabres.plot_astrometry import replot_astrometry
+
+
+def main():
+    # parse command-line options
+    parser = argparse.ArgumentParser(description="Auxiliary script to generate the plots of the astrometric "
+                                                 "calibration of reduced science images")
+
+    parser.add_argument("filename", help="reduced FITS file(s)", nargs='+')
+    parser.add_argument("--suffix", help="astrometric calibration", choices=['net', 'scamp'],
+                        nargs='+', default=['net', 'scamp'])
+    parser.add_argument("--force", action="store_true", help="regenerate existing PDF files")
+
+    args = parser.parse_args()
+
+    # ---
+
+    matplotlib.use('Agg')
+
+    for filename in args.filename:
+        if filename[-5:] != '.fits':
+            msg = 'ERROR: FITS extension (.fits) not found!'
+            raise SystemError(msg)
+        # subdirectory with the auxiliary files of the reduced image
+        backupsubdir = filename[:-5]
+        for suffix in args.suffix:
+            npzfname = '{}/astrometry-{}.npz'.format(backupsubdir, suffix)
+            pdfname = '{}/astrometry-{}.pdf'.format(backupsubdir, suffix)
+            if not os.path.isfile(npzfname):
+                print('WARNING: file {} not found'.format(npzfname))
+            elif os.path.isfile(pdfname) and not args.force:
+                print('File {} already exists (use --force to regenerate it)'.format(pdfname))
+            else:
+                replot_astrometry(npzfname, pdfname, image_fname=filename)
+                print('File {} created'.format(pdfname))
+
+
+if __name__ == "__main__":
+
+    main()
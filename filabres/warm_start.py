@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2020 Universidad Complutense de Madrid
+#
+# This file is part of filabres
+#
+# SPDX-License-Identifier: GPL-3.0+
+# License-Filename: LICENSE.txt
+#
+
+"""
+WCS solutions of the science images already calibrated in a night.
+
+Dithered or repeated exposures of the same field are usually solved
+with the same P value and have almost the same WCS solution. After
+solving a field with Astrometry.net, the pointing, signature, P value
+and the location of the WCS solution (xxx.wcs saved in the subdirectory
+of the reduced image) are stored as an append-only file
+(solved_wcs.jsonl, one JSON record per line). When a new image with the
+same signature and a close pointing is calibrated, the previous WCS
+solution, shifted by the pointing offset, is verified first with tight
+position and scale constraints (warm start), and the blind search is
+only performed when this fails.
+"""
+
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from astropy.wcs import WCS
+from astropy.wcs.utils import proj_plane_pixel_scales
+import json
+import numpy as np
+import os
+
+from .pointing_index import unit_vector
+
+JSONL_FNAME = 'solved_wcs.jsonl'
+
+# maximum pointing offset (fraction of the maximum field of view)
+MAXDIST_FACTOR = 0.25
+# search radius around the predicted field centre (fraction of the
+# maximum field of view)
+RADIUS_FACTOR = 0.05
+# relative tolerance in the pixel scale
+SCALE_TOLERANCE = 0.05
+
+
+class SolvedFieldIndex(object):
+    """
+    WCS solutions computed with Astrometry.net in a night.
+
+    Parameters
+    ----------
+    nightdir : str or None
+        Directory where the reduced images are stored. If None, the
+        solutions are only kept in memory.
+    """
+    def __init__(self, nightdir=None):
+        self.nightdir = nightdir
+        self.entries = []
+        if nightdir is None:
+            return
+        jsonlfname = os.path.join(nightdir, JSONL_FNAME)
+        if os.path.exists(jsonlfname):
+            with open(jsonlfname) as jfile:
+                for line in jfile:
+                    # ignore an incomplete last line (interrupted execution)
+                    try:
+                        self.entries.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        continue
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, signature, ra_deg, dec_deg, pvalue, wcsfname):
+        """
+        Add a new WCS solution.
+
+        Parameters
+        ----------
+        signature : str
+            Signature of the image (see signature_string()).
+        ra_deg, dec_deg : float
+            Central coordinates (J2000, degrees) of the pointing
+            given in the image header.
+        pvalue : int
+            P value employed to solve the field.
+        wcsfname : str
+            File name of the WCS solution (relative to nightdir).
+        """
+        entry = {
+            'signature': signature,
+            'ra': float(ra_deg),
+            'dec': float(dec_deg),
+            'pvalue': int(pvalue),
+            'wcsfname': wcsfname
+        }
+        if self.nightdir is not None:
+            with open(os.path.join(self.nightdir, JSONL_FNAME), 'a') as outfile:
+                outfile.write(json.dumps(entry) + '\n')
+        self.entries.append(entry)
+
+    def path(self, entry):
+        """Return path to the file with the WCS solution of a record."""
+        if self.nightdir is None:
+            return entry['wcsfname']
+        return os.path.join(self.nightdir, entry['wcsfname'])
+
+    def find(self, signature, ra_deg, dec_deg, maxdist_arcmin):
+        """
+        Find the closest WCS solution of an image with the same signature.
+
+        Parameters
+        ----------
+        signature : str
+            Signature of the image (see signature_string()).
+        ra_deg, dec_deg : float
+            Central coordinates (J2000, degrees) of the pointing.
+        maxdist_arcmin : float
+            Maximum distance between pointings.
+
+        Returns
+        -------
+        entry : dict or None
+            Record of the closest solution (the most recent one when
+            several solutions share the same pointing). None if not
+            found or if the file with the WCS solution is no longer
+            available.
+        """
+        candidates = [entry for entry in self.entries[::-1]
+                      if entry['signature'] == signature and os.path.isfile(self.path(entry))]
+        if len(candidates) == 0:
+            return None
+        xyz = np.array(unit_vector(ra_deg, dec_deg))
+        xyz_solved = np.array([unit_vector(entry['ra'], entry['dec']) for entry in candidates])
+        dist_arcmin = np.arccos(np.clip(xyz_solved @ xyz, -1, 1)) * 180 / np.pi * 60
+        iclosest = np.argmin(dist_arcmin)
+        if dist_arcmin[iclosest] > maxdist_arcmin:
+            return None
+        return candidates[iclosest]
+
+
+def shifted_wcs(wcsfname, ra_old, dec_old, ra_new, dec_new, naxis1, naxis2, outfname):
+    """
+    Shift a WCS solution by the offset between two pointings.
+
+    Parameters
+    ----------
+    wcsfname : str
+        File name of the initial WCS solution.
+    ra_old, dec_old : float
+        Pointing (J2000, degrees) corresponding to the initial WCS
+        solution.
+    ra_new, dec_new : float
+        New pointing (J2000, degrees).
+    naxis1, naxis2 : int
+        Image dimensions.
+    outfname : str
+        Output file name.
+
+    Returns
+    -------
+    ra_centre, dec_centre : float
+        Predicted coordinates (J2000, degrees) of the field centre.
+    pixscale : float
+        Pixel scale (mean in both axis) in arcsec/pix.
+    """
+    with fits.open(wcsfname) as hdul:
+        header = hdul[0].header.copy()
+    c_old = SkyCoord(ra=ra_old * u.degree, dec=dec_old * u.degree, frame='fk5')
+    c_new = SkyCoord(ra=ra_new * u.degree, dec=dec_new * u.degree, frame='fk5')
+    dra, ddec = c_old.spherical_offsets_to(c_new)
+    crval = SkyCoord(ra=header['CRVAL1'] * u.degree, dec=header['CRVAL2'] * u.degree, frame='fk5')
+    crval = crval.spherical_offsets_by(dra, ddec)
+    header['CRVAL1'] = crval.ra.deg
+    header['CRVAL2'] = crval.dec.deg
+    fits.PrimaryHDU(header=header).writeto(outfname, overwrite=True)
+    w = WCS(header, relax=True)
+    ra_centre, dec_centre = w.all_pix2world((naxis1 + 1) / 2, (naxis2 + 1) / 2, 1)
+    pixscale = np.mean(proj_plane_pixel_scales(w)) * 3600
+    return float(ra_centre), float(dec_centre), float(pixscale)